@@ -1,4 +1,26 @@
+from importlib import import_module
+# Imported now because importing a submodule binds it on the package under its own name, which would otherwise hide
+# the entry point
 from .process_target import main as process_target
 from .process_ligands import main as process_ligands
-from .rank_molecules import main as nrgrank_main
-from .generate_conformers import main as generate_conformers
\ No newline at end of file
+
+# The other entry points are imported on first use so that importing nrgrank does not load RDKit
+_entry_points = {
+    'nrgrank_main': ('.rank_molecules', 'main'),
+    'generate_conformers': ('.generate_conformers', 'main'),
+    'nrgrank_multi_target': ('.rank_multi_target', 'main'),
+}
+__all__ = ['process_target', 'process_ligands', *_entry_points]
+
+
+def __getattr__(name):
+    if name not in _entry_points:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module_name, attribute_name = _entry_points[name]
+    value = getattr(import_module(module_name, __name__), attribute_name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_entry_points))
@@ -0,0 +1,318 @@
+import os
+import json
+import shutil
+import argparse
+import platform
+import subprocess
+import sys
+import timeit
+from importlib.metadata import version, PackageNotFoundError
+import numpy as np
+import numba
+from nrgrank.process_target import main as process_target_main
+from nrgrank.process_ligands import main as process_ligands_main
+from nrgrank.rank_molecules import get_params_dict, load_target_from_params, load_ligands, get_rotation_matrices, \
+    rotate_ligand, score_ligands, write_molecule_poses, format_result_lines, get_pose_output_path
+from nrgrank.pose_writer import PoseWriter
+
+synthetic_atom_types = ['C.3', 'C.2', 'C.ar', 'N.am', 'N.3', 'O.2', 'O.3', 'S.3', 'N.4', 'O.co2', 'C.cat', 'N.pl3']
+
+
+def write_mol2_molecule(f, molecule_name, molecule_type, atom_types, atoms_xyz, residue_name):
+    f.write(f"@<TRIPOS>MOLECULE\n{molecule_name}\n {len(atom_types)} 0 0 0 0\n{molecule_type}\nNO_CHARGES\n\n"
+            f"@<TRIPOS>ATOM\n")
+    for i, (atom_type, xyz) in enumerate(zip(atom_types, atoms_xyz)):
+        f.write(f"{i+1:7d} {atom_type.split('.')[0]}{i:<5d} {xyz[0]:9.4f} {xyz[1]:9.4f} {xyz[2]:9.4f} {atom_type:<6}"
+                f"    1  {residue_name}  0.0000\n")
+    f.write("@<TRIPOS>BOND\n")
+
+
+def make_synthetic_target(folder_path, n_atoms=1500, box_size=40.0, pocket_radius=7.5, n_spheres=12,
+                          sphere_radius_range=(1.5, 3.0), seed=0):
+    """ Writes a target of n_atoms random atoms around an empty spherical pocket and a binding site made of
+    n_spheres spheres inside the pocket. Returns the paths to the target mol2 file and the binding site pdb file"""
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder_path, exist_ok=True)
+    atoms_xyz = np.zeros((0, 3))
+    while len(atoms_xyz) < n_atoms:
+        candidates = rng.uniform(-box_size / 2, box_size / 2, (n_atoms, 3))
+        atoms_xyz = np.concatenate((atoms_xyz, candidates[np.linalg.norm(candidates, axis=1) > pocket_radius]))
+    atoms_xyz = atoms_xyz[:n_atoms]
+    atom_types = [synthetic_atom_types[i] for i in rng.integers(len(synthetic_atom_types), size=n_atoms)]
+    target_path = os.path.join(folder_path, 'target.mol2')
+    with open(target_path, 'w') as f:
+        write_mol2_molecule(f, 'target', 'PROTEIN', atom_types, atoms_xyz, 'RES1')
+
+    sphere_spread = pocket_radius / 2
+    binding_site_path = os.path.join(folder_path, 'bd_site.pdb')
+    with open(binding_site_path, 'w') as f:
+        for i in range(n_spheres):
+            center = rng.uniform(-sphere_spread, sphere_spread, 3)
+            radius = rng.uniform(*sphere_radius_range)
+            f.write(f"ATOM  {i+1:5d}  C   SPH A   1    {center[0]:8.3f}{center[1]:8.3f}{center[2]:8.3f}  1.00"
+                    f"{radius:6.2f}\n")
+    return target_path, binding_site_path
+
+
+def make_synthetic_ligands(mol2_path, n_molecules=100, atoms_range=(6, 30), conformers_per_molecule=1,
+                           hydrogen_fraction=0.4, seed=0):
+    """ Writes n_molecules random chain molecules with conformers_per_molecule conformers each to a mol2 file.
+    Hydrogens are added to a fraction of the heavy atoms so the preprocessing has some to remove"""
+    rng = np.random.default_rng(seed)
+    with open(mol2_path, 'w') as f:
+        for i in range(n_molecules):
+            n_heavy_atoms = int(rng.integers(atoms_range[0], atoms_range[1] + 1))
+            heavy_atom_types = [synthetic_atom_types[j] for j in rng.integers(len(synthetic_atom_types),
+                                                                               size=n_heavy_atoms)]
+            has_hydrogen = rng.random(n_heavy_atoms) < hydrogen_fraction
+            for _ in range(conformers_per_molecule):
+                heavy_atoms_xyz = np.cumsum(rng.normal(0, 0.9, (n_heavy_atoms, 3)), axis=0)
+                atom_types, atoms_xyz = [], []
+                for atom_type, xyz, hydrogen in zip(heavy_atom_types, heavy_atoms_xyz, has_hydrogen):
+                    atom_types.append(atom_type)
+                    atoms_xyz.append(xyz)
+                    if hydrogen:
+                        atom_types.append('H')
+                        atoms_xyz.append(xyz + 0.6)
+                write_mol2_molecule(f, f"MOL{i}", 'SMALL', atom_types, atoms_xyz, 'LIG1')
+    return mol2_path
+
+
+def time_stage(stage_times, stage_name, function, *args, **kwargs):
+    stage_start = timeit.default_timer()
+    result = function(*args, **kwargs)
+    stage_times.setdefault(stage_name, []).append(timeit.default_timer() - stage_start)
+    return result
+
+
+def rotate_all_ligands(atom_xyz, atom_offsets, rotation_matrices):
+    for i in range(len(atom_offsets) - 1):
+        rotate_ligand(atom_xyz[atom_offsets[i]:atom_offsets[i+1]], rotation_matrices)
+
+
+def write_all_outputs(output_folder_path, top_poses_list, rotation_matrices, atom_name_array, atom_type_array,
+                      atom_xyz_array, atom_offsets, molecule_name_array, binding_site_grid, params_dict):
+    poses_saved_per_molecule = params_dict['POSES_SAVED_PER_MOLECULE']
+    ligand_pose_save_path = os.path.join(output_folder_path, 'ligand_poses')
+    if os.path.isdir(ligand_pose_save_path):
+        shutil.rmtree(ligand_pose_save_path)
+    pose_writer = None
+    if params_dict['POSE_OUTPUT_FORMAT'] != 'pdb':
+        pose_writer = PoseWriter(get_pose_output_path(ligand_pose_save_path, params_dict['POSE_OUTPUT_FORMAT']),
+                                 params_dict['POSE_OUTPUT_FORMAT'])
+    if poses_saved_per_molecule > 0:
+        for i in range(len(molecule_name_array)):
+            write_molecule_poses(top_poses_list[i], rotation_matrices,
+                                 atom_xyz_array[atom_offsets[i]:atom_offsets[i+1]],
+                                 atom_type_array[atom_offsets[i]:atom_offsets[i+1]], atom_name_array[i],
+                                 molecule_name_array[i], binding_site_grid, ligand_pose_save_path, 1,
+                                 poses_saved_per_molecule, 'benchmark', pose_writer, i)
+    if pose_writer:
+        pose_writer.close()
+    with open(os.path.join(output_folder_path, 'benchmark.csv'), 'w') as f:
+        f.write(format_result_lines([molecule_name.rsplit('_', 1)[0] for molecule_name in molecule_name_array],
+                                    np.rint(top_poses_list[:, 0, 0]).astype(np.int64), None, 'ligand', None, None,
+                                    ','))
+
+
+cold_start_script = """
+import sys, json, timeit
+time_start = timeit.default_timer()
+sys.path.insert(0, sys.argv[1])
+import numpy as np
+from nrgrank.rank_molecules import get_params_dict, load_target_from_params, load_ligands, get_rotation_matrices, \\
+    score_ligands
+time_import = timeit.default_timer()
+params_dict = get_params_dict(json.loads(sys.argv[4]))
+target = load_target_from_params(sys.argv[2], params_dict)
+_, atom_type, atom_xyz, atom_offsets, _, _, _ = load_ligands(None, 'ligand', 0, 1, 1, path_to_ligands=sys.argv[3])
+if params_dict['SEARCH_MODE'] == 'coarse_to_fine':
+    coarse_rotation_matrices = get_rotation_matrices(params_dict['COARSE_ROTATIONS_PER_AXIS'])
+else:
+    coarse_rotation_matrices = np.zeros((0, 3, 3), dtype=np.float64)
+score_ligands(target, atom_xyz, atom_type, atom_offsets, get_rotation_matrices(params_dict['LIGAND_ROTATIONS_PER_AXIS']),
+              coarse_rotation_matrices, params_dict)
+print(json.dumps({'import': time_import - time_start, 'first ligand': timeit.default_timer() - time_import}))
+"""
+
+
+def measure_cold_start(preprocessed_target_path, preprocessed_ligand_path, params_dict):
+    """ Scores one ligand in a new interpreter, like a short job would. Returns the time until the first ligand is
+    scored, the import time and the time to load and score the first ligand. The kernels are only compiled when they
+    are not in the numba cache yet"""
+    package_parent_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    time_start = timeit.default_timer()
+    output = subprocess.run([sys.executable, '-c', cold_start_script, package_parent_path, preprocessed_target_path,
+                             preprocessed_ligand_path, json.dumps(params_dict)], capture_output=True, text=True,
+                            check=True).stdout
+    cold_start_time = timeit.default_timer() - time_start
+    cold_start_stages = json.loads(output.strip().splitlines()[-1])
+    return cold_start_time, cold_start_stages['import'], cold_start_stages['first ligand']
+
+
+def get_environment():
+    try:
+        nrgrank_version = version('nrgrank')
+    except PackageNotFoundError:
+        nrgrank_version = 'unknown'
+    return {'nrgrank': nrgrank_version, 'python': platform.python_version(), 'numpy': np.__version__,
+            'numba': numba.__version__, 'machine': platform.machine(), 'processor': platform.processor(),
+            'cpu_count': os.cpu_count(), 'numba_threads': numba.get_num_threads()}
+
+
+def run_benchmark(output_folder_path, n_target_atoms=1500, n_ligands=100, atoms_range=(6, 30),
+                  conformers_per_molecule=1, n_spheres=12, repeats=3, seed=0, **user_config):
+    """
+    Runs the pipeline on a synthetic target and ligand library and times every stage.
+
+    Parameters:
+        output_folder_path (str): Folder for the synthetic inputs and the outputs of the benchmark.
+        n_target_atoms (int, optional): Number of target atoms. Default is 1500.
+        n_ligands (int, optional): Number of ligands in the library. Default is 100.
+        atoms_range (tuple[int, int], optional): Smallest and largest number of heavy atoms of a ligand.
+        conformers_per_molecule (int, optional): Conformers written for every ligand. Default is 1.
+        n_spheres (int, optional): Number of binding site spheres. Default is 12.
+        repeats (int, optional): Number of times every stage is run. The first run includes the numba compilation
+            unless the kernels are in the numba cache. Default is 3.
+        seed (int, optional): Seed of the synthetic inputs. The same seed gives the same inputs. Default is 0.
+        **user_config: Arbitrary keyword arguments for overriding default docking parameters.
+
+    Returns:
+        A dictionary with the environment, the configuration, the time of every stage (first run and best run) and the
+        throughput of the scoring stage
+    """
+    if repeats < 1:
+        raise ValueError(f"repeats must be at least 1, got {repeats}")
+    params_dict = get_params_dict(user_config)
+    input_folder_path = os.path.join(output_folder_path, 'inputs')
+    os.makedirs(input_folder_path, exist_ok=True)
+    target_path, binding_site_path = make_synthetic_target(input_folder_path, n_target_atoms, n_spheres=n_spheres,
+                                                           seed=seed)
+    ligand_mol2_path = make_synthetic_ligands(os.path.join(input_folder_path,
+                                                           f'ligands_{conformers_per_molecule}_conf.mol2'),
+                                              n_ligands, atoms_range, conformers_per_molecule, seed=seed)
+    target_config = {key: params_dict[key] for key in ('CLASH_DOT_DISTANCE', 'LIGAND_TEST_DOT_SEPARATION',
+                                                       'COARSE_TEST_DOT_SEPARATION', 'USE_CLASH', 'CF_GRID_SPACING')}
+
+    stage_times = {}
+    for _ in range(repeats):
+        preprocessed_target_path = time_stage(stage_times, 'target preprocess', process_target_main, target_path,
+                                              binding_site_path, overwrite=True, **target_config)
+        preprocessed_ligand_path = time_stage(stage_times, 'ligand preprocess', process_ligands_main,
+                                              ligand_mol2_path, conformers_per_molecule, overwrite=True)
+        target = time_stage(stage_times, 'target load', load_target_from_params, preprocessed_target_path,
+                            params_dict)
+        atom_name_array, atom_type_array, atom_xyz_array, atom_offsets, molecule_name_array, _, molecule_count = \
+            time_stage(stage_times, 'ligand load', load_ligands, None, 'ligand', 0, None, conformers_per_molecule,
+                       path_to_ligands=preprocessed_ligand_path)
+        rotation_matrices = get_rotation_matrices(params_dict['LIGAND_ROTATIONS_PER_AXIS'])
+        if params_dict['SEARCH_MODE'] == 'coarse_to_fine':
+            coarse_rotation_matrices = get_rotation_matrices(params_dict['COARSE_ROTATIONS_PER_AXIS'])
+        else:
+            coarse_rotation_matrices = np.zeros((0, 3, 3), dtype=np.float64)
+        time_stage(stage_times, 'rotation', rotate_all_ligands, atom_xyz_array, atom_offsets, rotation_matrices)
+        top_poses_list, _, _, _ = time_stage(stage_times, 'scoring', score_ligands, target, atom_xyz_array,
+                                          atom_type_array, atom_offsets, rotation_matrices, coarse_rotation_matrices,
+                                          params_dict)
+        time_stage(stage_times, 'output', write_all_outputs, output_folder_path, top_poses_list, rotation_matrices,
+                   atom_name_array, atom_type_array, atom_xyz_array, atom_offsets, molecule_name_array,
+                   target['binding_site_grid'], params_dict)
+        cold_start_times = measure_cold_start(preprocessed_target_path, preprocessed_ligand_path, params_dict)
+        for stage, stage_time in zip(('cold start', 'cold start import', 'cold start first ligand'), cold_start_times):
+            stage_times.setdefault(stage, []).append(stage_time)
+
+    n_poses = molecule_count * len(target['binding_site_grid']) * len(rotation_matrices)
+    best_scoring_time = min(stage_times['scoring'])
+    return {'environment': get_environment(),
+            'config': {'n_target_atoms': n_target_atoms, 'n_ligands': n_ligands, 'atoms_range': list(atoms_range),
+                       'conformers_per_molecule': conformers_per_molecule, 'n_spheres': n_spheres,
+                       'repeats': repeats, 'seed': seed, 'params': params_dict},
+            'binding_site_grid_dots': len(target['binding_site_grid']),
+            'rotations': len(rotation_matrices),
+            'molecules': molecule_count,
+            'stages': {stage: {'first': times[0], 'best': min(times)} for stage, times in stage_times.items()},
+            'ligands_per_second': molecule_count / best_scoring_time,
+            'poses_per_second': n_poses / best_scoring_time}
+
+
+def compare_benchmarks(baseline_results, new_results, tolerance=0.1):
+    """ Compares the best stage times and the throughput of two benchmark results. Returns report lines and the list
+    of stages that are more than tolerance slower in new_results"""
+    lines = [f"{'stage':<20}{'baseline':>12}{'new':>12}{'ratio':>8}"]
+    regressions = []
+    for stage, baseline_times in baseline_results['stages'].items():
+        if stage not in new_results['stages']:
+            continue
+        baseline_time = baseline_times['best']
+        new_time = new_results['stages'][stage]['best']
+        ratio = new_time / baseline_time if baseline_time > 0 else float('inf')
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions.append(stage)
+            flag = ' slower'
+        lines.append(f"{stage:<20}{baseline_time:>12.4f}{new_time:>12.4f}{ratio:>8.2f}{flag}")
+    for key in ('ligands_per_second', 'poses_per_second'):
+        lines.append(f"{key:<20}{baseline_results[key]:>12.1f}{new_results[key]:>12.1f}"
+                     f"{new_results[key] / baseline_results[key]:>8.2f}")
+    if baseline_results['config'] != new_results['config']:
+        lines.append("Warning: the benchmarks were run with different configurations")
+    return lines, regressions
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmark the NRGRank pipeline on synthetic inputs')
+    parser.add_argument('-o', '--output_folder_path', type=str, default=None,
+                        help='Folder for the synthetic inputs and the benchmark outputs')
+    parser.add_argument('-r', '--result_path', type=str, default=None,
+                        help='JSON file the results are written to. Default is benchmark.json in the output folder')
+    parser.add_argument('-n', '--n_ligands', type=int, default=100, help='Number of ligands')
+    parser.add_argument('-a', '--n_target_atoms', type=int, default=1500, help='Number of target atoms')
+    parser.add_argument('--min_atoms', type=int, default=6, help='Smallest number of heavy atoms of a ligand')
+    parser.add_argument('--max_atoms', type=int, default=30, help='Largest number of heavy atoms of a ligand')
+    parser.add_argument('--conformers', type=int, default=1, help='Number of conformers per ligand')
+    parser.add_argument('--spheres', type=int, default=12, help='Number of binding site spheres')
+    parser.add_argument('--repeats', type=int, default=3, help='Number of runs of every stage')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic inputs')
+    parser.add_argument('-c', '--config', type=str, default=None,
+                        help='JSON file with parameters overriding the default docking parameters')
+    parser.add_argument('--compare', type=str, nargs=2, default=None, metavar=('BASELINE', 'NEW'),
+                        help='Compare two benchmark result files instead of running a benchmark')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Relative slow down of a stage reported as a regression by --compare')
+    args = parser.parse_args()
+    if args.compare:
+        with open(args.compare[0]) as f:
+            baseline_results = json.load(f)
+        with open(args.compare[1]) as f:
+            new_results = json.load(f)
+        lines, regressions = compare_benchmarks(baseline_results, new_results, args.tolerance)
+        print("\n".join(lines))
+        if regressions:
+            exit(1)
+        return
+    if args.output_folder_path is None:
+        parser.error('-o/--output_folder_path is required to run a benchmark')
+    user_config = {}
+    if args.config:
+        with open(args.config) as f:
+            user_config = json.load(f)
+    main(args.output_folder_path, result_path=args.result_path, n_target_atoms=args.n_target_atoms,
+         n_ligands=args.n_ligands, atoms_range=(args.min_atoms, args.max_atoms), conformers_per_molecule=args.conformers,
+         n_spheres=args.spheres, repeats=args.repeats, seed=args.seed, **user_config)
+
+
+def main(output_folder_path, result_path=None, **benchmark_config):
+    """ Runs run_benchmark, prints a summary and saves the results as JSON. Returns the path to the results"""
+    results = run_benchmark(output_folder_path, **benchmark_config)
+    if result_path is None:
+        result_path = os.path.join(output_folder_path, 'benchmark.json')
+    with open(result_path, 'w') as f:
+        json.dump(results, f, indent=1)
+    for stage, stage_time in results['stages'].items():
+        print(f"{stage}: {stage_time['best']:.4f} seconds (first run {stage_time['first']:.4f} seconds)")
+    print(f"{results['ligands_per_second']:.1f} ligands/second, {results['poses_per_second']:.0f} poses/second")
+    return result_path
+
+
+if __name__ == '__main__':
+    get_args()
@@ -1,6 +1,7 @@
 import os
 import json
 import importlib.resources
+import numpy as np
 
 
 def write_pdb(coord_list, name, path, ligand_names, extra_info):
@@ -44,4 +45,24 @@ def get_radius_number(letter_type, rad_dict):
         atm_info = [39, 2.00]
     atm_type_num = atm_info[0]
     atm_rad = atm_info[1]
-    return atm_type_num, atm_rad
\ No newline at end of file
+    return atm_type_num, atm_rad
+
+
+def save_string_table(save_path, table_name, strings):
+    """ Saves strings as one utf-8 byte array with offsets so any range can be read back without loading the rest"""
+    encoded_strings = [f"{string}\n".encode('utf-8') for string in strings]
+    offsets = np.zeros(len(encoded_strings) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(string) for string in encoded_strings], dtype=np.int64)
+    np.save(os.path.join(save_path, f"{table_name}_offsets"), offsets)
+    np.save(os.path.join(save_path, f"{table_name}_bytes"), np.frombuffer(b"".join(encoded_strings), dtype=np.uint8))
+
+
+def load_string_table(save_path, table_name, start=0, end=None):
+    offsets = np.load(os.path.join(save_path, f"{table_name}_offsets.npy"), mmap_mode='r')
+    string_count = len(offsets) - 1
+    if end is None or end > string_count:
+        end = string_count
+    if start >= end:
+        return []
+    string_bytes = np.load(os.path.join(save_path, f"{table_name}_bytes.npy"), mmap_mode='r')
+    return string_bytes[offsets[start]:offsets[end]].tobytes().decode('utf-8').split('\n')[:-1]
@@ -1,5 +1,6 @@
 import concurrent.futures
 import os
+import shutil
 try:
     from rdkit import Chem
     from rdkit.Chem import AllChem, rdMolDescriptors, rdForceFieldHelpers, rdDistGeom
@@ -10,6 +11,8 @@ except Exception:
 from itertools import repeat
 from datetime import datetime
 from nrgrank import process_ligands
+from nrgrank.process_ligands import get_suffix, write_ligand_shards, write_ligand_manifest, remove_ligand_shards
+from nrgrank.general_functions import get_radius_number, load_rad_dict
 import subprocess
 import csv
 import argparse
@@ -43,6 +46,33 @@ def read_column_from_csv(file_path, column_number, delimiter, has_header=True):
     return column_values
 
 
+def iter_smiles_chunks(smiles_path_or_dict, smiles_column_number, name_column_number, chunk_size):
+    """ Yields (smiles, names) lists of at most chunk_size molecules. A csv file is read one row at a time so the
+    whole file is never held in memory"""
+    if isinstance(smiles_path_or_dict, dict):
+        molecule_smiles_list = list(smiles_path_or_dict['Smiles'])
+        molecule_name_list = list(smiles_path_or_dict['Name'])
+        for chunk_start in range(0, len(molecule_smiles_list), chunk_size):
+            yield (molecule_smiles_list[chunk_start:chunk_start+chunk_size],
+                   molecule_name_list[chunk_start:chunk_start+chunk_size])
+        return
+    delimiter = get_delimiter(smiles_path_or_dict, bytes_to_read=4096)
+    chunk_smiles, chunk_names = [], []
+    with open(smiles_path_or_dict, mode='r', encoding='utf-8') as file:
+        reader = csv.reader(file, delimiter=delimiter)
+        next(reader, None)
+        for row in reader:
+            # Rows missing either column are skipped
+            if len(row) > smiles_column_number and len(row) > name_column_number:
+                chunk_smiles.append(row[smiles_column_number])
+                chunk_names.append(row[name_column_number])
+                if len(chunk_smiles) == chunk_size:
+                    yield chunk_smiles, chunk_names
+                    chunk_smiles, chunk_names = [], []
+    if chunk_smiles:
+        yield chunk_smiles, chunk_names
+
+
 def generate_conformers(molecule_smile, molecule_name, no_conformers, mol_weight_max=None, heavy_atoms_min=None):
     etkdg = rdDistGeom.ETKDGv3()
     # === optional settings ===
@@ -87,6 +117,215 @@ def generate_conformers(molecule_smile, molecule_name, no_conformers, mol_weight
     return mol
 
 
+def convert_to_mol2(sdf_path, mol2_path):
+    open_babel_command = f"obabel \"{sdf_path}\" -O \"{mol2_path}\" ---errorlevel 1"
+    subprocess.run(open_babel_command, shell=True, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    os.remove(sdf_path)
+
+
+def is_amide_nitrogen(atom):
+    for neighbour in atom.GetNeighbors():
+        if neighbour.GetSymbol() == 'C' and not neighbour.GetIsAromatic():
+            for bond in neighbour.GetBonds():
+                if bond.GetBondType() == Chem.BondType.DOUBLE and bond.GetOtherAtom(neighbour).GetSymbol() in ('O', 'S'):
+                    return True
+    return False
+
+
+def get_terminal_oxygens(atom):
+    # Oxygens bonded to nothing else. Hydrogens are removed before typing, as in the SDF files obabel converts, so
+    # the oxygens of carboxylic acids are terminal like those of carboxylates
+    return [neighbour for neighbour in atom.GetNeighbors() if neighbour.GetSymbol() == 'O' and
+            neighbour.GetDegree() == 1]
+
+
+def get_sybyl_type(atom):
+    """ Sybyl type of an RDKit atom, close to the types obabel writes in mol2 files so ligands typed here get the
+    same NRGRank atom types as ligands converted by obabel"""
+    symbol = atom.GetSymbol()
+    hybridization = atom.GetHybridization()
+    has_double_bond = any(bond.GetBondType() == Chem.BondType.DOUBLE for bond in atom.GetBonds())
+    if symbol == 'C':
+        if atom.GetIsAromatic():
+            return 'C.ar'
+        if hybridization == Chem.HybridizationType.SP:
+            return 'C.1'
+        if hybridization == Chem.HybridizationType.SP2:
+            nitrogens = [neighbour for neighbour in atom.GetNeighbors()
+                         if neighbour.GetSymbol() == 'N' and not neighbour.GetIsAromatic()]
+            # Central carbon of amidinium and guanidinium groups
+            if len(nitrogens) >= 2 and any(nitrogen.GetFormalCharge() > 0 for nitrogen in nitrogens):
+                return 'C.cat'
+            return 'C.2'
+        return 'C.3'
+    if symbol == 'N':
+        if atom.GetIsAromatic():
+            return 'N.ar'
+        # Nitro nitrogens are trigonal planar
+        if len(get_terminal_oxygens(atom)) >= 2:
+            return 'N.pl3'
+        if hybridization == Chem.HybridizationType.SP:
+            return 'N.1'
+        if atom.GetFormalCharge() > 0 and hybridization == Chem.HybridizationType.SP3:
+            return 'N.4'
+        if not has_double_bond and is_amide_nitrogen(atom):
+            return 'N.am'
+        if hybridization == Chem.HybridizationType.SP2:
+            return 'N.2' if has_double_bond else 'N.pl3'
+        return 'N.3'
+    if symbol == 'O':
+        neighbours = atom.GetNeighbors()
+        if atom.GetDegree() == 1 and len(get_terminal_oxygens(neighbours[0])) >= 2:
+            # Oxygens of carboxylic acids, carboxylates and phosphates share the charge, like obabel types them
+            if neighbours[0].GetSymbol() in ('C', 'P'):
+                return 'O.co2'
+            # Both oxygens of a nitro group are O.2
+            if neighbours[0].GetSymbol() == 'N':
+                return 'O.2'
+        return 'O.2' if has_double_bond else 'O.3'
+    if symbol == 'S':
+        double_bonded_oxygens = sum(1 for bond in atom.GetBonds() if bond.GetBondType() == Chem.BondType.DOUBLE and
+                                    bond.GetOtherAtom(atom).GetSymbol() == 'O')
+        if double_bonded_oxygens == 1:
+            return 'S.O'
+        if double_bonded_oxygens >= 2:
+            return 'S.O2'
+        return 'S.2' if has_double_bond else 'S.3'
+    if symbol == 'P':
+        return 'P.3'
+    return symbol
+
+
+def iter_conformer_arrays(mol, molecule_name):
+    """ Yields (conformer name, atom xyz, atom types, atom names) of every conformer of a molecule without hydrogens,
+    the same values process_ligands reads from a mol2 file"""
+    rad_dict = load_rad_dict()
+    atoms_type, atom_name_list = [], []
+    atoms_name_count = {}
+    for atom in mol.GetAtoms():
+        sybyl_type = get_sybyl_type(atom)
+        atoms_type.append(get_radius_number(sybyl_type, rad_dict)[0])
+        atm_name = sybyl_type.split(".")[0]
+        atoms_name_count[atm_name] = atoms_name_count.get(atm_name, 0) + 1
+        atom_name_list.append(f"{atm_name}{atoms_name_count[atm_name]}")
+    for conformer_number, conformer in enumerate(mol.GetConformers()):
+        yield f"{molecule_name}_{conformer_number}", conformer.GetPositions(), atoms_type, atom_name_list
+
+
+def iter_prepared_molecules(molecules, optimize):
+    """ Yields the molecules with conformers, MMFF optimized if optimize, without their hydrogens"""
+    for mol in molecules:
+        if mol is None or mol.GetNumConformers() == 0:
+            continue
+        if optimize:
+            rdForceFieldHelpers.MMFFOptimizeMoleculeConfs(mol, numThreads=1)
+        yield Chem.RemoveHs(mol)
+
+
+def generate_conformer_chunk(chunk_index, molecule_smiles_list, molecule_name_list, output_folder_path,
+                             conformers_per_molecule, optimize, convert, molecular_weight_max, heavy_atoms_min,
+                             direct_preprocess=False):
+    """ Runs in a worker process. Embeds, optimizes and writes the conformers of one chunk of molecules to its own
+    shard so only the shard path goes back to the main process. With direct_preprocess nothing is written and the
+    (conformer name, atom xyz, atom types, atom names) of the conformers are returned instead, so the main process
+    can group the chunks in shards of the requested size.
+    Returns (chunk_index, shard path or conformers, number of molecules)"""
+    molecules = iter_prepared_molecules(
+        (generate_conformers(molecule_smile, molecule_name, conformers_per_molecule, molecular_weight_max,
+                             heavy_atoms_min) for molecule_smile, molecule_name in zip(molecule_smiles_list,
+                                                                                       molecule_name_list)),
+        optimize)
+    if direct_preprocess:
+        conformers = []
+        n_molecules = 0
+        for mol in molecules:
+            conformers.extend(iter_conformer_arrays(mol, mol.GetProp("_Name")))
+            n_molecules += 1
+        return chunk_index, conformers, n_molecules
+    shard_path = os.path.join(output_folder_path, f"chunk_{chunk_index:08d}.sdf")
+    n_written = 0
+    writer = AllChem.SDWriter(shard_path)
+    for mol in molecules:
+        for conformer in mol.GetConformers():
+            writer.write(mol, conformer.GetId())
+        n_written += 1
+    writer.close()
+    if convert:
+        mol2_shard_path = os.path.splitext(shard_path)[0] + '.mol2'
+        convert_to_mol2(shard_path, mol2_shard_path)
+        shard_path = mol2_shard_path
+    return chunk_index, shard_path, n_written
+
+
+def iter_chunk_outputs(chunks, n_processes, max_chunks_in_flight, *chunk_args):
+    """ Runs generate_conformer_chunk on (smiles, names) chunks in n_processes worker processes with at most
+    max_chunks_in_flight chunks read and queued at once. Yields (chunk output, number of molecules) in input order
+    as the chunks complete"""
+    completed_chunks = {}
+    next_chunk_to_yield = 0
+    chunks = enumerate(chunks)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_processes) as executor:
+        in_flight = set()
+        chunks_left = True
+        while chunks_left or in_flight:
+            while chunks_left and len(in_flight) < max_chunks_in_flight:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    chunks_left = False
+                    break
+                chunk_index, (molecule_smiles_list, molecule_name_list) = chunk
+                in_flight.add(executor.submit(generate_conformer_chunk, chunk_index, molecule_smiles_list,
+                                              molecule_name_list, *chunk_args))
+            if not in_flight:
+                break
+            done, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                chunk_index, chunk_output, chunk_written = future.result()
+                completed_chunks[chunk_index] = (chunk_output, chunk_written)
+            while next_chunk_to_yield in completed_chunks:
+                yield completed_chunks.pop(next_chunk_to_yield)
+                next_chunk_to_yield += 1
+
+
+def generate_conformers_process_pool(smiles_path_or_dict, output_path, smiles_column_number, name_column_number,
+                                     conformers_per_molecule, optimize, convert, molecular_weight_max,
+                                     heavy_atoms_min, n_processes, chunk_size, max_chunks_in_flight=None,
+                                     preprocessed_ligand_type=None, shard_size=100000):
+    """ Generates conformers in n_processes worker processes, chunk_size molecules at a time. At most
+    max_chunks_in_flight chunks (2 per process by default) are read and queued at once, so memory does not grow with
+    the size of the input. The shards are appended to the output_path file in input order as they complete. With
+    preprocessed_ligand_type, output_path is a preprocessed ligand folder. The conformers of the chunks are written
+    to it in input order in shards of shard_size molecules, whatever chunk_size is.
+    Returns the number of molecules written"""
+    if chunk_size <= 0:
+        raise ValueError(f"chunk_size must be positive, got {chunk_size}")
+    if max_chunks_in_flight is None:
+        max_chunks_in_flight = 2 * n_processes
+    chunks = iter_smiles_chunks(smiles_path_or_dict, smiles_column_number, name_column_number, chunk_size)
+    if preprocessed_ligand_type is not None:
+        remove_ligand_shards(output_path, preprocessed_ligand_type)
+        chunk_outputs = iter_chunk_outputs(chunks, n_processes, max_chunks_in_flight, None, conformers_per_molecule,
+                                           optimize, False, molecular_weight_max, heavy_atoms_min, True)
+        conformers = (conformer for chunk_conformers, _ in chunk_outputs for conformer in chunk_conformers)
+        shard_results = [write_ligand_shards(conformers, output_path, preprocessed_ligand_type, shard_size)]
+        write_ligand_manifest(output_path, preprocessed_ligand_type, shard_results)
+        return shard_results[0][1]
+
+    shard_folder_path = os.path.splitext(output_path)[0] + '_shards'
+    os.makedirs(shard_folder_path, exist_ok=True)
+    n_written = 0
+    with open(output_path, 'wb') as output_file:
+        for shard_path, chunk_written in iter_chunk_outputs(chunks, n_processes, max_chunks_in_flight,
+                                                            shard_folder_path, conformers_per_molecule, optimize,
+                                                            convert, molecular_weight_max, heavy_atoms_min):
+            with open(shard_path, 'rb') as shard_file:
+                shutil.copyfileobj(shard_file, output_file)
+            os.remove(shard_path)
+            n_written += chunk_written
+    shutil.rmtree(shard_folder_path)
+    return n_written
+
+
 def read_args():
     parser = argparse.ArgumentParser(description="Process and convert chemical data.")
 
@@ -150,11 +389,31 @@ def read_args():
         default=0,
         help="Minimum number of heavy atoms. Defaults to 0 which will not filter for this setting",
     )
+    parser.add_argument(
+        "-np",
+        "--processes",
+        type=int,
+        default=None,
+        help="Number of worker processes. Defaults to None which uses threads in a single process",
+    )
+    parser.add_argument(
+        "-cs",
+        "--chunk_size",
+        type=int,
+        default=1000,
+        help="Number of molecules per work unit with worker processes. Defaults to 1000",
+    )
+    parser.add_argument(
+        "-d",
+        "--direct_preprocess",
+        action="store_true",
+        help="Write the preprocessed ligands directly from RDKit, without SDF, obabel or mol2 files. Defaults to False",
+    )
 
     args = parser.parse_args()
 
     main(
-        smiles_path_or_list=args.smiles_path,
+        smiles_path_or_dict=args.smiles_path,
         smiles_column_number=args.smiles_column_number,
         name_column_number=args.name_column_number,
         output_folder_path=args.output_folder_path,
@@ -162,22 +421,23 @@ def read_args():
         convert=args.convert,
         preprocess=args.preprocess,
         molecular_weight_max=args.molecular_weight_max,
-        heavy_atoms_min=args.heavy_atoms_min
+        heavy_atoms_min=args.heavy_atoms_min,
+        n_processes=args.processes,
+        chunk_size=args.chunk_size,
+        direct_preprocess=args.direct_preprocess
     )
 
 
 def main(smiles_path_or_dict, output_folder_path, smiles_column_number=None, name_column_number=None,
          conformers_per_molecule=1, optimize=False, convert=True, preprocess=False, molecular_weight_max=None,
-         heavy_atoms_min=None):
+         heavy_atoms_min=None, n_processes=None, chunk_size=1000, direct_preprocess=False, ligand_type='ligand',
+         shard_size=100000):
+    """ With n_processes, conformers are generated and optimized in that many worker processes, chunk_size molecules
+    at a time, instead of in threads of this process.
+    With direct_preprocess, the atoms of the RDKit conformers are typed here and written as preprocessed ligands, the
+    same folder process_ligands makes from a mol2 file, so no SDF or mol2 file is written and obabel is not needed.
+    Returns the path of the mol2 or sdf file, or of the preprocessed ligand folder"""
     require_rdkit()
-    if isinstance(smiles_path_or_dict, dict):
-        molecule_smiles_list = list(smiles_path_or_dict['Smiles'])
-        molecule_name_list = list(smiles_path_or_dict['Name'])
-    else:
-        delimiter = get_delimiter(smiles_path_or_dict, bytes_to_read=4096)
-        molecule_smiles_list = read_column_from_csv(smiles_path_or_dict, smiles_column_number, delimiter, has_header=True)
-        molecule_name_list = read_column_from_csv(smiles_path_or_dict, name_column_number, delimiter, has_header=True)
-
     if conformers_per_molecule <= 0:
         exit("Number of conformers must be greater than 0.")
 
@@ -192,6 +452,52 @@ def main(smiles_path_or_dict, output_folder_path, smiles_column_number=None, nam
     sdf_output_file += '.sdf'
     mol2_output_file = os.path.splitext(sdf_output_file)[0] + '.mol2'
 
+    if direct_preprocess:
+        preprocessed_folder_path = os.path.join(output_folder_path,
+                                                f"preprocessed_ligands{get_suffix(conformers_per_molecule)}")
+        os.makedirs(preprocessed_folder_path, exist_ok=True)
+        if n_processes:
+            n_written = generate_conformers_process_pool(smiles_path_or_dict, preprocessed_folder_path,
+                                                         smiles_column_number, name_column_number,
+                                                         conformers_per_molecule, optimize, False,
+                                                         molecular_weight_max, heavy_atoms_min, n_processes,
+                                                         chunk_size, preprocessed_ligand_type=ligand_type,
+                                                         shard_size=shard_size)
+        else:
+            chunks = iter_smiles_chunks(smiles_path_or_dict, smiles_column_number, name_column_number, chunk_size)
+            remove_ligand_shards(preprocessed_folder_path, ligand_type)
+            with concurrent.futures.ThreadPoolExecutor() as executor:
+                molecules = iter_prepared_molecules(
+                    (mol for molecule_smiles_list, molecule_name_list in chunks
+                     for mol in executor.map(generate_conformers, molecule_smiles_list, molecule_name_list,
+                                             repeat(conformers_per_molecule), repeat(molecular_weight_max),
+                                             repeat(heavy_atoms_min))), optimize)
+                conformers = (conformer for mol in molecules
+                              for conformer in iter_conformer_arrays(mol, mol.GetProp("_Name")))
+                shard_results = [write_ligand_shards(conformers, preprocessed_folder_path, ligand_type, shard_size)]
+            write_ligand_manifest(preprocessed_folder_path, ligand_type, shard_results)
+            n_written = shard_results[0][1]
+        print(f"Finished preprocessing conformers for {n_written} molecules @ ", datetime.now())
+        return preprocessed_folder_path
+
+    if n_processes:
+        output_file = mol2_output_file if convert else sdf_output_file
+        n_written = generate_conformers_process_pool(smiles_path_or_dict, output_file, smiles_column_number,
+                                                     name_column_number, conformers_per_molecule, optimize, convert,
+                                                     molecular_weight_max, heavy_atoms_min, n_processes, chunk_size)
+        print(f"Finished generating conformers for {n_written} molecules @ ", datetime.now())
+        if preprocess:
+            return process_ligands(ligand_path=mol2_output_file, conformers_per_molecule=conformers_per_molecule)
+        return output_file
+
+    if isinstance(smiles_path_or_dict, dict):
+        molecule_smiles_list = list(smiles_path_or_dict['Smiles'])
+        molecule_name_list = list(smiles_path_or_dict['Name'])
+    else:
+        delimiter = get_delimiter(smiles_path_or_dict, bytes_to_read=4096)
+        molecule_smiles_list = read_column_from_csv(smiles_path_or_dict, smiles_column_number, delimiter, has_header=True)
+        molecule_name_list = read_column_from_csv(smiles_path_or_dict, name_column_number, delimiter, has_header=True)
+
     writer = AllChem.SDWriter(sdf_output_file)
 
     with concurrent.futures.ThreadPoolExecutor() as executor:
@@ -214,7 +520,8 @@ def main(smiles_path_or_dict, output_folder_path, smiles_column_number=None, nam
         os.remove(sdf_output_file)
 
     if preprocess:
-        process_ligands(ligand_path=mol2_output_file)
+        return process_ligands(ligand_path=mol2_output_file, conformers_per_molecule=conformers_per_molecule)
+    return mol2_output_file if convert else sdf_output_file
 
 
 if __name__ == '__main__':
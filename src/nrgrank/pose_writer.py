@@ -0,0 +1,248 @@
+import os
+import json
+import argparse
+import numpy as np
+from nrgrank.general_functions import write_pdb
+
+
+pose_index_dtype = np.dtype([('molecule_index', np.int64), ('pose_number', np.int32), ('cf', np.float32),
+                             ('atom_start', np.int64), ('atom_count', np.int32), ('name_start', np.int64),
+                             ('name_length', np.int32)])
+archive_file_names = {'index': 'pose_index.bin', 'xyz': 'pose_xyz.bin', 'type': 'pose_atom_type.bin',
+                      'name': 'pose_name.bin'}
+pdb_atom_line = "HETATM{:>5d} {:<4} LIG L   1    {:>8.3f}{:>8.3f}{:>8.3f}  1.00  0.10\n"
+
+
+def get_pose_file_name(molecule_name, conf_num, unique_run_id, poses_saved_per_molecule, pose_number):
+    pose_file_name = molecule_name
+    if conf_num == 1:
+        if pose_file_name.endswith('0'):
+            pose_file_name = pose_file_name.rsplit('_', 1)[0]
+    pose_file_name += f'_{unique_run_id}'
+    if poses_saved_per_molecule != 1:
+        pose_file_name += f'_pose_{pose_number+1}'
+    return pose_file_name
+
+
+def format_pdb_atoms(pose_xyz, atom_names):
+    """ Formats all the atoms of a pose with a single string operation"""
+    values = np.empty((len(pose_xyz), 5), dtype=object)
+    values[:, 0] = np.arange(len(pose_xyz))
+    values[:, 1] = atom_names
+    values[:, 2:] = pose_xyz.astype(np.float64)
+    return (pdb_atom_line * len(pose_xyz)).format(*values.ravel())
+
+
+def format_pdb_model(model_number, molecule_index, pose_name, cf, atom_types, pose_xyz, atom_names):
+    return (f"MODEL {model_number:>8d}\n"
+            f"REMARK name: {pose_name}\n"
+            f"REMARK molecule index: {molecule_index}\n"
+            f"REMARK CF: {cf:.2f}\n"
+            f"REMARK atom types: {' '.join(map(str, atom_types))}\n"
+            + format_pdb_atoms(pose_xyz, atom_names) + "ENDMDL\n")
+
+
+class PoseWriter:
+    """ Writes every pose of a run in one file instead of one pdb file per pose.
+    'multi_pdb' writes a multi model pdb file. 'archive' writes a folder of flat binary files: the coordinates and atom
+    types of all poses one after the other, their names, and an index with the offsets of every pose.
+    Poses are appended as they are written, so with resume_from the poses of molecules from resume_from on are dropped
+    and the run continues the file"""
+    def __init__(self, output_path, pose_output_format, resume_from=None):
+        if pose_output_format not in ('multi_pdb', 'archive'):
+            raise ValueError(f"Unknown pose output format: {pose_output_format}. Expected 'multi_pdb' or 'archive'")
+        self.output_path = output_path
+        self.pose_output_format = pose_output_format
+        output_folder = os.path.dirname(output_path)
+        if output_folder and not os.path.isdir(output_folder):
+            os.makedirs(output_folder)
+        if pose_output_format == 'multi_pdb':
+            self.n_poses = truncate_multi_pdb(output_path, resume_from)
+            self.files = {'pdb': open(output_path, 'ab')}
+        else:
+            if not os.path.isdir(output_path):
+                os.makedirs(output_path)
+            self.n_poses = len(truncate_archive(output_path, resume_from))
+            self.files = {key: open(os.path.join(output_path, file_name), 'ab')
+                          for key, file_name in archive_file_names.items()}
+            with open(os.path.join(output_path, 'pose_archive.json'), 'w') as f:
+                json.dump({'index_dtype': pose_index_dtype.descr, 'xyz_dtype': 'float32', 'type_dtype': 'int32',
+                           'files': archive_file_names}, f, indent=1)
+
+    def write(self, molecule_index, pose_names, pose_cfs, molecule_atom_types, poses_xyz, molecule_atoms_names):
+        """ Writes the poses of one molecule. poses_xyz has one row of atom coordinates per pose"""
+        if self.pose_output_format == 'multi_pdb':
+            models = [format_pdb_model(self.n_poses + pose_number + 1, molecule_index, pose_name, pose_cf,
+                                       molecule_atom_types, pose_xyz, molecule_atoms_names)
+                      for pose_number, (pose_name, pose_cf, pose_xyz) in enumerate(zip(pose_names, pose_cfs,
+                                                                                        poses_xyz))]
+            self.files['pdb'].write("".join(models).encode())
+        else:
+            n_atoms = len(molecule_atom_types)
+            atom_names = " ".join(molecule_atoms_names)
+            encoded_names = [f"{pose_name}\t{atom_names}\n".encode() for pose_name in pose_names]
+            records = np.zeros(len(pose_names), dtype=pose_index_dtype)
+            records['molecule_index'] = molecule_index
+            records['pose_number'] = np.arange(len(pose_names))
+            records['cf'] = pose_cfs
+            records['atom_start'] = self.files['xyz'].tell() // 12 + np.arange(len(pose_names)) * n_atoms
+            records['atom_count'] = n_atoms
+            records['name_length'] = [len(name) for name in encoded_names]
+            records['name_start'] = self.files['name'].tell() + np.cumsum(records['name_length']) - \
+                records['name_length']
+            self.files['xyz'].write(np.ascontiguousarray(poses_xyz, dtype=np.float32).tobytes())
+            self.files['type'].write(np.tile(np.asarray(molecule_atom_types, dtype=np.int32),
+                                             len(pose_names)).tobytes())
+            self.files['name'].write(b"".join(encoded_names))
+            # The index is written last so a pose is only listed once all its data is written
+            self.files['index'].write(records.tobytes())
+        self.n_poses += len(pose_names)
+
+    def flush(self):
+        for file in self.files.values():
+            file.flush()
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+
+
+def truncate_multi_pdb(pdb_path, resume_from):
+    """ Keeps the complete models of molecules before resume_from and returns their number"""
+    if resume_from is None or not os.path.isfile(pdb_path):
+        open(pdb_path, 'wb').close()
+        return 0
+    n_models = 0
+    keep_bytes = 0
+    model_molecule_index = None
+    position = 0
+    with open(pdb_path, 'rb') as f:
+        for line in f:
+            if line.startswith(b'REMARK molecule index:'):
+                model_molecule_index = int(line.split(b':')[1])
+            elif line.startswith(b'ENDMDL'):
+                if model_molecule_index >= resume_from:
+                    break
+                n_models += 1
+                keep_bytes = position + len(line)
+            position += len(line)
+    with open(pdb_path, 'r+b') as f:
+        f.truncate(keep_bytes)
+    return n_models
+
+
+def truncate_archive(archive_path, resume_from):
+    """ Keeps the poses of molecules before resume_from and drops any data written after the last complete index
+    record"""
+    index_path = os.path.join(archive_path, archive_file_names['index'])
+    if resume_from is None or not os.path.isfile(index_path):
+        for file_name in archive_file_names.values():
+            open(os.path.join(archive_path, file_name), 'wb').close()
+        return np.zeros(0, dtype=pose_index_dtype)
+    index = load_pose_index(archive_path)
+    index = index[:np.searchsorted(index['molecule_index'], resume_from)]
+    if len(index):
+        atom_end = int(index['atom_start'][-1] + index['atom_count'][-1])
+        name_end = int(index['name_start'][-1] + index['name_length'][-1])
+    else:
+        atom_end = name_end = 0
+    for key, size in (('index', len(index) * pose_index_dtype.itemsize), ('xyz', atom_end * 12),
+                      ('type', atom_end * 4), ('name', name_end)):
+        with open(os.path.join(archive_path, archive_file_names[key]), 'r+b') as f:
+            f.truncate(size)
+    return index
+
+
+def load_pose_index(archive_path):
+    index_path = os.path.join(archive_path, archive_file_names['index'])
+    if not os.path.isfile(index_path):
+        raise FileNotFoundError(f"{archive_path} is not a pose archive")
+    n_records = os.path.getsize(index_path) // pose_index_dtype.itemsize
+    return np.fromfile(index_path, dtype=pose_index_dtype, count=n_records)
+
+
+def read_archive_poses(archive_path, pose_indices=None):
+    """ Yields (pose name, cf, atom types, atom xyz, atom names) of the poses of an archive. The coordinates are read
+    from a memory map so only the requested poses are loaded"""
+    index = load_pose_index(archive_path)
+    if pose_indices is None:
+        pose_indices = range(len(index))
+    n_atoms = int(index['atom_start'][-1] + index['atom_count'][-1]) if len(index) else 0
+    if n_atoms == 0:
+        return
+    atom_xyz = np.memmap(os.path.join(archive_path, archive_file_names['xyz']), dtype=np.float32, mode='r',
+                         shape=(n_atoms, 3))
+    atom_type = np.memmap(os.path.join(archive_path, archive_file_names['type']), dtype=np.int32, mode='r',
+                          shape=(n_atoms,))
+    with open(os.path.join(archive_path, archive_file_names['name']), 'rb') as name_file:
+        for pose_index in pose_indices:
+            record = index[pose_index]
+            name_file.seek(record['name_start'])
+            pose_name, atom_names = name_file.read(record['name_length']).decode().rstrip('\n').split('\t')
+            atom_slice = slice(record['atom_start'], record['atom_start'] + record['atom_count'])
+            yield pose_name, float(record['cf']), np.array(atom_type[atom_slice]), np.array(atom_xyz[atom_slice]), \
+                atom_names.split(' ')
+
+
+def read_multi_pdb_poses(pdb_path):
+    """ Yields (pose name, cf, atom types, atom xyz, atom names) of the models of a multi model pdb file"""
+    with open(pdb_path) as f:
+        for line in f:
+            if line.startswith('MODEL'):
+                pose_name, cf, atom_types, atom_xyz, atom_names = None, None, [], [], []
+            elif line.startswith('REMARK name:'):
+                pose_name = line.split(':', 1)[1].strip()
+            elif line.startswith('REMARK CF:'):
+                cf = float(line.split(':', 1)[1])
+            elif line.startswith('REMARK atom types:'):
+                atom_types = [int(atom_type) for atom_type in line.split(':', 1)[1].split()]
+            elif line.startswith('HETATM'):
+                atom_names.append(line[12:16].strip())
+                atom_xyz.append([float(line[30:38]), float(line[38:46]), float(line[46:54])])
+            elif line.startswith('ENDMDL'):
+                yield pose_name, cf, np.array(atom_types, dtype=np.int32), \
+                    np.array(atom_xyz, dtype=np.float32).reshape((-1, 3)), atom_names
+
+
+def read_poses(pose_output_path):
+    if os.path.isdir(pose_output_path):
+        return read_archive_poses(pose_output_path)
+    if os.path.isfile(pose_output_path):
+        return read_multi_pdb_poses(pose_output_path)
+    raise FileNotFoundError(f"{pose_output_path} does not exist")
+
+
+def extract_poses(pose_output_path, output_folder, pose_names=None):
+    """ Writes poses of a multi model pdb file or a pose archive as one pdb file per pose, the same files as the 'pdb'
+    pose output format. Only the poses in pose_names are written when it is given.
+    Returns the number of poses written"""
+    if pose_names is not None:
+        pose_names = set(pose_names)
+    if not os.path.isdir(output_folder):
+        os.makedirs(output_folder)
+    n_written = 0
+    for pose_name, cf, atom_types, atom_xyz, atom_names in read_poses(pose_output_path):
+        if pose_names is not None and pose_name not in pose_names:
+            continue
+        extra_info = [f"REMARK CF: {cf:.2f}\n",
+                      f"REMARK atom types: {' '.join(map(str, atom_types))}\n"]
+        write_pdb(atom_xyz, pose_name, output_folder, atom_names, extra_info)
+        n_written += 1
+    return n_written
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Extract poses from a multi model pdb file or a pose archive')
+    parser.add_argument('-i', '--pose_output_path', type=str, required=True,
+                        help='Path to the multi model pdb file or the pose archive folder')
+    parser.add_argument('-o', '--output_folder', type=str, required=True, help='Folder for the extracted pdb files')
+    parser.add_argument('-n', '--pose_names', type=str, default=None,
+                        help='Names of the poses to extract. If multiple: separate with comma no space')
+    args = parser.parse_args()
+    pose_names = args.pose_names.split(',') if args.pose_names else None
+    n_written = extract_poses(args.pose_output_path, args.output_folder, pose_names)
+    print(f'Extracted {n_written} poses to {args.output_folder}')
+
+
+if __name__ == '__main__':
+    get_args()
@@ -0,0 +1,106 @@
+import os
+import json
+import shutil
+import hashlib
+
+# Changing how an artifact is computed must change this so entries made by older versions are not reused
+cache_format_version = 2
+last_used_file_name = 'last_used'
+
+
+def get_file_digest(file_path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_cache_key(kind, params):
+    """ Key of an artifact of kind made with params. params holds the digests of the input files so two keys are only
+    equal if the inputs have the same content and every parameter has the same value"""
+    digest = hashlib.sha256()
+    digest.update(json.dumps({'kind': kind, 'version': cache_format_version, 'params': params}, sort_keys=True,
+                             default=str).encode())
+    return digest.hexdigest()
+
+
+def get_entry_path(cache_folder, kind, key):
+    return os.path.join(cache_folder, kind, key)
+
+
+def restore_from_cache(cache_folder, kind, key, output_folder):
+    """ Copies the files of a cache entry to output_folder. Returns False if there is no entry for key"""
+    entry_path = get_entry_path(cache_folder, kind, key)
+    if not os.path.isdir(entry_path):
+        return False
+    os.makedirs(output_folder, exist_ok=True)
+    for file_name in os.listdir(entry_path):
+        if file_name != last_used_file_name:
+            shutil.copyfile(os.path.join(entry_path, file_name), os.path.join(output_folder, file_name))
+    touch_entry(entry_path)
+    return True
+
+
+def store_in_cache(cache_folder, kind, key, source_folder, file_names, max_bytes=None):
+    """ Copies file_names of source_folder to a cache entry, then evicts the least recently used entries until the
+    cache holds at most max_bytes. The entry is written under a temporary name and renamed once complete so a
+    concurrent run never reads a partial entry"""
+    entry_path = get_entry_path(cache_folder, kind, key)
+    if not os.path.isdir(entry_path):
+        temporary_path = f"{entry_path}.tmp-{os.getpid()}"
+        shutil.rmtree(temporary_path, ignore_errors=True)
+        os.makedirs(temporary_path)
+        for file_name in file_names:
+            shutil.copyfile(os.path.join(source_folder, file_name), os.path.join(temporary_path, file_name))
+        try:
+            os.rename(temporary_path, entry_path)
+        except OSError:
+            # Another run stored the same entry first
+            shutil.rmtree(temporary_path, ignore_errors=True)
+    touch_entry(entry_path)
+    if max_bytes is not None:
+        evict_cache(cache_folder, max_bytes, keep=entry_path)
+
+
+def touch_entry(entry_path):
+    with open(os.path.join(entry_path, last_used_file_name), 'w') as f:
+        f.write('')
+
+
+def get_folder_size(folder_path):
+    return sum(os.path.getsize(os.path.join(folder_path, file_name)) for file_name in os.listdir(folder_path))
+
+
+def list_cache_entries(cache_folder):
+    """ Returns (last used time, size in bytes, path) of every complete entry, least recently used first"""
+    entries = []
+    if not os.path.isdir(cache_folder):
+        return entries
+    for kind in os.listdir(cache_folder):
+        kind_path = os.path.join(cache_folder, kind)
+        if not os.path.isdir(kind_path):
+            continue
+        for key in os.listdir(kind_path):
+            entry_path = os.path.join(kind_path, key)
+            last_used_path = os.path.join(entry_path, last_used_file_name)
+            if '.tmp-' in key or not os.path.isfile(last_used_path):
+                continue
+            entries.append((os.path.getmtime(last_used_path), get_folder_size(entry_path), entry_path))
+    return sorted(entries)
+
+
+def evict_cache(cache_folder, max_bytes, keep=None):
+    """ Removes the least recently used entries until the cache holds at most max_bytes. Returns the removed paths"""
+    entries = list_cache_entries(cache_folder)
+    total_bytes = sum(size for _, size, _ in entries)
+    removed = []
+    for _, size, entry_path in entries:
+        if total_bytes <= max_bytes:
+            break
+        if entry_path == keep:
+            continue
+        shutil.rmtree(entry_path, ignore_errors=True)
+        total_bytes -= size
+        removed.append(entry_path)
+    return removed
@@ -1,107 +1,275 @@
 import os
+import json
 import numpy as np
-from nrgrank.general_functions import get_radius_number, load_rad_dict
+from concurrent.futures import ProcessPoolExecutor
+from nrgrank.general_functions import get_radius_number, load_rad_dict, save_string_table
+from nrgrank.preprocess_cache import get_file_digest, get_cache_key, restore_from_cache, store_in_cache
 import argparse
-import pickle
 import re
 
 
-def load_atoms_mol2(filename, save_path, ligand_type='ligand'):
-    coord_start = 0
-    max_atoms = 0
-    n_atoms = 0
-    n_molecules = 0
-    n_unique_molecules = 0
-    same_molec_counter = 1
-    molecule_name_list = []
+def get_molecule_boundaries(filename, n_chunks):
+    """ Splits a mol2 file in byte ranges that start on a @<TRIPOS>MOLECULE record. A range never starts in the middle
+    of a group of conformers so the name suffixes are the same as when the file is read in one piece"""
+    file_size = os.path.getsize(filename)
+    boundaries = [0]
+    with open(filename, 'rb') as f:
+        for chunk in range(1, n_chunks):
+            f.seek(max(file_size * chunk // n_chunks, boundaries[-1]))
+            if f.tell() > 0:
+                f.readline()
+            previous_name = None
+            boundary = None
+            while boundary is None:
+                line_start = f.tell()
+                line = f.readline()
+                if not line:
+                    break
+                if line.startswith(b'@<TRIPOS>MOLECULE'):
+                    molecule_name = f.readline().decode().rstrip('\r\n')
+                    if previous_name is not None and previous_name.split("_")[0] != molecule_name:
+                        boundary = line_start
+                    previous_name = molecule_name
+            if boundary is None:
+                break
+            if boundary > boundaries[-1]:
+                boundaries.append(boundary)
+    boundaries.append(file_size)
+    return boundaries
+
+
+def iter_mol2_molecules(filename, start_byte=0, end_byte=None):
+    """ Yields (molecule name, atom lines) for every molecule starting between start_byte and end_byte"""
+    molecule_name = None
+    atom_lines = []
+    in_atoms = False
+    read_name = False
+    position = start_byte
+    with open(filename, 'rb') as f:
+        f.seek(start_byte)
+        for line in f:
+            if line.startswith(b'@<TRIPOS>MOLECULE'):
+                if end_byte is not None and position >= end_byte:
+                    break
+                if molecule_name is not None:
+                    yield molecule_name, atom_lines
+                atom_lines = []
+                in_atoms = False
+                read_name = True
+            elif read_name:
+                molecule_name = line.decode().rstrip('\r\n')
+                if molecule_name == "":
+                    exit("Error when reading molecule name")
+                read_name = False
+            elif line.startswith(b'@'):
+                in_atoms = line.startswith(b'@<TRIPOS>ATOM')
+            elif in_atoms and line.strip():
+                atom_lines.append(line.decode())
+            position += len(line)
+    if molecule_name is not None:
+        yield molecule_name, atom_lines
+
+
+def iter_parsed_molecules(filename, start_byte=0, end_byte=None):
+    """ Yields (molecule name, atom xyz, atom types, atom names) of the heavy atoms of every molecule. Molecules that
+    follow a molecule with the same name are numbered as conformers"""
     rad_dict = load_rad_dict()
-    with open(filename) as f:
-        lines = f.readlines()
-
-    for counter, line in enumerate(lines):
-        if line.startswith('@<TRIPOS>MOLECULE'):
-            n_molecules += 1
-            molecule_name = lines[counter+1][0:-1]
-            if molecule_name != "\n":
-                molec_suffix = "_0"
-                if n_molecules > 1 and molecule_name_list[n_molecules-2].split("_")[0] == molecule_name:
-                    molec_suffix = f"_{same_molec_counter}"
-                    same_molec_counter += 1
+    same_molec_counter = 1
+    previous_name = None
+    for raw_name, atom_lines in iter_mol2_molecules(filename, start_byte, end_byte):
+        molec_suffix = "_0"
+        if previous_name is not None and previous_name.split("_")[0] == raw_name:
+            molec_suffix = f"_{same_molec_counter}"
+            same_molec_counter += 1
+        else:
+            same_molec_counter = 1
+        previous_name = raw_name + molec_suffix
+
+        atoms_xyz, atoms_type, atom_name_list = [], [], []
+        atoms_name_count = {}
+        for line in atom_lines:
+            line = line.split()
+            if line[5][0] != 'H':
+                atoms_xyz.append([float(line[2]), float(line[3]), float(line[4])])
+                atom_type = line[5]
+                atoms_type_temp, _ = get_radius_number(atom_type, rad_dict)
+                atoms_type.append(atoms_type_temp)
+                atm_name = atom_type.split(".")[0]
+                if atm_name in atoms_name_count:
+                    atoms_name_count[atm_name] += 1
                 else:
-                    same_molec_counter = 1
-                molecule_name_list.append(lines[counter+1][0:-1] + molec_suffix)
-                if molec_suffix == "_0":
-                    n_unique_molecules += 1
-            else:
-                exit("Error when reading molecule name")
-        elif line.startswith("@<TRIPOS>ATOM"):
-            coord_start = 1
-            if max_atoms < n_atoms:
-                max_atoms = n_atoms
-            n_atoms = 0
-        if coord_start == 1:
-            if line.startswith("@<TRIPOS>ATOM") is False:
-                if line[0] == "@":
-                    coord_start = 0
-                elif line.split()[1][0] != "H":
-                    n_atoms += 1
-    if max_atoms < n_atoms:
-        max_atoms = n_atoms
-
-    n_atom_array = np.zeros(n_molecules, dtype=np.int32)
-    atoms_xyz = np.full((n_molecules, max_atoms, 3), 9999, dtype=np.float32)
-    atoms_type = np.full((n_molecules, max_atoms), -1, dtype=np.int32)
-
-    molecule_counter = -1
-    atom_counter = 0
-    coord_start = 0
-    atom_name_list = []
-    temp_atom_name_list = []
-    atoms_name_count = {}
-    for counter, line in enumerate(lines):
-        if line.startswith('@<TRIPOS>MOLECULE'):
-            atoms_name_count = {}
-            molecule_counter += 1
-            if molecule_counter > 0:
-                n_atom_array[molecule_counter-1] = atom_counter
-                atom_counter = 0
-                coord_start = 0
-                atom_name_list.append(temp_atom_name_list)
-                temp_atom_name_list = []
-        if line.startswith('@<TRIPOS>ATOM') and line[0] != "\n":
-            coord_start = 1
-        if coord_start == 1 and line.startswith('@<TRIPOS>ATOM') is False:
-            if line[0] != '@':
-                line = line.split()
-                if line[5][0] != 'H':
-                    atoms_xyz[molecule_counter][atom_counter] = np.array([float(line[2]),
-                                                                          float(line[3]),
-                                                                          float(line[4])])
-                    atom_type = line[5]
-                    atoms_type_temp, _ = get_radius_number(atom_type, rad_dict)
-                    atoms_type[molecule_counter][atom_counter] = atoms_type_temp
-                    atm_name = atom_type.split(".")[0]
-                    if atm_name in atoms_name_count:
-                        atoms_name_count[atm_name] += 1
-                    else:
-                        atoms_name_count[atm_name] = 1
-                    temp_atom_name_list.append(f"{atm_name}{atoms_name_count[atm_name]}")
-                    atom_counter += 1
-            else:
-                coord_start = 0
-    n_atom_array[-1] = atom_counter
-    atom_name_list.append(temp_atom_name_list)
-    np.save(os.path.join(save_path, f"{ligand_type}_atom_xyz"), atoms_xyz)
-    np.save(os.path.join(save_path, f"{ligand_type}_atom_type"), atoms_type)
-    with open(os.path.join(save_path, f"{ligand_type}_molecule_name.pkl"), 'wb') as f:
-        pickle.dump(molecule_name_list, f)
-    with open(os.path.join(save_path, f"{ligand_type}_atom_name.pkl"), 'wb') as f:
-        pickle.dump(atom_name_list, f)
-    np.save(os.path.join(save_path, f"{ligand_type}_atoms_num_per_ligand"), n_atom_array)
+                    atoms_name_count[atm_name] = 1
+                atom_name_list.append(f"{atm_name}{atoms_name_count[atm_name]}")
+        yield previous_name, atoms_xyz, atoms_type, atom_name_list
+
+
+def read_mol2(filename):
+    """ Parses a whole mol2 file in memory in the same ragged layout as the preprocessed ligands.
+    Returns atom names per molecule, flat atom types, flat atom xyz, atom offsets and molecule names"""
+    molecule_name_list, atom_name_list, atoms_xyz, atoms_type = [], [], [], []
+    n_atom_list = []
+    for molecule_name, molecule_xyz, molecule_types, molecule_atom_names in iter_parsed_molecules(filename):
+        molecule_name_list.append(molecule_name)
+        atom_name_list.append(molecule_atom_names)
+        atoms_xyz.extend(molecule_xyz)
+        atoms_type.extend(molecule_types)
+        n_atom_list.append(len(molecule_types))
+    atom_offsets = np.zeros(len(n_atom_list) + 1, dtype=np.int64)
+    atom_offsets[1:] = np.cumsum(n_atom_list, dtype=np.int64)
+    return atom_name_list, np.array(atoms_type, dtype=np.int32), \
+        np.array(atoms_xyz, dtype=np.float32).reshape((-1, 3)), atom_offsets, molecule_name_list
+
+
+def load_atoms_mol2_range(filename, save_path, ligand_type, start_byte=0, end_byte=None, shard_size=100000,
+                          chunk_index=0, batch=0):
+    """ Parses one byte range of a mol2 file and writes a shard every shard_size molecules.
+    Returns the manifest entries of the written shards and the number of unique molecules"""
+    return write_ligand_shards(iter_parsed_molecules(filename, start_byte, end_byte), save_path, ligand_type,
+                               shard_size, chunk_index, batch)
+
+
+def get_shard_prefix(ligand_type, chunk_index, shard_index, batch=0):
+    # Shards appended to a library are named by batch so they never replace the shards of an earlier batch
+    if batch == 0:
+        return f"{ligand_type}_shard_{chunk_index:04d}_{shard_index:04d}"
+    return f"{ligand_type}_shard_b{batch:04d}_{chunk_index:04d}_{shard_index:04d}"
+
+
+def write_ligand_shards(molecules, save_path, ligand_type, shard_size=100000, chunk_index=0, batch=0):
+    """ Writes (molecule name, atom xyz, atom types, atom names) molecules to a shard every shard_size molecules.
+    Conformers are named {molecule name}_{conformer number}, counting from 0.
+    Returns the manifest entries of the written shards and the number of unique molecules"""
+    shards = []
+    n_unique_molecules = 0
+    molecule_name_list, atom_name_list, atoms_xyz, atoms_type, n_atom_list = [], [], [], [], []
+
+    def write_shard():
+        prefix = get_shard_prefix(ligand_type, chunk_index, len(shards), batch)
+        save_ligand_arrays(save_path, prefix, np.array(atoms_xyz, dtype=np.float32).reshape((-1, 3)),
+                           np.array(atoms_type, dtype=np.int32), np.array(n_atom_list, dtype=np.int32),
+                           molecule_name_list, atom_name_list)
+        shards.append({"prefix": prefix, "molecule_count": len(n_atom_list), "atom_count": len(atoms_type),
+                       "batch": batch})
+
+    for molecule_name, molecule_xyz, molecule_types, molecule_atom_names in molecules:
+        if molecule_name.endswith("_0"):
+            n_unique_molecules += 1
+        molecule_name_list.append(molecule_name)
+        atoms_xyz.extend(molecule_xyz)
+        atoms_type.extend(molecule_types)
+        atom_name_list.extend(molecule_atom_names)
+        n_atom_list.append(len(molecule_types))
+
+        if len(n_atom_list) == shard_size:
+            write_shard()
+            molecule_name_list, atom_name_list, atoms_xyz, atoms_type, n_atom_list = [], [], [], [], []
+    if n_atom_list:
+        write_shard()
+    return shards, n_unique_molecules
+
+
+def load_atoms_mol2(filename, save_path, ligand_type='ligand', shard_size=100000, processes=1, source_digest=None,
+                    append=False):
+    """ Streams a mol2 file into shards of at most shard_size molecules. With processes > 1 the file is split in byte
+    ranges that are parsed in parallel. The shards are listed in order in {ligand_type}_manifest.json.
+    With append, the shards already in save_path are kept and the new shards are added to the manifest as a new batch.
+    Returns the batch number of the new shards"""
+    previous_manifest = read_ligand_manifest(save_path, ligand_type) if append else None
+    if previous_manifest is None:
+        remove_ligand_shards(save_path, ligand_type)
+        batch = 0
+    else:
+        batch = max(batch_entry["batch"] for batch_entry in previous_manifest["batches"]) + 1
+    if processes > 1:
+        boundaries = get_molecule_boundaries(filename, processes * 4)
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(load_atoms_mol2_range, filename, save_path, ligand_type, boundaries[i],
+                                       boundaries[i+1], shard_size, i, batch) for i in range(len(boundaries) - 1)]
+            results = [future.result() for future in futures]
+    else:
+        results = [load_atoms_mol2_range(filename, save_path, ligand_type, shard_size=shard_size, batch=batch)]
+    write_ligand_manifest(save_path, ligand_type, results, source_digest, batch, previous_manifest)
+    return batch
+
+
+def remove_ligand_shards(save_path, ligand_type):
+    for file in os.listdir(save_path):
+        if file.startswith(f"{ligand_type}_shard_"):
+            os.remove(os.path.join(save_path, file))
+
+
+def write_ligand_manifest(save_path, ligand_type, results, source_digest=None, batch=0, previous_manifest=None):
+    """ Lists the shards of results, (manifest entries, number of unique molecules) per chunk, in order.
+    source_digest is the sha256 of the file the ligands were read from. With previous_manifest, the shards of results
+    are listed after its shards as batch and the counts cover every batch"""
+    new_shards = [shard for chunk_shards, _ in results for shard in chunk_shards]
+    batch_entry = {"batch": batch, "source_sha256": source_digest,
+                   "molecule_count": sum(shard["molecule_count"] for shard in new_shards),
+                   "unique_molecule_count": sum(n_unique for _, n_unique in results)}
+    if previous_manifest is None:
+        shards, batches = new_shards, [batch_entry]
+    else:
+        shards, batches = previous_manifest["shards"] + new_shards, previous_manifest["batches"] + [batch_entry]
+    n_unique_molecules = sum(batch_entry["unique_molecule_count"] for batch_entry in batches)
+    manifest = {"shards": shards,
+                "molecule_count": sum(shard["molecule_count"] for shard in shards),
+                "unique_molecule_count": n_unique_molecules,
+                "batches": batches}
+    # The library is identified by the file of its first batch, appended files are listed in batches
+    if batches[0]["source_sha256"] is not None:
+        manifest["source_sha256"] = batches[0]["source_sha256"]
+    with open(os.path.join(save_path, f"{ligand_type}_manifest.json"), 'w') as f:
+        json.dump(manifest, f, indent=1)
     if ligand_type != 'ligand':
         np.save(os.path.join(save_path, f"{ligand_type}_ligand_count"), np.array([n_unique_molecules]))
 
 
+def save_ligand_arrays(save_path, ligand_type, atoms_xyz, atoms_type, n_atom_array, molecule_name_list, atom_name_list):
+    """ Saves ligands in a ragged layout: the atoms of every molecule are stored one after the other in flat arrays
+    and molecule i owns atoms atom_offsets[i] to atom_offsets[i+1]"""
+    atom_offsets = np.zeros(len(n_atom_array) + 1, dtype=np.int64)
+    atom_offsets[1:] = np.cumsum(n_atom_array, dtype=np.int64)
+    np.save(os.path.join(save_path, f"{ligand_type}_atom_xyz_flat"), atoms_xyz)
+    np.save(os.path.join(save_path, f"{ligand_type}_atom_type_flat"), atoms_type)
+    np.save(os.path.join(save_path, f"{ligand_type}_atom_offsets"), atom_offsets)
+    np.save(os.path.join(save_path, f"{ligand_type}_atoms_num_per_ligand"), n_atom_array)
+    save_string_table(save_path, f"{ligand_type}_molecule_name", molecule_name_list)
+    save_string_table(save_path, f"{ligand_type}_atom_name", atom_name_list)
+
+
+def read_ligand_manifest(save_path, ligand_type):
+    """ Returns the manifest of the ligands of ligand_type in save_path, or None if they are not preprocessed.
+    Manifests written before batches were recorded are read as a single batch 0"""
+    manifest_path = os.path.join(save_path, f"{ligand_type}_manifest.json")
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if "batches" not in manifest:
+        for shard in manifest["shards"]:
+            shard["batch"] = 0
+        manifest["batches"] = [{"batch": 0, "source_sha256": manifest.get("source_sha256"),
+                                "molecule_count": manifest["molecule_count"],
+                                "unique_molecule_count": manifest["unique_molecule_count"]}]
+    return manifest
+
+
+def get_ligand_files(save_path, ligand_type):
+    return [file for file in os.listdir(save_path) if file.startswith(f"{ligand_type}_shard_") or
+            file in (f"{ligand_type}_manifest.json", f"{ligand_type}_ligand_count.npy")]
+
+
+def is_preprocessed(save_path, ligand_type, source_digest, append=False):
+    """ True if save_path holds the ligands of ligand_type read from a file with source_digest as sha256. With append,
+    true if any batch was read from that file"""
+    manifest = read_ligand_manifest(save_path, ligand_type)
+    if manifest is None:
+        return False
+    if append:
+        return any(batch_entry["source_sha256"] == source_digest for batch_entry in manifest["batches"])
+    return manifest.get("source_sha256") == source_digest
+
+
 def get_suffix(conf_num):
     suffix = ""
     if conf_num != 0:
@@ -122,16 +290,34 @@ def get_args():
     parser.add_argument("-t", '--ligand_type', type=str, help='Ligand type (not required)')
     parser.add_argument("-c", '--conformers_per_molecule', type=int, help='Number of conformers per molecule')
     parser.add_argument("-o", '--output_dir', type=str, help='Output directory')
+    parser.add_argument("-s", '--shard_size', type=int, default=100000, help='Number of molecules per output shard')
+    parser.add_argument("-p", '--processes', type=int, default=1, help='Number of processes used to parse the file')
+    parser.add_argument('--cache_folder', type=str, default=None,
+                        help='Folder where preprocessed ligands are cached and reused between runs')
+    parser.add_argument('--cache_max_gb', type=float, default=None,
+                        help='Size of the cache above which the least recently used entries are removed')
+    parser.add_argument("-a", '--append', action='store_true',
+                        help='Add the ligands to the already preprocessed ligands as a new batch')
 
     args = parser.parse_args()
     ligand_file_path = args.ligand_path
     ligand_type = args.ligand_type
     conformers_per_molecule = args.conformers_per_molecule
     output_dir = args.output_dir
-    main(ligand_path=ligand_file_path, ligand_type=ligand_type, conformers_per_molecule=conformers_per_molecule, output_dir=output_dir)
+    main(ligand_path=ligand_file_path, ligand_type=ligand_type, conformers_per_molecule=conformers_per_molecule,
+         output_dir=output_dir, shard_size=args.shard_size, processes=args.processes,
+         cache_folder=args.cache_folder, append=args.append,
+         cache_max_bytes=int(args.cache_max_gb * 1e9) if args.cache_max_gb is not None else None)
 
 
-def main(ligand_path, conformers_per_molecule, overwrite=False, ligand_type='ligand', output_dir=None):
+def main(ligand_path, conformers_per_molecule, overwrite=False, ligand_type='ligand', output_dir=None,
+         shard_size=100000, processes=1, cache_folder=None, cache_max_bytes=None, append=False):
+    """ Ligands already preprocessed from a file with the same content are reused unless overwrite is set. With
+    cache_folder, the preprocessed ligands are also looked up in and stored to a cache keyed by the content of
+    ligand_path and ligand_type.
+    With append, only ligand_path is parsed and its shards are added to the ligands already in the output folder as
+    a new batch, which can be scored alone with LIGAND_BATCHES. A file that was already appended is skipped. The
+    cache is not used when appending since an entry holds the ligands of a single file"""
     if os.path.isfile(ligand_path):
         if ligand_path.find('_conf') != -1:
             suffix = get_suffix_search_in_file_name(ligand_path)
@@ -142,10 +328,26 @@ def main(ligand_path, conformers_per_molecule, overwrite=False, ligand_type='lig
         output_folder = os.path.join(output_dir, f"preprocessed_ligands{suffix}")
         if not os.path.exists(output_folder):
             os.makedirs(output_folder)
-        if os.listdir(output_folder) and not overwrite:
-            print(f'{output_folder} is not empty... Skipping. \nUse overwrite=True to overwrite.')
+        source_digest = get_file_digest(ligand_path)
+        if cache_folder is not None:
+            cache_key = get_cache_key('ligands', {'SOURCE_SHA256': source_digest, 'LIGAND_TYPE': ligand_type})
+        if is_preprocessed(output_folder, ligand_type, source_digest, append) and not overwrite:
+            print(f'{output_folder} already holds these ligands... Skipping. \nUse overwrite=True to overwrite.')
+        elif append and read_ligand_manifest(output_folder, ligand_type) is not None:
+            batch = load_atoms_mol2(ligand_path, output_folder, ligand_type=ligand_type, shard_size=shard_size,
+                                    processes=processes, source_digest=source_digest, append=True)
+            print(f'Appended {ligand_path} to {output_folder} as batch {batch}')
         else:
-            load_atoms_mol2(ligand_path, output_folder, ligand_type=ligand_type)
+            remove_ligand_shards(output_folder, ligand_type)
+            if cache_folder is not None and not overwrite and \
+                    restore_from_cache(cache_folder, 'ligands', cache_key, output_folder):
+                print(f'Restored {ligand_type} from cache {cache_key}')
+                return output_folder
+            load_atoms_mol2(ligand_path, output_folder, ligand_type=ligand_type, shard_size=shard_size,
+                            processes=processes, source_digest=source_digest)
+            if cache_folder is not None:
+                store_in_cache(cache_folder, 'ligands', cache_key, output_folder,
+                               get_ligand_files(output_folder, ligand_type), cache_max_bytes)
         return output_folder
     else:
         exit(f'Argument used for ligand_path is not a file: {ligand_path}')
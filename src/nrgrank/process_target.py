@@ -1,9 +1,13 @@
 import os
+import re
 import numpy as np
-from numba import njit
+from numba import njit, prange
+from scipy.spatial import cKDTree
 from nrgrank.general_functions import load_rad_dict, get_radius_number
+from nrgrank.preprocess_cache import get_file_digest, get_cache_key, restore_from_cache, store_in_cache
 import shutil
 import timeit
+import hashlib
 import argparse
 from datetime import date
 import importlib.resources
@@ -83,157 +87,241 @@ def build_index_cubes(water_vdw_radius, target_atoms_xyz, atoms_radius, preproce
     min_xyz[1] = np.min(target_atoms_xyz[:, 1]) - cell_width*cw_factor
     min_xyz[2] = np.min(target_atoms_xyz[:, 2]) - cell_width*cw_factor
     lengths = ((max_xyz - min_xyz) / cell_width).astype(np.int32) + 1
-    temp_grid = []
-    for i in range(lengths[0]):
-        temp_grid.append([])
-        for j in range(lengths[1]):
-            temp_grid[i].append([])
-            for k in range(lengths[2]):
-                temp_grid[i][j].append([])
-    for i, row in enumerate(target_atoms_xyz):
-        grid_indices = ((row[:3] - min_xyz) / cell_width).astype(np.int32)
-        temp_grid[grid_indices[0]][grid_indices[1]][grid_indices[2]].append(i)
-    max_cell_len = 0
-    for row in temp_grid:
-        for col in row:
-            for cell in col:
-                n = len(cell)
-                if n > max_cell_len:
-                    max_cell_len = n
-    grid = np.full((lengths[0], lengths[1], lengths[2], max_cell_len), grid_placeholder, dtype=np.int32)
-    for i in range(lengths[0]):
-        for j in range(lengths[1]):
-            for k in range(lengths[2]):
-                for x, v in enumerate(temp_grid[i][j][k]):
-                    grid[i][j][k][x] = v
+    grid_indices = ((target_atoms_xyz[:, :3] - min_xyz) / cell_width).astype(np.int32)
+    cell_indices = np.ravel_multi_index(grid_indices.T, lengths)
+    atoms_per_cell = np.bincount(cell_indices, minlength=np.prod(lengths))
+    max_cell_len = np.max(atoms_per_cell) if len(cell_indices) else 0
+    # Atoms are stored in each cell in the order they appear in the target file
+    sorted_atoms = np.argsort(cell_indices, kind='stable')
+    sorted_cells = cell_indices[sorted_atoms]
+    cell_starts = np.cumsum(atoms_per_cell) - atoms_per_cell
+    position_in_cell = np.arange(len(sorted_atoms)) - cell_starts[sorted_cells]
+    grid = np.full((np.prod(lengths), max_cell_len), grid_placeholder, dtype=np.int32)
+    grid[sorted_cells, position_in_cell] = sorted_atoms
+    grid = grid.reshape((lengths[0], lengths[1], lengths[2], max_cell_len))
     np.save(os.path.join(preprocessed_file_path, f"index_cube_min_xyz"), min_xyz)
     np.save(os.path.join(preprocessed_file_path, f"index_cube_cell_width"), cell_width)
-    coord_list = []
-    name_list = []
-    for x in np.arange(min_xyz[0], max_xyz[0], cell_width):
-        for y in np.arange(min_xyz[1], max_xyz[1], cell_width):
-            for z in np.arange(min_xyz[2], max_xyz[2], cell_width):
-                coord_list.append([x, y, z])
-                if not name_list:
-                    name_list = ["O"]
-                elif name_list == ["O"]:
-                    name_list.append("N")
-                else:
-                    name_list.append("C")
-    # write_pdb(coord_list, "binding_grid_test", './temp/ligand_poses', name_list, None)
     return grid, min_xyz, cell_width, max_xyz
 
 
-def prepare_preprocess_output(path_to_target, params_dict):
+# Parameters that only add files named after their value, or that do not change any file
+config_parameters_ignored = ('VERBOSE', 'LIGAND_TEST_DOT_SEPARATION', 'COARSE_TEST_DOT_SEPARATION', 'CF_GRID_SPACING')
+
+
+def prepare_preprocess_output(path_to_target):
     numpy_output_path = os.path.join(path_to_target, 'preprocessed_target')
     os.makedirs(numpy_output_path, exist_ok=True)
-    config_output = os.path.join(numpy_output_path, "config.txt")
-    with open(config_output, "w") as config_file:
+    return numpy_output_path
+
+
+def write_preprocess_config(preprocessed_target_folder_path, params_dict):
+    """ Records the parameters the files were made with. It is written once every file is complete, under a temporary
+    name that is then renamed, so an interrupted run never leaves a config that matches incomplete files"""
+    config_output = os.path.join(preprocessed_target_folder_path, "config.txt")
+    temporary_output = f"{config_output}.tmp-{os.getpid()}"
+    with open(temporary_output, "w") as config_file:
         config_file.write(f"DATE_PREPARED {date.today().strftime('%d/%m/%Y')}\n")
         for parameter in params_dict:
             config_file.write(f"{parameter}={params_dict[parameter]}\n")
-    return numpy_output_path
+    os.replace(temporary_output, config_output)
+
+
+def remove_preprocess_config(preprocessed_target_folder_path):
+    config_path = os.path.join(preprocessed_target_folder_path, "config.txt")
+    if os.path.isfile(config_path):
+        os.remove(config_path)
+
+
+# Files named after the value of a parameter: test dots, clash grid and finer CF grid with its origin
+value_named_file_pattern = re.compile(r'(ligand_test_dots|clash_list)_[0-9.]+\.npy|cf_list_[0-9.]+(_origin)?\.npy')
+
+
+def remove_value_named_files(preprocessed_target_folder_path):
+    """ Removes the files made for any value of the parameters that only add files named after their value. They were
+    made from the previous grid, so a later run with one of these values must not find them"""
+    for file_name in os.listdir(preprocessed_target_folder_path):
+        if value_named_file_pattern.fullmatch(file_name):
+            os.remove(os.path.join(preprocessed_target_folder_path, file_name))
+
+
+def read_preprocess_config(preprocessed_target_folder_path):
+    """ Parameters written in config.txt by write_preprocess_config, as strings. None if there is no config"""
+    config_path = os.path.join(preprocessed_target_folder_path, "config.txt")
+    if not os.path.isfile(config_path):
+        return None
+    config = {}
+    with open(config_path) as config_file:
+        for line in config_file:
+            if '=' in line:
+                parameter, value = line.rstrip('\n').split('=', 1)
+                config[parameter] = value
+    return config
+
+
+def get_changed_parameters(previous_config, params_dict):
+    return [parameter for parameter in params_dict if parameter not in config_parameters_ignored and
+            previous_config.get(parameter) != str(params_dict[parameter])]
 
 
 def load_ligand_test_dots(test_dot_separation, binding_site_spheres, ignore_distance_sphere):
     """ This function uses the binding site spheres to make dots on which the ligand will be centered for testing poses"""
-    grid_coords = []
     a = np.array(binding_site_spheres)
 
     x = [round(np.min(a[:, 0]) - a[np.argmin(a[:, 0]), 3], 3), round(np.max(a[:, 0]) + a[np.argmax(a[:, 0]), 3], 3)]
     y = [round(np.min(a[:, 1]) - a[np.argmin(a[:, 1]), 3], 3), round(np.max(a[:, 1]) + a[np.argmax(a[:, 1]), 3], 3)]
     z = [round(np.min(a[:, 2]) - a[np.argmin(a[:, 2]), 3], 3), round(np.max(a[:, 2]) + a[np.argmax(a[:, 2]), 3], 3)]
 
-    for dot_x in np.arange(x[0], x[1], test_dot_separation):
-        for dot_y in np.arange(y[0], y[1], test_dot_separation):
-            for dot_z in np.arange(z[0], z[1], test_dot_separation):
-                coords = np.array([round(dot_x, 3), round(dot_y, 3), round(dot_z, 3)])
-                for row in a:
-                    if ignore_distance_sphere:
-                        grid_coords.append(coords)
-                    else:
-                        distance = np.linalg.norm(coords - row[:3])
-                        if distance < row[3]:
-                            grid_coords.append(coords)
-                            break
-    return grid_coords
+    dot_x, dot_y, dot_z = np.meshgrid(np.round(np.arange(x[0], x[1], test_dot_separation), 3),
+                                      np.round(np.arange(y[0], y[1], test_dot_separation), 3),
+                                      np.round(np.arange(z[0], z[1], test_dot_separation), 3), indexing='ij')
+    box_coords = np.stack((dot_x.ravel(), dot_y.ravel(), dot_z.ravel()), axis=1)
+    if ignore_distance_sphere:
+        return np.repeat(box_coords, len(a), axis=0)
+    # Only measure distances between dots and spheres close enough to possibly contain them
+    sphere_tree = cKDTree(a[:, :3])
+    pairs = sphere_tree.sparse_distance_matrix(cKDTree(box_coords), np.max(a[:, 3]), output_type='ndarray')
+    sphere_index = pairs['i']
+    dot_index = pairs['j']
+    distance = np.sqrt(np.sum((box_coords[dot_index] - a[sphere_index, :3]) ** 2, axis=1))
+    in_sphere = np.zeros(len(box_coords), dtype=np.bool_)
+    in_sphere[dot_index[distance < a[sphere_index, 3]]] = True
+    return box_coords[in_sphere]
 
 
 def clean_binding_site_grid(target_grid, binding_site_grid, min_xyz, cell_width, target_atoms_xyz, ligand_test_dot_file_path):
+    binding_site_grid = np.asarray(binding_site_grid, dtype=np.float64).reshape((-1, 3))
     index = []
-    for a, point in enumerate(binding_site_grid):
-        grid_index = ((point - min_xyz) / cell_width).astype(np.int32)
-        for i_offset in [-1, 0, 1]:
-            for j_offset in [-1, 0, 1]:
-                for k_offset in [-1, 0, 1]:
-                    i = i_offset + grid_index[0]
-                    j = j_offset + grid_index[1]
-                    k = k_offset + grid_index[2]
-                    if i < len(target_grid) and j < len(target_grid[0]) and k < len(target_grid[0][0]):
-                        for neighbour in target_grid[i][j][k]:
-                            if neighbour == -1:
-                                break
-                            else:
-                                dist = np.sqrt((target_atoms_xyz[neighbour][0] - point[0]) ** 2 +
-                                               (target_atoms_xyz[neighbour][1] - point[1]) ** 2 +
-                                               (target_atoms_xyz[neighbour][2] - point[2]) ** 2)
-                                if dist <= 2.0:
-                                    index.append(a)
-
-                                    break
+    if len(binding_site_grid) and len(target_atoms_xyz):
+        pairs = cKDTree(binding_site_grid).sparse_distance_matrix(cKDTree(target_atoms_xyz), 2.0 + 1e-6,
+                                                                  output_type='ndarray')
+        point = binding_site_grid[pairs['i']]
+        neighbour = target_atoms_xyz[pairs['j']]
+        dist = np.sqrt((neighbour[:, 0] - point[:, 0]) ** 2 +
+                       (neighbour[:, 1] - point[:, 1]) ** 2 +
+                       (neighbour[:, 2] - point[:, 2]) ** 2)
+        index = np.unique(pairs['i'][dist <= 2.0])
     cleaned_binding_site_grid = np.delete(binding_site_grid, index, 0)
     # write_pdb(cleaned_binding_site_grid, "cleaned_grid", f'./temp/ligand_poses/', None, None)
     np.save(ligand_test_dot_file_path, cleaned_binding_site_grid)
 
 
-@njit
-def get_cf_list(target_grid, atom_type_range, target_atom_types, energy_matrix, number_types):
+@njit(cache=True)
+def get_type_energies(atom_type_range, energy_matrix):
+    """ Rows of the energy matrix for every ligand atom type, so one product per cell gives the CF of all types"""
+    type_energies = np.zeros((len(atom_type_range), len(energy_matrix[0])))
+    for counter, atom_type in enumerate(atom_type_range):
+        type_energies[counter] = energy_matrix[atom_type]
+    return type_energies
+
+
+def get_cf_list_bounds(bd_site_cuboid, min_xyz, cell_width, grid_shape, padding):
+    """ First and last + 1 index cube cell of the CF grid on each axis. The cells cover the binding site cuboid grown
+    by padding with one more cell on each side for interpolation. With padding None every cell is kept"""
+    grid_shape = np.array(grid_shape, dtype=np.int64)
+    if padding is None:
+        return np.zeros(3, dtype=np.int64), grid_shape
+    low_index = np.floor((bd_site_cuboid[:, 0] - padding - min_xyz) / cell_width).astype(np.int64) - 1
+    high_index = np.floor((bd_site_cuboid[:, 1] + padding - min_xyz) / cell_width).astype(np.int64) + 2
+    low_index = np.clip(low_index, 0, grid_shape)
+    return low_index, np.maximum(np.clip(high_index, 0, grid_shape), low_index)
+
+
+@njit(parallel=True, cache=True)
+def get_cf_list(target_grid, atom_type_range, target_atom_types, energy_matrix, number_types, low_index, high_index):
+    """ CF of every atom type in the index cube cells low_index to high_index, stored as float32"""
     target_grid_x = len(target_grid)
     target_grid_y = len(target_grid[0])
     target_grid_z = len(target_grid[0][0])
-    result_array = np.zeros((target_grid_x, target_grid_y, target_grid_z, number_types))
-    for x in np.arange(0, target_grid_x):
-        for y in np.arange(0, target_grid_y):
-            for z in np.arange(0, target_grid_z):
-                grid_index = [x, y, z]
-                for counter, atom_type in enumerate(atom_type_range):
+    number_target_types = len(energy_matrix[0])
+    type_energies = get_type_energies(atom_type_range, energy_matrix)
+    result_array = np.zeros((high_index[0] - low_index[0], high_index[1] - low_index[1], high_index[2] - low_index[2],
+                             number_types), dtype=np.float32)
+    for x in prange(low_index[0], high_index[0]):
+        neighbour_type_histogram = np.zeros(number_target_types)
+        for y in range(low_index[1], high_index[1]):
+            for z in range(low_index[2], high_index[2]):
+                neighbour_type_histogram[:] = 0.0
+                for i_offset in range(-1, 2):
+                    for j_offset in range(-1, 2):
+                        for k_offset in range(-1, 2):
+                            i = i_offset + x
+                            j = j_offset + y
+                            k = k_offset + z
+                            if 0 < i < target_grid_x and 0 < j < target_grid_y and 0 < k < target_grid_z:
+                                for neighbour in target_grid[i, j, k]:
+                                    if neighbour == -1:
+                                        break
+                                    neighbour_type_histogram[target_atom_types[neighbour]] += 1.0
+                for counter in range(len(atom_type_range)):
+                    cf = 0.0
+                    for target_type in range(number_target_types):
+                        if neighbour_type_histogram[target_type] != 0.0:
+                            cf += neighbour_type_histogram[target_type] * type_energies[counter, target_type]
+                    result_array[x - low_index[0], y - low_index[1], z - low_index[2], counter] = cf
+    return result_array
+
+
+@njit(parallel=True, cache=True)
+def get_cf_grid(grid_origin, grid_spacing, grid_shape, target_grid, min_xyz, cell_width, target_atoms_xyz,
+                target_atom_types, atom_type_range, energy_matrix, number_types):
+    """ CF of every atom type on a grid of points grid_spacing apart, independent of the index cube cell width.
+    Every point counts the target atoms within 1.5 cell widths on each axis, the same neighbourhood a cell centre gets
+    in get_cf_list"""
+    number_target_types = len(energy_matrix[0])
+    type_energies = get_type_energies(atom_type_range, energy_matrix)
+    half_width = 1.5 * cell_width
+    result_array = np.zeros((grid_shape[0], grid_shape[1], grid_shape[2], number_types), dtype=np.float32)
+    for x in prange(grid_shape[0]):
+        neighbour_type_histogram = np.zeros(number_target_types)
+        point = np.zeros(3)
+        low_index = np.zeros(3, dtype=np.int64)
+        high_index = np.zeros(3, dtype=np.int64)
+        point[0] = grid_origin[0] + x * grid_spacing
+        for y in range(grid_shape[1]):
+            point[1] = grid_origin[1] + y * grid_spacing
+            for z in range(grid_shape[2]):
+                point[2] = grid_origin[2] + z * grid_spacing
+                neighbour_type_histogram[:] = 0.0
+                for axis in range(3):
+                    low_index[axis] = max(int(np.floor((point[axis] - half_width - min_xyz[axis]) / cell_width)), 0)
+                    high_index[axis] = min(int(np.floor((point[axis] + half_width - min_xyz[axis]) / cell_width)),
+                                           target_grid.shape[axis] - 1)
+                for i in range(low_index[0], high_index[0] + 1):
+                    for j in range(low_index[1], high_index[1] + 1):
+                        for k in range(low_index[2], high_index[2] + 1):
+                            for neighbour in target_grid[i, j, k]:
+                                if neighbour == -1:
+                                    break
+                                if -half_width <= target_atoms_xyz[neighbour, 0] - point[0] < half_width and \
+                                        -half_width <= target_atoms_xyz[neighbour, 1] - point[1] < half_width and \
+                                        -half_width <= target_atoms_xyz[neighbour, 2] - point[2] < half_width:
+                                    neighbour_type_histogram[target_atom_types[neighbour]] += 1.0
+                for counter in range(len(atom_type_range)):
                     cf = 0.0
-                    for i_offset in [-1, 0, 1]:
-                        for j_offset in [-1, 0, 1]:
-                            for k_offset in [-1, 0, 1]:
-                                i = i_offset + grid_index[0]
-                                j = j_offset + grid_index[1]
-                                k = k_offset + grid_index[2]
-                                if 0 < i < len(target_grid) and 0 < j < len(target_grid[0]) and 0 < k < len(target_grid[0][0]):
-                                    if target_grid[i][j][k][0] != -1:
-                                        for neighbour in target_grid[i][j][k]:
-                                            if neighbour == -1:
-                                                break
-                                            else:
-                                                # Normal program:
-                                                type_1 = atom_type
-                                                type_2 = target_atom_types[neighbour]
-                                                # Randomly chosen atom type
-                                                # type_1 = np.random.randint(1, 41)
-                                                # type_2 = np.random.randint(1, 41)
-                                                energy_value = energy_matrix[type_1][type_2]
-                                                cf += energy_value
+                    for target_type in range(number_target_types):
+                        if neighbour_type_histogram[target_type] != 0.0:
+                            cf += neighbour_type_histogram[target_type] * type_energies[counter, target_type]
                     result_array[x, y, z, counter] = cf
     return result_array
 
 
-@njit
+def get_cf_grid_paths(preprocessed_target_folder_path, cf_grid_spacing):
+    return (os.path.join(preprocessed_target_folder_path, f"cf_list_{cf_grid_spacing}.npy"),
+            os.path.join(preprocessed_target_folder_path, f"cf_list_{cf_grid_spacing}_origin.npy"))
+
+
+@njit(parallel=True, cache=True)
 def get_clash_per_dot(x_range, y_range, z_range, target_grid, min_xyz, cell_width, target_atoms_xyz, max_size_array):
     clash_list = np.zeros((max_size_array[0], max_size_array[1], max_size_array[2]), dtype=np.bool_)
-    for a, x_value in enumerate(x_range):
+    for a in prange(len(x_range)):
         for b, y_value in enumerate(y_range):
             for c, z_value in enumerate(z_range):
-                ligand_atom = np.array([x_value, y_value, z_value], dtype=np.float32)
-                clash_list[a][b][c] = get_clash_for_dot(ligand_atom, target_grid, min_xyz, cell_width, target_atoms_xyz)
+                ligand_atom = np.array([x_range[a], y_value, z_value], dtype=np.float32)
+                clash_list[a, b, c] = get_clash_for_dot(ligand_atom, target_grid, min_xyz, cell_width, target_atoms_xyz)
     return clash_list
 
 
-@njit
+@njit(cache=True)
 def get_clash_for_dot(ligand_atom_coord, target_grid, min_xyz, cell_width, target_atoms_xyz):
     # TODO: test if clashes per radius associated to each type is better
     clash = False
@@ -258,12 +346,19 @@ def get_clash_for_dot(ligand_atom_coord, target_grid, min_xyz, cell_width, targe
 
 
 def preprocess_one_target(target_file_path, binding_site_file_path, params_dict, energy_matrix, time_start, overwrite,
-                          verbose=False, create_new_dir=True, ignore_distance_sphere=False):
+                          verbose=False, create_new_dir=True, ignore_distance_sphere=False, cache_folder=None,
+                          cache_max_bytes=None):
+    """ Files already in the output folder are reused unless overwrite is set or the target, the binding site or a
+    parameter changed since they were made. With cache_folder, the preprocessed files are also looked up in and
+    stored to a cache keyed by the content of the inputs and every parameter"""
     use_clash = params_dict["USE_CLASH"]
     clash_dot_distance = params_dict['CLASH_DOT_DISTANCE']
     bd_site_cuboid_padding = params_dict["BD_SITE_CUBOID_PADDING"]
     cell_width = params_dict['CELL_WIDTH']
     test_dot_separation = params_dict['LIGAND_TEST_DOT_SEPARATION']
+    coarse_test_dot_separation = params_dict['COARSE_TEST_DOT_SEPARATION']
+    cf_grid_spacing = params_dict['CF_GRID_SPACING']
+    cf_crop_padding = params_dict['CF_CROP_PADDING']
     water_vdw_radius = params_dict['WATER_RADIUS']
 
     target = os.path.splitext(os.path.basename(target_file_path))[0]
@@ -285,13 +380,45 @@ def preprocess_one_target(target_file_path, binding_site_file_path, params_dict,
 
     # ####################### DEFINE CUBOID AROUND BINDING SITE #######################
 
+    stage_times = {}
+    stage_start = timeit.default_timer()
     rad_dict = load_rad_dict()
     number_of_atom_types = len(energy_matrix)-2
     target_atoms_xyz, target_atoms_types, atoms_radius = load_atoms_mol2(target_file_path, rad_dict)
-    preprocessed_target_folder_path = prepare_preprocess_output(target_save_dir, params_dict)
+    config_params = dict(params_dict, TARGET_SHA256=get_file_digest(target_file_path),
+                         BINDING_SITE_SHA256=get_file_digest(binding_site_file_path),
+                         IGNORE_DISTANCE_SPHERE=ignore_distance_sphere)
+    use_cached_files = not overwrite
+    preprocessed_target_folder_path = prepare_preprocess_output(target_save_dir)
+    previous_config = read_preprocess_config(preprocessed_target_folder_path)
+    if previous_config is None:
+        # Files without a config were left by an interrupted run
+        overwrite = True
+    elif not overwrite:
+        changed_parameters = get_changed_parameters(previous_config, config_params)
+        if changed_parameters:
+            print(f"{target}: {', '.join(changed_parameters)} changed since the target was preprocessed... "
+                  f"Recomputing.")
+            overwrite = True
+    if overwrite:
+        remove_preprocess_config(preprocessed_target_folder_path)
+        remove_value_named_files(preprocessed_target_folder_path)
+    stage_times['load target'] = timeit.default_timer() - stage_start
+
+    if cache_folder is not None:
+        cache_params = {parameter: value for parameter, value in config_params.items() if parameter != 'VERBOSE'}
+        cache_params['ENERGY_MATRIX_SHA256'] = hashlib.sha256(np.ascontiguousarray(energy_matrix)).hexdigest()
+        cache_key = get_cache_key('target', cache_params)
+        if use_cached_files and restore_from_cache(cache_folder, 'target', cache_key, preprocessed_target_folder_path):
+            write_preprocess_config(preprocessed_target_folder_path, config_params)
+            if verbose:
+                print(f"{target}: restored from cache {cache_key}")
+            return preprocessed_target_folder_path
+    stage_start = timeit.default_timer()
     index_cubes, min_xyz, cell_width, max_xyz = build_index_cubes(water_vdw_radius, target_atoms_xyz, atoms_radius,
                                                                   preprocessed_target_folder_path,
                                                                   custom_cell_width=cell_width)
+    stage_times['index cubes'] = timeit.default_timer() - stage_start
     binding_site_spheres = load_binding_site_pdb(binding_site_file_path)
     binding_site_x_range, binding_site_y_range, binding_site_z_range = make_binding_site_cuboid(clash_dot_distance,
                                                                                                 np.array(binding_site_spheres),
@@ -308,27 +435,77 @@ def preprocess_one_target(target_file_path, binding_site_file_path, params_dict,
         if use_clash:
             if verbose:
                 print('Getting clashes')
+            stage_start = timeit.default_timer()
             clash_list = get_clash_per_dot(binding_site_x_range, binding_site_y_range, binding_site_z_range,
                                            index_cubes, min_xyz, cell_width, target_atoms_xyz, max_size_array)
             np.save(clash_file_path, clash_list)
+            stage_times['clash grid'] = timeit.default_timer() - stage_start
         if verbose:
             print('Precalculating CF')
-        cfs_list = get_cf_list(index_cubes, atom_type_range, target_atoms_types, energy_matrix, number_of_atom_types)
+        stage_start = timeit.default_timer()
+        bd_site_cuboid = np.load(os.path.join(preprocessed_target_folder_path, "bd_site_cuboid_coord_range_array.npy"))
+        low_index, high_index = get_cf_list_bounds(bd_site_cuboid, min_xyz, cell_width, index_cubes.shape[:3],
+                                                   cf_crop_padding)
+        cfs_list = get_cf_list(index_cubes, atom_type_range, target_atoms_types, energy_matrix, number_of_atom_types,
+                               low_index, high_index)
         np.save(cf_array_path, cfs_list)
+        # Origin of the first cell kept, rank_molecules indexes the cropped grid from there
+        np.save(os.path.join(preprocessed_target_folder_path, "cf_list_min_xyz.npy"), min_xyz + low_index * cell_width)
+        # Lowest CF each atom type can get anywhere on the grid, used as a lower bound when pruning poses
+        np.save(os.path.join(preprocessed_target_folder_path, "cf_min_per_type.npy"),
+                np.min(cfs_list, axis=(0, 1, 2)).astype(np.float64))
+        stage_times['cf grid'] = timeit.default_timer() - stage_start
     else:
         print(f"Energies already precalculated... Skipping. \nUse -o flag if you wish to overwrite.")
 
+    # The finer CF grid only covers the binding site cuboid, poses outside of it are out of bounds like for clashes
+    if cf_grid_spacing is not None:
+        cf_grid_path, cf_grid_origin_path = get_cf_grid_paths(preprocessed_target_folder_path, cf_grid_spacing)
+        if not os.path.isfile(cf_grid_path) or overwrite:
+            if verbose:
+                print(f'Precalculating CF grid at {cf_grid_spacing} A')
+            stage_start = timeit.default_timer()
+            bd_site_cuboid = np.load(os.path.join(preprocessed_target_folder_path,
+                                                  "bd_site_cuboid_coord_range_array.npy"))
+            grid_origin = bd_site_cuboid[:, 0].astype(np.float64)
+            grid_shape = np.floor((bd_site_cuboid[:, 1] - grid_origin) / cf_grid_spacing).astype(np.int64) + 2
+            cf_grid = get_cf_grid(grid_origin, float(cf_grid_spacing), grid_shape, index_cubes, min_xyz, cell_width,
+                                  target_atoms_xyz, target_atoms_types, np.arange(1, number_of_atom_types+1),
+                                  energy_matrix, number_of_atom_types)
+            np.save(cf_grid_path, cf_grid)
+            np.save(cf_grid_origin_path, grid_origin)
+            stage_times[f'cf grid {cf_grid_spacing} A'] = timeit.default_timer() - stage_start
+
     # ####################### GENERATE AND CLEAN LIGAND TEST DOTS #######################
 
-    ligand_test_dot_file_path = os.path.join(preprocessed_target_folder_path, f"ligand_test_dots_{test_dot_separation}.npy")
-    if not os.path.isfile(ligand_test_dot_file_path) or overwrite:
-        original_grid = load_ligand_test_dots(test_dot_separation, binding_site_spheres, ignore_distance_sphere)
-        clean_binding_site_grid(index_cubes, original_grid, min_xyz, cell_width, target_atoms_xyz,
-                                ligand_test_dot_file_path)
-    else:
-        if verbose:
-            print(f"The file for binding site dots at {test_dot_separation} A distance already exists")
+    # The coarse dots are used by the coarse to fine search mode of rank_molecules
+    for dot_separation in sorted({test_dot_separation, coarse_test_dot_separation} - {None}):
+        ligand_test_dot_file_path = os.path.join(preprocessed_target_folder_path, f"ligand_test_dots_{dot_separation}.npy")
+        if not os.path.isfile(ligand_test_dot_file_path) or overwrite:
+            stage_start = timeit.default_timer()
+            original_grid = load_ligand_test_dots(dot_separation, binding_site_spheres, ignore_distance_sphere)
+            clean_binding_site_grid(index_cubes, original_grid, min_xyz, cell_width, target_atoms_xyz,
+                                    ligand_test_dot_file_path)
+            stage_times[f'test dots {dot_separation} A'] = timeit.default_timer() - stage_start
+        else:
+            if verbose:
+                print(f"The file for binding site dots at {dot_separation} A distance already exists")
+    if cache_folder is not None:
+        cached_files = [os.path.join(preprocessed_target_folder_path, file_name) for file_name in
+                        ["bd_site_cuboid_coord_range_array.npy", "index_cube_min_xyz.npy", "index_cube_cell_width.npy",
+                         "cf_list.npy", "cf_list_min_xyz.npy", "cf_min_per_type.npy"]]
+        if use_clash:
+            cached_files.append(clash_file_path)
+        cached_files.extend(os.path.join(preprocessed_target_folder_path, f"ligand_test_dots_{dot_separation}.npy")
+                            for dot_separation in sorted({test_dot_separation, coarse_test_dot_separation} - {None}))
+        if cf_grid_spacing is not None:
+            cached_files.extend(get_cf_grid_paths(preprocessed_target_folder_path, cf_grid_spacing))
+        store_in_cache(cache_folder, 'target', cache_key, preprocessed_target_folder_path,
+                       [os.path.basename(file_path) for file_path in cached_files], cache_max_bytes)
+    write_preprocess_config(preprocessed_target_folder_path, config_params)
     if verbose:
+        for stage, stage_time in stage_times.items():
+            print(f"{target}: {stage}: {stage_time:.2f} seconds")
         total_run_time = timeit.default_timer() - time_start
         if total_run_time > 60.0:
             total_run_time /= 60
@@ -362,6 +539,8 @@ def main(target_mol2_path: os.PathLike[str] | str,
          create_new_dir: bool = True,
          overwrite: bool = False,
          ignore_distance_sphere: bool = False,
+         cache_folder: os.PathLike[str] | str | None = None,
+         cache_max_bytes: int | None = None,
          **user_config) -> str:
 
     time_start = timeit.default_timer()
@@ -371,8 +550,11 @@ def main(target_mol2_path: os.PathLike[str] | str,
         'CLASH_DOT_DISTANCE': 0.25,
         'BD_SITE_CUBOID_PADDING': 2,
         'LIGAND_TEST_DOT_SEPARATION': 1.5,
+        'COARSE_TEST_DOT_SEPARATION': 3.0,
         'USE_CLASH': True,
         'CELL_WIDTH': 6.56,
+        'CF_GRID_SPACING': None,
+        'CF_CROP_PADDING': None,
         'VERBOSE': False
     }
     params_dict = params_dict_default.copy()
@@ -380,6 +562,10 @@ def main(target_mol2_path: os.PathLike[str] | str,
     use_clash = params_dict['USE_CLASH']
     matrix_name = params_dict['MATRIX_NAME']
     verbose = params_dict['VERBOSE']
+    if params_dict['CF_GRID_SPACING'] is not None and params_dict['CF_GRID_SPACING'] <= 0:
+        raise ValueError(f"CF_GRID_SPACING must be positive, got {params_dict['CF_GRID_SPACING']}")
+    if params_dict['CF_CROP_PADDING'] is not None and params_dict['CF_CROP_PADDING'] < 0:
+        raise ValueError(f"CF_CROP_PADDING must not be negative, got {params_dict['CF_CROP_PADDING']}")
     if not use_clash and verbose:
         print('Considering poses with clashes')
 
@@ -399,7 +585,8 @@ def main(target_mol2_path: os.PathLike[str] | str,
         raise IsADirectoryError(f'{binding_site_file_path} is a directory, expected a file')
 
     target_save_dir = preprocess_one_target(target_mol2_path, binding_site_file_path, params_dict, energy_matrix,
-                                            time_start, overwrite, verbose, create_new_dir, ignore_distance_sphere)
+                                            time_start, overwrite, verbose, create_new_dir, ignore_distance_sphere,
+                                            cache_folder, cache_max_bytes)
     return target_save_dir
 
 
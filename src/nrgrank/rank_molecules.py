@@ -1,17 +1,21 @@
 import os
 import numpy as np
-from numba import njit
+from numba import njit, prange, set_num_threads
+from numba.core import event
 import timeit
 import argparse
 import math as m
 import pickle
-from nrgrank.general_functions import write_pdb
+import json
+from scipy.stats import spearmanr
+from nrgrank.general_functions import write_pdb, load_string_table, save_string_table
+from nrgrank.pose_writer import PoseWriter, get_pose_file_name
 
 # def njit(njit):
 #     return njit
 
 
-@njit
+@njit(cache=True)
 def center_coords(ligand_atoms_xyz, list_size):
     length = list_size
     centered_coord = np.zeros((list_size, 3), dtype=np.float32)
@@ -24,7 +28,9 @@ def center_coords(ligand_atoms_xyz, list_size):
     return centered_coord
 
 
-def load_ligands(target_path, ligand_type, start, end, conf_num, path_to_ligands=None):
+def load_ligands(target_path, ligand_type, start, end, conf_num, path_to_ligands=None, batches=None):
+    """ Loads the molecules start to end of the preprocessed ligands. With batches, only the shards of these batches
+    of the manifest are loaded and start and end count the molecules of these batches"""
     if not path_to_ligands:
         if conf_num == 0:
             print('Ligands are in an old path and conf number is 0')
@@ -35,16 +41,111 @@ def load_ligands(target_path, ligand_type, start, end, conf_num, path_to_ligands
             ligand_folder = f"preprocessed_ligands_{conf_num}_conf"
             path_to_ligands = os.path.join(target_path, ligand_folder)
 
+    batches = get_ligand_batches(path_to_ligands, ligand_type, batches)
+    manifest_path = os.path.join(path_to_ligands, f"{ligand_type}_manifest.json")
+    if os.path.isfile(manifest_path):
+        return load_sharded_ligands(path_to_ligands, manifest_path, start, end, batches)
+    if not os.path.isfile(os.path.join(path_to_ligands, f"{ligand_type}_atom_offsets.npy")):
+        return load_padded_ligands(path_to_ligands, ligand_type, start, end)
+    atom_name, atom_type, atom_xyz, atom_offsets, molecule_name, atoms_num_per_ligand = \
+        load_ligand_shard(path_to_ligands, ligand_type, start, end)
+    return atom_name, atom_type, atom_xyz, atom_offsets, molecule_name, atoms_num_per_ligand, len(atoms_num_per_ligand)
+
+
+def load_ligand_shard(path_to_ligands, prefix, start, end):
+    atom_offsets = np.load(os.path.join(path_to_ligands, f"{prefix}_atom_offsets.npy"), mmap_mode='r')
+    molecule_count = len(atom_offsets) - 1
+    end = molecule_count if end is None else min(end, molecule_count)
+    start = min(start, end)
+    atom_start = atom_offsets[start]
+    atom_end = atom_offsets[end]
+    # Only the atoms of the slice are mapped, nothing is copied until the kernels read it
+    atom_offsets = np.asarray(atom_offsets[start:end+1]) - atom_start
+    atom_xyz = np.load(os.path.join(path_to_ligands, f"{prefix}_atom_xyz_flat.npy"), mmap_mode='r')[atom_start:atom_end]
+    atom_type = np.load(os.path.join(path_to_ligands, f"{prefix}_atom_type_flat.npy"), mmap_mode='r')[atom_start:atom_end]
+    atoms_num_per_ligand = np.asarray(np.load(os.path.join(path_to_ligands, f"{prefix}_atoms_num_per_ligand.npy"),
+                                              mmap_mode='r')[start:end])
+    molecule_name = load_string_table(path_to_ligands, f"{prefix}_molecule_name", start, end)
+    flat_atom_name = load_string_table(path_to_ligands, f"{prefix}_atom_name", atom_start, atom_end)
+    atom_name = [flat_atom_name[atom_offsets[i]:atom_offsets[i+1]] for i in range(len(atoms_num_per_ligand))]
+    return atom_name, atom_type, atom_xyz, atom_offsets, molecule_name, atoms_num_per_ligand
+
+
+def get_ligand_batches(path_to_ligands, ligand_type, batches):
+    """ Returns the batch numbers selected by batches: None for every batch, 'latest' for the last appended batch or a
+    list of batch numbers"""
+    if batches is None:
+        return None
+    manifest_path = os.path.join(path_to_ligands, f"{ligand_type}_manifest.json")
+    if not os.path.isfile(manifest_path):
+        raise ValueError(f'{path_to_ligands} has no {ligand_type} manifest, ligand batches can not be selected')
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    available = sorted({shard.get("batch", 0) for shard in manifest["shards"]})
+    if batches == 'latest':
+        return available[-1:]
+    if isinstance(batches, int):
+        batches = [batches]
+    missing = [batch for batch in batches if batch not in available]
+    if missing:
+        raise ValueError(f'Ligand batches {missing} are not in {manifest_path}. Available batches: {available}')
+    return sorted(batches)
+
+
+def load_sharded_ligands(path_to_ligands, manifest_path, start, end, batches=None):
+    """ Loads the molecules start to end from the shards listed in the manifest. When the slice is inside one shard
+    the arrays stay memory mapped, otherwise the parts of each shard are concatenated.
+    With batches, only the shards of these batches are read"""
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    shards = manifest["shards"]
+    if batches is not None:
+        shards = [shard for shard in shards if shard.get("batch", 0) in batches]
+    molecule_count = sum(shard["molecule_count"] for shard in shards)
+    end = molecule_count if end is None else min(end, molecule_count)
+    parts = []
+    shard_start = 0
+    for shard in shards:
+        shard_end = shard_start + shard["molecule_count"]
+        if shard_start < end and shard_end > start:
+            parts.append(load_ligand_shard(path_to_ligands, shard["prefix"], max(start - shard_start, 0),
+                                           min(end, shard_end) - shard_start))
+        shard_start = shard_end
+    if len(parts) == 1:
+        atom_name, atom_type, atom_xyz, atom_offsets, molecule_name, atoms_num_per_ligand = parts[0]
+    elif len(parts) == 0:
+        atom_name, molecule_name = [], []
+        atom_type = np.zeros(0, dtype=np.int32)
+        atom_xyz = np.zeros((0, 3), dtype=np.float32)
+        atom_offsets = np.zeros(1, dtype=np.int64)
+        atoms_num_per_ligand = np.zeros(0, dtype=np.int32)
+    else:
+        atom_name = [name for part in parts for name in part[0]]
+        atom_type = np.concatenate([part[1] for part in parts])
+        atom_xyz = np.concatenate([part[2] for part in parts])
+        molecule_name = [name for part in parts for name in part[4]]
+        atoms_num_per_ligand = np.concatenate([part[5] for part in parts])
+        atom_offsets = np.zeros(len(atoms_num_per_ligand) + 1, dtype=np.int64)
+        atom_offsets[1:] = np.cumsum(atoms_num_per_ligand, dtype=np.int64)
+    return atom_name, atom_type, atom_xyz, atom_offsets, molecule_name, atoms_num_per_ligand, len(atoms_num_per_ligand)
+
+
+def load_padded_ligands(path_to_ligands, ligand_type, start, end):
+    """ Loads ligands preprocessed before the ragged layout and flattens them"""
     with open(os.path.join(path_to_ligands, f"{ligand_type}_atom_name.pkl"), 'rb') as f:
         atom_name = pickle.load(f)[start:end].copy()
     with open(os.path.join(path_to_ligands, f"{ligand_type}_molecule_name.pkl"), 'rb') as f:
         molecule_name = pickle.load(f)[start:end].copy()
-    atom_type = np.load(os.path.join(path_to_ligands, f"{ligand_type}_atom_type.npy"), mmap_mode='r')[start:end].copy()
-    atom_xyz = np.load(os.path.join(path_to_ligands, f"{ligand_type}_atom_xyz.npy"), mmap_mode='r')[start:end].copy()
+    atom_type = np.load(os.path.join(path_to_ligands, f"{ligand_type}_atom_type.npy"), mmap_mode='r')[start:end]
+    atom_xyz = np.load(os.path.join(path_to_ligands, f"{ligand_type}_atom_xyz.npy"), mmap_mode='r')[start:end]
     atoms_num_per_ligand = np.load(os.path.join(path_to_ligands, f"{ligand_type}_atoms_num_per_ligand.npy"),
                                    mmap_mode='r')[start:end].copy()
+    atom_mask = np.arange(atom_xyz.shape[1]) < atoms_num_per_ligand[:, None]
+    atom_offsets = np.zeros(len(atoms_num_per_ligand) + 1, dtype=np.int64)
+    atom_offsets[1:] = np.cumsum(atoms_num_per_ligand)
     ligand_count = len(atom_type)
-    return atom_name, atom_type, atom_xyz, molecule_name, atoms_num_per_ligand, ligand_count
+    return atom_name, atom_type[atom_mask], atom_xyz[atom_mask], atom_offsets, molecule_name, atoms_num_per_ligand, \
+        ligand_count
 
 
 def Rx(theta):
@@ -59,27 +160,55 @@ def Rz(theta):
     return np.matrix([[m.cos(theta), -m.sin(theta), 0], [m.sin(theta), m.cos(theta), 0], [0, 0, 1]])
 
 
-def rotate_ligand(ligand_atoms_xyz, n_rotations):
-    centered_ligand_atoms_xyz = center_coords(ligand_atoms_xyz, len(ligand_atoms_xyz))
+def get_rotation_matrices(n_rotations):
     single_rotation = 360/n_rotations
+    rotation_matrices = np.zeros((n_rotations**3, 3, 3), dtype=np.float64)
     rotation_counter = 0
-    rotated_ligand_coord_list = np.zeros((n_rotations**3, len(centered_ligand_atoms_xyz), 3), dtype=np.float32)
     for x_rot_count in range(n_rotations):
         for y_rot_count in range(n_rotations):
             for z_rot_count in range(n_rotations):
                 x = np.deg2rad(x_rot_count*single_rotation)
                 y = np.deg2rad(y_rot_count*single_rotation)
                 z = np.deg2rad(z_rot_count*single_rotation)
-                rotation_matrix = Rx(x) * Ry(y) * Rz(z)
-                for i, coord in enumerate(centered_ligand_atoms_xyz):
-                    rotated_ligand_coord_list[rotation_counter][i] = np.array(np.dot(rotation_matrix, coord))
+                rotation_matrices[rotation_counter] = Rx(x) * Ry(y) * Rz(z)
                 rotation_counter += 1
-    rotated_ligand_coord_list_unique = np.unique(rotated_ligand_coord_list, axis=0)
-    return rotated_ligand_coord_list_unique
+    # Different euler angle combinations can describe the same rotation, only keep the first occurrence
+    _, unique_indices = np.unique(np.round(rotation_matrices, 6), axis=0, return_index=True)
+    return rotation_matrices[np.sort(unique_indices)]
 
 
-@njit
-def get_cf(lig_pose, point, cf_size_list, precalc_cf_list, ligand_atoms_types, default_cf, cell_width, min_xyz):
+@njit(cache=True)
+def apply_rotations(centered_ligand_atoms_xyz, rotation_matrices):
+    n_atoms = len(centered_ligand_atoms_xyz)
+    rotated_ligand_coord_list = np.zeros((len(rotation_matrices), n_atoms, 3), dtype=np.float32)
+    for rotation_counter in range(len(rotation_matrices)):
+        rotation_matrix = rotation_matrices[rotation_counter]
+        for i in range(n_atoms):
+            for axis in range(3):
+                rotated_ligand_coord_list[rotation_counter, i, axis] = \
+                    rotation_matrix[axis, 0] * centered_ligand_atoms_xyz[i, 0] + \
+                    rotation_matrix[axis, 1] * centered_ligand_atoms_xyz[i, 1] + \
+                    rotation_matrix[axis, 2] * centered_ligand_atoms_xyz[i, 2]
+    return rotated_ligand_coord_list
+
+
+def rotate_ligand(ligand_atoms_xyz, rotation_matrices):
+    centered_ligand_atoms_xyz = center_coords(ligand_atoms_xyz, len(ligand_atoms_xyz))
+    return apply_rotations(centered_ligand_atoms_xyz, rotation_matrices)
+
+
+# Outcomes of the poses counted by the scoring kernels. A pose that is not rejected is scored
+pose_count_names = ('evaluated', 'out of bounds', 'clash', 'default cf', 'pruned')
+
+
+@njit(cache=True)
+def get_cf(lig_pose, point, cf_size_list, precalc_cf_list, ligand_atoms_types, default_cf, cell_width, min_xyz,
+           cf_interpolation, cf_threshold, remaining_cf_bounds, pose_counts):
+    # pose_counts is indexed like pose_count_names
+    pose_counts[0] += 1
+    if cf_interpolation:
+        return get_cf_interpolated(lig_pose + point, precalc_cf_list, ligand_atoms_types, default_cf, min_xyz,
+                                   cell_width, cf_threshold, remaining_cf_bounds, pose_counts)
     cf = 0.0
     lig_pose = lig_pose + point
     x_index_array = ((lig_pose[:, 0] - min_xyz[0]) / cell_width).astype(np.int32)
@@ -87,22 +216,67 @@ def get_cf(lig_pose, point, cf_size_list, precalc_cf_list, ligand_atoms_types, d
     z_index_array = ((lig_pose[:, 2] - min_xyz[2]) / cell_width).astype(np.int32)
     if np.min(x_index_array) < 0 or np.min(y_index_array) < 0 or np.min(z_index_array) < 0:
         cf = default_cf
+        pose_counts[1] += 1
     elif np.max(x_index_array) >= cf_size_list[0] or np.max(y_index_array) >= cf_size_list[1] or np.max(z_index_array) >= cf_size_list[2]:
         cf = default_cf
+        pose_counts[1] += 1
     else:
         for counter, _ in enumerate(x_index_array):
             temp_cf = precalc_cf_list[x_index_array[counter]][y_index_array[counter]][z_index_array[counter]][ligand_atoms_types[counter]-1]
             if temp_cf == default_cf:
                 cf = default_cf
+                pose_counts[3] += 1
                 break
             else:
                 cf += temp_cf
+                # Even the best remaining contacts can not bring this pose under the threshold
+                if cf + remaining_cf_bounds[counter] > cf_threshold:
+                    cf = default_cf
+                    pose_counts[4] += 1
+                    break
+    return cf
+
+
+@njit(cache=True)
+def get_cf_interpolated(posed_xyz, cf_list, ligand_atoms_types, default_cf, min_xyz, cell_width, cf_threshold,
+                        remaining_cf_bounds, pose_counts):
+    """ CF of a pose with the CF of every atom interpolated between the 8 grid points around it. The CF of a cell is
+    the value at its centre"""
+    grid_position = (posed_xyz - min_xyz) / cell_width - 0.5
+    low_index = np.floor(grid_position).astype(np.int64)
+    fraction = grid_position - low_index
+    for axis in range(3):
+        if np.min(low_index[:, axis]) < 0 or np.max(low_index[:, axis]) + 1 >= cf_list.shape[axis]:
+            pose_counts[1] += 1
+            return default_cf
+    cf = 0.0
+    for counter in range(len(posed_xyz)):
+        x, y, z = low_index[counter]
+        fx, fy, fz = fraction[counter]
+        type_index = ligand_atoms_types[counter] - 1
+        temp_cf = 0.0
+        for i in range(2):
+            wx = fx if i else 1.0 - fx
+            for j in range(2):
+                wy = fy if j else 1.0 - fy
+                for k in range(2):
+                    corner_cf = cf_list[x + i, y + j, z + k, type_index]
+                    if corner_cf == default_cf:
+                        pose_counts[3] += 1
+                        return default_cf
+                    temp_cf += wx * wy * (fz if k else 1.0 - fz) * corner_cf
+        cf += temp_cf
+        if cf + remaining_cf_bounds[counter] > cf_threshold:
+            pose_counts[4] += 1
+            return default_cf
     return cf
 
 
-@njit
+@njit(cache=True)
 def get_cf_with_clash(lig_pose, point, load_range_list, grid_spacing, cf_size_list, load_cf_list, ligand_atoms_types,
-                      default_cf, cell_width, min_xyz, clash_list, clash_list_size, num_atoms):
+                      default_cf, cell_width, min_xyz, cf_interpolation, clash_list, clash_list_size, num_atoms,
+                      cf_threshold, remaining_cf_bounds, pose_counts):
+    pose_counts[0] += 1
     ###### CHECK CLASH ######
     x_index_array = np.empty_like(lig_pose[:, 0])
     np.round(((lig_pose[:, 0] + point[0] - load_range_list[0][0]) / grid_spacing), 0, x_index_array)  # .astype(np.int32)
@@ -113,71 +287,627 @@ def get_cf_with_clash(lig_pose, point, load_range_list, grid_spacing, cf_size_li
     x_index_array = x_index_array.astype(np.int32)
     y_index_array = y_index_array.astype(np.int32)
     z_index_array = z_index_array.astype(np.int32)
-    x_index_array[x_index_array == cf_size_list[0]] -= 1
-    y_index_array[y_index_array == cf_size_list[1]] -= 1
-    z_index_array[z_index_array == cf_size_list[2]] -= 1
+    x_index_array[x_index_array == clash_list_size[0]] -= 1
+    y_index_array[y_index_array == clash_list_size[1]] -= 1
+    z_index_array[z_index_array == clash_list_size[2]] -= 1
     if np.min(x_index_array) < 0 or np.min(y_index_array) < 0 or np.min(z_index_array) < 0:
+        pose_counts[1] += 1
         return default_cf
     elif np.max(x_index_array) >= clash_list_size[0] or np.max(y_index_array) >= clash_list_size[1] or np.max(z_index_array) >= clash_list_size[2]:
+        pose_counts[1] += 1
         return default_cf
     else:
         for number in np.arange(0, num_atoms, 1):
             clash_detect = clash_list[x_index_array[number]][y_index_array[number]][z_index_array[number]]
             if clash_detect:
+                pose_counts[2] += 1
                 return default_cf
         else:
+            if cf_interpolation:
+                return get_cf_interpolated(lig_pose + point, load_cf_list, ligand_atoms_types, default_cf, min_xyz,
+                                           cell_width, cf_threshold, remaining_cf_bounds, pose_counts)
             cf = 0.0
             lig_pose = lig_pose + point
             x_index_array = ((lig_pose[:, 0] - min_xyz[0]) / cell_width).astype(np.int32)
             y_index_array = ((lig_pose[:, 1] - min_xyz[1]) / cell_width).astype(np.int32)
             z_index_array = ((lig_pose[:, 2] - min_xyz[2]) / cell_width).astype(np.int32)
+            # A CF grid finer than the index cubes only covers the binding site cuboid
+            if np.min(x_index_array) < 0 or np.min(y_index_array) < 0 or np.min(z_index_array) < 0 or \
+                    np.max(x_index_array) >= cf_size_list[0] or np.max(y_index_array) >= cf_size_list[1] or \
+                    np.max(z_index_array) >= cf_size_list[2]:
+                pose_counts[1] += 1
+                return default_cf
             for counter, _ in enumerate(x_index_array):
                 temp_cf = load_cf_list[x_index_array[counter]][y_index_array[counter]][z_index_array[counter]][ligand_atoms_types[counter]-1]
                 if temp_cf == default_cf:
                     cf = default_cf
+                    pose_counts[3] += 1
                     break
                 else:
                     cf += temp_cf
+                    if cf + remaining_cf_bounds[counter] > cf_threshold:
+                        cf = default_cf
+                        pose_counts[4] += 1
+                        break
             return cf
 
 
-@njit
-def get_cf_main(binding_site_grid, ligand_orientations, cf_size_list, n_cf_evals, load_cf_list, ligand_atoms_types,
-                default_cf, cell_width, min_xyz):
-    cfs_list = np.zeros((n_cf_evals, 3), dtype=np.float32)
-    counter = 0
+@njit(cache=True)
+def add_to_top_poses(top_poses, cf, pose_index, point_index):
+    """ Inserts a pose in the ascending top_poses array if it is better than the worst kept pose"""
+    cf = np.float32(cf)
+    position = len(top_poses) - 1
+    if not cf < top_poses[position][0]:
+        return
+    while position > 0 and cf < top_poses[position-1][0]:
+        top_poses[position] = top_poses[position-1]
+        position -= 1
+    top_poses[position][0] = cf
+    top_poses[position][1] = pose_index
+    top_poses[position][2] = point_index
+
+
+@njit(cache=True)
+def init_top_poses(poses_kept, cf_threshold_init):
+    """ Only poses with a CF below cf_threshold_init are kept. Rows that are never filled keep -1 as indices"""
+    top_poses = np.full((poses_kept, 3), -1, dtype=np.float32)
+    top_poses[:, 0] = cf_threshold_init
+    return top_poses
+
+
+@njit(cache=True)
+def get_remaining_cf_bounds(ligand_atoms_types, cf_min_per_type):
+    """ Lowest CF the atoms after each atom of the ligand could still add to a pose"""
+    remaining_cf_bounds = np.zeros(len(ligand_atoms_types), dtype=np.float64)
+    for counter in range(len(ligand_atoms_types) - 2, -1, -1):
+        remaining_cf_bounds[counter] = remaining_cf_bounds[counter+1] + cf_min_per_type[ligand_atoms_types[counter+1]-1]
+    return remaining_cf_bounds
+
+
+@njit(cache=True)
+def get_cf_threshold(top_poses, use_bound_pruning):
+    if use_bound_pruning:
+        return np.float64(top_poses[-1][0])
+    return np.inf
+
+
+@njit(cache=True)
+def get_cf_main(binding_site_grid, ligand_orientations, cf_size_list, poses_kept, load_cf_list, ligand_atoms_types,
+                default_cf, cell_width, min_xyz, cf_interpolation, use_bound_pruning, cf_min_per_type,
+                cf_threshold_init, pose_counts):
+    top_poses = init_top_poses(poses_kept, cf_threshold_init)
+    remaining_cf_bounds = get_remaining_cf_bounds(ligand_atoms_types, cf_min_per_type)
     for point_index, point in enumerate(binding_site_grid):
         for pose_index, lig_pose in enumerate(ligand_orientations):
-            cf = get_cf(lig_pose, point, cf_size_list, load_cf_list, ligand_atoms_types, default_cf, cell_width, min_xyz)
-            cfs_list[counter][0] = cf
-            cfs_list[counter][1] = pose_index
-            cfs_list[counter][2] = point_index
-            counter += 1
-    return cfs_list
-
-
-@njit
-def get_cf_main_clash(binding_site_grid, ligand_orientations, cf_size_list, n_cf_evals, load_cf_list,
-                      ligand_atoms_types, default_cf, cell_width, min_xyz, load_range_list, preload_grid_distance,
-                      clash_list, clash_list_size, num_atoms):
-    cfs_list = np.zeros((n_cf_evals, 3), dtype=np.float32)
-    counter = 0
+            cf = get_cf(lig_pose, point, cf_size_list, load_cf_list, ligand_atoms_types, default_cf, cell_width,
+                        min_xyz, cf_interpolation, get_cf_threshold(top_poses, use_bound_pruning), remaining_cf_bounds,
+                        pose_counts)
+            add_to_top_poses(top_poses, cf, pose_index, point_index)
+    return top_poses
+
+
+@njit(cache=True)
+def get_cf_main_clash(binding_site_grid, ligand_orientations, cf_size_list, poses_kept, load_cf_list,
+                      ligand_atoms_types, default_cf, cell_width, min_xyz, cf_interpolation, load_range_list,
+                      preload_grid_distance, clash_list, clash_list_size, num_atoms, use_bound_pruning, cf_min_per_type,
+                      cf_threshold_init, pose_counts):
+    top_poses = init_top_poses(poses_kept, cf_threshold_init)
+    remaining_cf_bounds = get_remaining_cf_bounds(ligand_atoms_types, cf_min_per_type)
     for point_index, point in enumerate(binding_site_grid):
         for pose_index, lig_pose in enumerate(ligand_orientations):
             cf = get_cf_with_clash(lig_pose, point, load_range_list, preload_grid_distance, cf_size_list, load_cf_list,
-                                   ligand_atoms_types, default_cf, cell_width, min_xyz, clash_list, clash_list_size,
-                                   num_atoms)
-            cfs_list[counter][0] = cf
-            cfs_list[counter][1] = pose_index
-            cfs_list[counter][2] = point_index
-            counter += 1
-    return cfs_list
+                                   ligand_atoms_types, default_cf, cell_width, min_xyz, cf_interpolation, clash_list,
+                                   clash_list_size, num_atoms, get_cf_threshold(top_poses, use_bound_pruning),
+                                   remaining_cf_bounds, pose_counts)
+            add_to_top_poses(top_poses, cf, pose_index, point_index)
+    return top_poses
+
+
+@njit(cache=True)
+def score_ligand_orientations(binding_site_grid, ligand_orientations, poses_kept, ligand_atoms_types, num_atoms,
+                              cf_size_list, load_cf_list, default_cf, cell_width, min_xyz, cf_interpolation, use_clash,
+                              load_range_list, preload_grid_distance, clash_list, clash_list_size, use_bound_pruning,
+                              cf_min_per_type, cf_threshold_init, pose_counts):
+    if use_clash:
+        return get_cf_main_clash(binding_site_grid, ligand_orientations, cf_size_list, poses_kept, load_cf_list,
+                                 ligand_atoms_types, default_cf, cell_width, min_xyz, cf_interpolation, load_range_list,
+                                 preload_grid_distance, clash_list, clash_list_size, num_atoms, use_bound_pruning,
+                                 cf_min_per_type, cf_threshold_init, pose_counts)
+    return get_cf_main(binding_site_grid, ligand_orientations, cf_size_list, poses_kept, load_cf_list,
+                       ligand_atoms_types, default_cf, cell_width, min_xyz, cf_interpolation, use_bound_pruning,
+                       cf_min_per_type, cf_threshold_init, pose_counts)
+
+
+@njit(cache=True)
+def get_refine_dot_indices(binding_site_grid, region_centers, refine_distance):
+    in_region = np.zeros(len(binding_site_grid), dtype=np.bool_)
+    max_distance = refine_distance ** 2
+    for center in region_centers:
+        for i in range(len(binding_site_grid)):
+            if not in_region[i]:
+                distance = ((binding_site_grid[i, 0] - center[0]) ** 2 + (binding_site_grid[i, 1] - center[1]) ** 2 +
+                            (binding_site_grid[i, 2] - center[2]) ** 2)
+                if distance <= max_distance:
+                    in_region[i] = True
+    return np.nonzero(in_region)[0]
+
+
+@njit(cache=True)
+def get_cf_main_coarse_to_fine(binding_site_grid, ligand_orientations, coarse_grid, coarse_orientations, regions_kept,
+                               refine_distance, poses_kept, ligand_atoms_types, num_atoms, cf_size_list, load_cf_list,
+                               default_cf, cell_width, min_xyz, cf_interpolation, use_clash, load_range_list,
+                               preload_grid_distance, clash_list, clash_list_size, use_bound_pruning, cf_min_per_type,
+                               cf_threshold_init, pose_counts):
+    """ Scores the coarse dots with the coarse rotations, then only the fine dots around the best coarse dots"""
+    coarse_cf_per_dot = np.zeros(len(coarse_grid), dtype=np.float32)
+    for point_index in range(len(coarse_grid)):
+        coarse_cf_per_dot[point_index] = score_ligand_orientations(
+            coarse_grid[point_index:point_index+1], coarse_orientations, 1, ligand_atoms_types, num_atoms, cf_size_list,
+            load_cf_list, default_cf, cell_width, min_xyz, cf_interpolation, use_clash, load_range_list,
+            preload_grid_distance, clash_list, clash_list_size, use_bound_pruning, cf_min_per_type, np.inf,
+            pose_counts)[0][0]
+    best_coarse_dots = np.argsort(coarse_cf_per_dot, kind='mergesort')[:regions_kept]
+    best_coarse_dots = best_coarse_dots[coarse_cf_per_dot[best_coarse_dots] < default_cf]
+    refine_dot_indices = get_refine_dot_indices(binding_site_grid, coarse_grid[best_coarse_dots], refine_distance)
+    if len(refine_dot_indices) == 0:
+        top_poses = init_top_poses(poses_kept, np.inf)
+        top_poses[0][0] = default_cf
+        return top_poses, 0
+    top_poses = score_ligand_orientations(binding_site_grid[refine_dot_indices], ligand_orientations, poses_kept,
+                                          ligand_atoms_types, num_atoms, cf_size_list, load_cf_list, default_cf,
+                                          cell_width, min_xyz, cf_interpolation, use_clash, load_range_list,
+                                          preload_grid_distance, clash_list, clash_list_size, use_bound_pruning,
+                                          cf_min_per_type, cf_threshold_init, pose_counts)
+    for pose in top_poses:
+        if pose[2] >= 0:
+            pose[2] = refine_dot_indices[int(pose[2])]
+    return top_poses, len(refine_dot_indices)
+
+
+@njit(parallel=True, cache=True)
+def get_cf_main_batch(binding_site_grid, rotation_matrices, atom_xyz, atom_type, atom_offsets, poses_kept, cf_size_list,
+                      load_cf_list, default_cf, cell_width, min_xyz, cf_interpolation, use_clash, load_range_list,
+                      preload_grid_distance, clash_list, clash_list_size, use_bound_pruning, cf_min_per_type,
+                      coarse_grid, coarse_rotation_matrices, regions_kept, refine_distance, group_offsets,
+                      use_group_threshold):
+    """ Groups of ligands (e.g. conformers of a molecule) are scored in parallel and the ligands of a group one after
+    the other. With use_group_threshold, the best CF of the group so far is the threshold of the next ligand"""
+    n_ligands = group_offsets[-1] - group_offsets[0]
+    top_poses_list = np.zeros((n_ligands, poses_kept, 3), dtype=np.float32)
+    refine_dot_counts = np.zeros(n_ligands, dtype=np.int64)
+    pose_counts = np.zeros((n_ligands, len(pose_count_names)), dtype=np.int64)
+    for group_index in prange(len(group_offsets) - 1):
+        cf_threshold_init = np.inf
+        for ligand_index in range(group_offsets[group_index] - group_offsets[0],
+                                  group_offsets[group_index+1] - group_offsets[0]):
+            atom_start = atom_offsets[ligand_index]
+            atom_end = atom_offsets[ligand_index+1]
+            num_atoms = atom_end - atom_start
+            ligand_atoms_types = atom_type[atom_start:atom_end]
+            centered_coords = center_coords(atom_xyz[atom_start:atom_end], num_atoms)
+            ligand_orientations = apply_rotations(centered_coords, rotation_matrices)
+            if regions_kept > 0:
+                top_poses_list[ligand_index], refine_dot_counts[ligand_index] = get_cf_main_coarse_to_fine(
+                    binding_site_grid, ligand_orientations, coarse_grid,
+                    apply_rotations(centered_coords, coarse_rotation_matrices), regions_kept, refine_distance,
+                    poses_kept, ligand_atoms_types, num_atoms, cf_size_list, load_cf_list, default_cf, cell_width,
+                    min_xyz, cf_interpolation, use_clash, load_range_list, preload_grid_distance, clash_list,
+                    clash_list_size, use_bound_pruning, cf_min_per_type, cf_threshold_init, pose_counts[ligand_index])
+            else:
+                top_poses_list[ligand_index] = score_ligand_orientations(
+                    binding_site_grid, ligand_orientations, poses_kept, ligand_atoms_types, num_atoms, cf_size_list,
+                    load_cf_list, default_cf, cell_width, min_xyz, cf_interpolation, use_clash, load_range_list,
+                    preload_grid_distance, clash_list, clash_list_size, use_bound_pruning, cf_min_per_type,
+                    cf_threshold_init, pose_counts[ligand_index])
+            if use_group_threshold:
+                cf_threshold_init = min(cf_threshold_init, np.float64(top_poses_list[ligand_index][0][0]))
+    return top_poses_list, refine_dot_counts, pose_counts
+
+
+def get_params_dict(user_config):
+    params_dict_default = {
+        'USE_CLASH': True,
+        'LIGAND_ROTATIONS_PER_AXIS': 9,
+        'LIGAND_TEST_DOT_SEPARATION': 1.5,
+        'CLASH_DOT_DISTANCE': 0.25,
+        'CONFORMERS_PER_MOLECULE': 1,
+        'POSES_SAVED_PER_MOLECULE': 1,
+        'WRITE_LIGAND_TEST_DOTS': False,
+        'VERBOSE': False,
+        'SAVE_TOTAL_TIME': False,
+        'BATCH_SIZE': 0,
+        'NUMBA_THREADS': None,
+        'USE_BOUND_PRUNING': False,
+        'SEARCH_MODE': 'exhaustive',
+        'COARSE_TEST_DOT_SEPARATION': 3.0,
+        'COARSE_ROTATIONS_PER_AXIS': 5,
+        'COARSE_REGIONS_KEPT': 10,
+        'REPORT_SEARCH_AGREEMENT': False,
+        'CHECKPOINT_INTERVAL': 0,
+        'RESUME': False,
+        'WRITE_INTERVAL': 10000,
+        'COLUMNAR_OUTPUT': False,
+        'BEST_CONFORMER_ONLY': False,
+        'POSE_OUTPUT_FORMAT': 'pdb',
+        'WRITE_STATS': False,
+        'CF_GRID_SPACING': None,
+        'CF_INTERPOLATION': False,
+        'LIGAND_BATCHES': None
+    }
+    params_dict = params_dict_default.copy()
+    params_dict.update(user_config)
+    if params_dict['SEARCH_MODE'] not in ('exhaustive', 'coarse_to_fine'):
+        raise ValueError(f"Unknown SEARCH_MODE: {params_dict['SEARCH_MODE']}. "
+                         f"Expected 'exhaustive' or 'coarse_to_fine'")
+    if params_dict['POSE_OUTPUT_FORMAT'] not in ('pdb', 'multi_pdb', 'archive'):
+        raise ValueError(f"Unknown POSE_OUTPUT_FORMAT: {params_dict['POSE_OUTPUT_FORMAT']}. "
+                         f"Expected 'pdb', 'multi_pdb' or 'archive'")
+    return params_dict
+
+
+def load_target(preprocessed_target_path, test_dot_separation=1.5, use_clash=True, clash_dot_distance=0.25,
+                coarse_test_dot_separation=None, cf_grid_spacing=None, cf_interpolation=False):
+    """ Loads every array of a preprocessed target needed for scoring in a dictionary so it can be reused between
+    calls. The coarse grid is only loaded when coarse_test_dot_separation is given.
+    With cf_grid_spacing the CF grid precalculated at that spacing is used instead of the index cube CF grid. Its
+    points are stored as the centres of cells of width cf_grid_spacing so the kernels read both grids the same way"""
+    if not os.path.exists(preprocessed_target_path):
+        raise FileNotFoundError(f'{preprocessed_target_path} does not exist')
+    if not os.path.isdir(preprocessed_target_path):
+        raise IsADirectoryError(f'{preprocessed_target_path} is not directory, expected a directory')
+    target = {'path': preprocessed_target_path, 'use_clash': use_clash, 'clash_dot_distance': clash_dot_distance,
+              'test_dot_separation': test_dot_separation, 'coarse_test_dot_separation': coarse_test_dot_separation,
+              'cf_grid_spacing': cf_grid_spacing, 'cf_interpolation': cf_interpolation}
+    target['binding_site_grid'] = np.load(os.path.join(preprocessed_target_path,
+                                                       f"ligand_test_dots_{test_dot_separation}.npy"))
+    if cf_grid_spacing is not None:
+        cf_grid_path = os.path.join(preprocessed_target_path, f"cf_list_{cf_grid_spacing}.npy")
+        if not os.path.isfile(cf_grid_path):
+            raise FileNotFoundError(f'{cf_grid_path} does not exist. Preprocess the target with '
+                                    f'CF_GRID_SPACING={cf_grid_spacing}')
+        target['cf_list'] = np.load(cf_grid_path)
+        target['cf_min_per_type'] = np.min(target['cf_list'], axis=(0, 1, 2)).astype(np.float64)
+        target['cell_width'] = np.array(cf_grid_spacing, dtype=np.float64)
+        target['min_xyz'] = np.load(os.path.join(preprocessed_target_path,
+                                                 f"cf_list_{cf_grid_spacing}_origin.npy")) - cf_grid_spacing / 2
+    else:
+        target['cf_list'] = np.load(os.path.join(preprocessed_target_path, f"cf_list.npy"))
+        cf_min_per_type_path = os.path.join(preprocessed_target_path, "cf_min_per_type.npy")
+        if os.path.isfile(cf_min_per_type_path):
+            target['cf_min_per_type'] = np.load(cf_min_per_type_path)
+        else:
+            target['cf_min_per_type'] = np.min(target['cf_list'], axis=(0, 1, 2)).astype(np.float64)
+        target['cell_width'] = np.load(os.path.join(preprocessed_target_path, 'index_cube_cell_width.npy'))
+        # The CF grid only covers the cells around the binding site, targets preprocessed before it was cropped
+        # cover the whole index cube grid
+        cf_list_min_xyz_path = os.path.join(preprocessed_target_path, 'cf_list_min_xyz.npy')
+        if os.path.isfile(cf_list_min_xyz_path):
+            target['min_xyz'] = np.load(cf_list_min_xyz_path)
+        else:
+            target['min_xyz'] = np.load(os.path.join(preprocessed_target_path, 'index_cube_min_xyz.npy'))
+    target['cf_size_list'] = np.array(target['cf_list'].shape[:3])
+
+    if use_clash:
+        target['load_range_list'] = np.load(os.path.join(preprocessed_target_path,
+                                                         "bd_site_cuboid_coord_range_array.npy"))
+        target['clash_list'] = np.load(os.path.join(preprocessed_target_path,
+                                                    f"clash_list_{clash_dot_distance}.npy"))
+    else:
+        # Placeholders so the kernels are compiled with the same argument types with or without clashes
+        target['load_range_list'] = np.zeros((3, 2), dtype=np.float64)
+        target['clash_list'] = np.zeros((1, 1, 1), dtype=np.bool_)
+    target['clash_list_size'] = target['clash_list'].shape
+
+    if coarse_test_dot_separation is not None:
+        coarse_grid_path = os.path.join(preprocessed_target_path,
+                                        f"ligand_test_dots_{coarse_test_dot_separation}.npy")
+        if not os.path.isfile(coarse_grid_path):
+            raise FileNotFoundError(f'{coarse_grid_path} does not exist. Preprocess the target with '
+                                    f'COARSE_TEST_DOT_SEPARATION={coarse_test_dot_separation}')
+        target['coarse_grid'] = np.load(coarse_grid_path)
+    else:
+        target['coarse_grid'] = np.zeros((0, 3), dtype=np.float64)
+    return target
+
+
+def load_target_from_params(preprocessed_target_path, params_dict):
+    coarse_test_dot_separation = None
+    if params_dict['SEARCH_MODE'] == 'coarse_to_fine':
+        coarse_test_dot_separation = params_dict['COARSE_TEST_DOT_SEPARATION']
+    return load_target(preprocessed_target_path, params_dict['LIGAND_TEST_DOT_SEPARATION'],
+                       params_dict['USE_CLASH'], params_dict['CLASH_DOT_DISTANCE'], coarse_test_dot_separation,
+                       params_dict['CF_GRID_SPACING'], params_dict['CF_INTERPOLATION'])
+
+
+def score_ligands(target, atom_xyz, atom_type, atom_offsets, rotation_matrices, coarse_rotation_matrices, params_dict,
+                  default_cf=100000000, save_time=False, group_offsets=None, use_group_threshold=False):
+    """ Scores every ligand of a flat ligand store against a target loaded with load_target.
+    Ligands i of a group (group_offsets[g] <= i < group_offsets[g+1]) are scored one after the other. With
+    use_group_threshold only poses better than the best pose of the group so far are kept, the other ligands of the
+    group then return that best CF with -1 as indices.
+    Returns the kept poses of every ligand (n_ligands, poses_kept, 3), the refined dots per ligand, the time spent
+    per ligand (zeros unless save_time is True) and the pose counts per ligand (n_ligands, len(pose_count_names))
+    with the time spent rotating and scoring. Batches rotate inside the scoring kernel so their rotation time is
+    part of the scoring time"""
+    n_ligands = len(atom_offsets) - 1
+    if group_offsets is None:
+        group_offsets = np.arange(n_ligands + 1, dtype=np.int64)
+    n_groups = len(group_offsets) - 1
+    poses_kept = max(params_dict['POSES_SAVED_PER_MOLECULE'], 1)
+    batch_size = params_dict['BATCH_SIZE']
+    use_bound_pruning = params_dict['USE_BOUND_PRUNING']
+    search_mode = params_dict['SEARCH_MODE']
+    refine_distance = params_dict['COARSE_TEST_DOT_SEPARATION']
+    regions_kept = params_dict['COARSE_REGIONS_KEPT'] if search_mode == 'coarse_to_fine' else 0
+    use_clash = target['use_clash']
+    clash_dot_distance = target['clash_dot_distance']
+    top_poses_list = np.zeros((n_ligands, poses_kept, 3), dtype=np.float32)
+    refine_dot_counts = np.zeros(n_ligands, dtype=np.int64)
+    time_list = np.zeros(n_ligands, dtype=np.float32)
+    scoring_stats = {'pose counts': np.zeros((n_ligands, len(pose_count_names)), dtype=np.int64),
+                     'rotate time': 0.0, 'score time': 0.0}
+
+    if batch_size > 0:
+        if params_dict['NUMBA_THREADS']:
+            set_num_threads(params_dict['NUMBA_THREADS'])
+        group_start = 0
+        while group_start < n_groups:
+            # Batches hold about batch_size ligands and never split a group
+            group_end = np.searchsorted(group_offsets, group_offsets[group_start] + batch_size, side='right') - 1
+            group_end = min(max(group_end, group_start + 1), n_groups)
+            batch_start = group_offsets[group_start]
+            batch_end = group_offsets[group_end]
+            time_batch_start = timeit.default_timer()
+            top_poses_list[batch_start:batch_end], refine_dot_counts[batch_start:batch_end], \
+                scoring_stats['pose counts'][batch_start:batch_end] = get_cf_main_batch(
+                target['binding_site_grid'], rotation_matrices, atom_xyz, atom_type,
+                atom_offsets[batch_start:batch_end+1], poses_kept, target['cf_size_list'], target['cf_list'],
+                default_cf, target['cell_width'], target['min_xyz'], target['cf_interpolation'], use_clash,
+                target['load_range_list'], clash_dot_distance, target['clash_list'], target['clash_list_size'],
+                use_bound_pruning, target['cf_min_per_type'], target['coarse_grid'], coarse_rotation_matrices,
+                regions_kept, refine_distance, group_offsets[group_start:group_end+1], use_group_threshold)
+            scoring_stats['score time'] += timeit.default_timer() - time_batch_start
+            if save_time:
+                time_list[batch_start:batch_end] = (timeit.default_timer() - time_batch_start) / (batch_end - batch_start)
+            group_start = group_end
+    else:
+        for group_index in range(n_groups):
+            cf_threshold_init = np.inf
+            for i in range(group_offsets[group_index], group_offsets[group_index+1]):
+                time_molecule_start = timeit.default_timer()
+                molecule_atom_xyz = atom_xyz[atom_offsets[i]:atom_offsets[i+1]]
+                molecule_atom_types = atom_type[atom_offsets[i]:atom_offsets[i+1]]
+                molecule_rotations = rotate_ligand(molecule_atom_xyz, rotation_matrices)
+                if search_mode == 'coarse_to_fine':
+                    molecule_coarse_rotations = rotate_ligand(molecule_atom_xyz, coarse_rotation_matrices)
+                time_score_start = timeit.default_timer()
+                scoring_stats['rotate time'] += time_score_start - time_molecule_start
+                num_atoms = len(molecule_rotations[0])
+                if search_mode == 'coarse_to_fine':
+                    top_poses_list[i], refine_dot_counts[i] = get_cf_main_coarse_to_fine(
+                        target['binding_site_grid'], molecule_rotations, target['coarse_grid'],
+                        molecule_coarse_rotations, regions_kept, refine_distance, poses_kept, molecule_atom_types,
+                        num_atoms, target['cf_size_list'], target['cf_list'], default_cf, target['cell_width'],
+                        target['min_xyz'], target['cf_interpolation'], use_clash, target['load_range_list'],
+                        clash_dot_distance, target['clash_list'], target['clash_list_size'], use_bound_pruning,
+                        target['cf_min_per_type'], cf_threshold_init, scoring_stats['pose counts'][i])
+                else:
+                    top_poses_list[i] = score_ligand_orientations(
+                        target['binding_site_grid'], molecule_rotations, poses_kept, molecule_atom_types, num_atoms,
+                        target['cf_size_list'], target['cf_list'], default_cf, target['cell_width'], target['min_xyz'],
+                        target['cf_interpolation'], use_clash, target['load_range_list'], clash_dot_distance,
+                        target['clash_list'], target['clash_list_size'], use_bound_pruning, target['cf_min_per_type'],
+                        cf_threshold_init, scoring_stats['pose counts'][i])
+                scoring_stats['score time'] += timeit.default_timer() - time_score_start
+                if use_group_threshold:
+                    cf_threshold_init = min(cf_threshold_init, float(top_poses_list[i][0][0]))
+                if save_time:
+                    time_list[i] = timeit.default_timer() - time_molecule_start
+    return top_poses_list, refine_dot_counts, time_list, scoring_stats
+
+
+def get_molecule_pose_coords(pose_info_list, rotation_matrices, molecule_atom_xyz, binding_site_grid):
+    """ Returns the atom coordinates of all the poses of a molecule, shape (n_poses, n_atoms, 3)"""
+    pose_rotations = rotate_ligand(molecule_atom_xyz, rotation_matrices[pose_info_list[:, 1].astype(np.int64)])
+    return (pose_rotations + binding_site_grid[pose_info_list[:, 2].astype(np.int64)][:, None, :]).astype(np.float32)
+
+
+def write_molecule_poses(pose_info_list, rotation_matrices, molecule_atom_xyz, molecule_atom_types,
+                         molecule_atoms_names, molecule_name, binding_site_grid, ligand_pose_save_path, conf_num,
+                         poses_saved_per_molecule, unique_run_id, pose_writer=None, molecule_index=0):
+    pose_info_list = pose_info_list[pose_info_list[:, 1] >= 0]
+    if len(pose_info_list) == 0:
+        return
+    poses_xyz = get_molecule_pose_coords(pose_info_list, rotation_matrices, molecule_atom_xyz, binding_site_grid)
+    pose_file_names = [get_pose_file_name(molecule_name, conf_num, unique_run_id, poses_saved_per_molecule, pose_number)
+                       for pose_number in range(len(pose_info_list))]
+    if pose_writer is not None:
+        pose_writer.write(molecule_index, pose_file_names, pose_info_list[:, 0], molecule_atom_types, poses_xyz,
+                          molecule_atoms_names)
+        return
+    if poses_saved_per_molecule == 1:
+        molecule_save_folder = ligand_pose_save_path
+    else:
+        molecule_save_folder = os.path.join(ligand_pose_save_path, molecule_name)
+        if not os.path.isdir(molecule_save_folder):
+            os.makedirs(molecule_save_folder)
+    for pose_info, translated_coords, pose_file_name in zip(pose_info_list, poses_xyz, pose_file_names):
+        extra_info = [
+                      f"REMARK CF: {pose_info[0]:.2f}\n",
+                      f"REMARK atom types: "
+                      f"{np.array2string(molecule_atom_types, separator=' ',max_line_width=2000).strip('[]')}\n"
+        ]
+        if unique_run_id:
+            extra_info.append(f"REMARK unique_run_ID: {unique_run_id}\n")
+        write_pdb(translated_coords, pose_file_name, molecule_save_folder, molecule_atoms_names, extra_info)
+
+
+def get_pose_output_path(ligand_pose_save_path, pose_output_format):
+    if pose_output_format == 'multi_pdb':
+        return ligand_pose_save_path + '.pdb'
+    return ligand_pose_save_path + '_archive'
+
+
+checkpoint_dtype = np.dtype([('index', np.int64), ('cf', np.float32), ('refine_dots', np.int64), ('time', np.float32)])
+
+
+def get_checkpoint_paths(checkpoint_base_path):
+    return f"{checkpoint_base_path}_checkpoint.bin", f"{checkpoint_base_path}_checkpoint.json"
+
+
+def load_checkpoint(checkpoint_base_path, ligand_slice, molecule_count, best_conformer_only):
+    """ Returns the records saved by previous runs and the block size they were scored with, None without a
+    checkpoint. Records written after the last progress marker are dropped since they may be incomplete"""
+    records_path, marker_path = get_checkpoint_paths(checkpoint_base_path)
+    if not os.path.isfile(marker_path):
+        return np.zeros(0, dtype=checkpoint_dtype), None
+    with open(marker_path) as f:
+        marker = json.load(f)
+    if marker['ligand_slice'] != list(ligand_slice) or marker['molecule_count'] != molecule_count:
+        raise ValueError(f"The checkpoint in {marker_path} was made for ligand_slice {marker['ligand_slice']} with "
+                         f"{marker['molecule_count']} molecules, not {list(ligand_slice)} with {molecule_count}")
+    # Blocks end on conformer group boundaries with BEST_CONFORMER_ONLY, so it changes where they end
+    if marker.get('best_conformer_only', best_conformer_only) != best_conformer_only:
+        raise ValueError(f"The checkpoint in {marker_path} was made with BEST_CONFORMER_ONLY "
+                         f"{marker['best_conformer_only']}, not {best_conformer_only}")
+    os.truncate(records_path, marker['records'] * checkpoint_dtype.itemsize)
+    records = np.fromfile(records_path, dtype=checkpoint_dtype)
+    scored = np.zeros(molecule_count, dtype=np.bool_)
+    scored[records['index']] = True
+    if not np.all(scored[:np.count_nonzero(scored)]):
+        raise ValueError(f"The molecules in the checkpoint in {marker_path} are not the first molecules of the slice")
+    return records, marker.get('block_size')
+
+
+def append_checkpoint(checkpoint_base_path, records, ligand_slice, molecule_count, block_size, best_conformer_only):
+    """ Appends a block of records then replaces the progress marker so it only ever points to complete blocks. The
+    block size is recorded so a resumed run continues with the same blocks"""
+    records_path, marker_path = get_checkpoint_paths(checkpoint_base_path)
+    with open(records_path, 'ab') as f:
+        f.write(records.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+        record_count = f.tell() // checkpoint_dtype.itemsize
+    with open(marker_path + '.tmp', 'w') as f:
+        json.dump({'ligand_slice': list(ligand_slice), 'molecule_count': molecule_count, 'records': record_count,
+                   'block_size': block_size, 'best_conformer_only': best_conformer_only}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(marker_path + '.tmp', marker_path)
+
+
+def remove_checkpoint(checkpoint_base_path):
+    for path in get_checkpoint_paths(checkpoint_base_path):
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def get_conformer_group_offsets(molecule_name_cleaned):
+    """ Index of the first conformer of every molecule followed by the molecule count. Conformers of a molecule
+    follow each other and share the cleaned name"""
+    return np.array([0] + [i for i in range(1, len(molecule_name_cleaned))
+                           if molecule_name_cleaned[i] != molecule_name_cleaned[i-1]]
+                    + [len(molecule_name_cleaned)], dtype=np.int64)
+
+
+def get_result_file_extension(file_separator):
+    return {',': 'csv', '\t': 'tsv'}.get(file_separator, 'txt')
+
+
+def get_result_header(normalise_score, ligand_type, conf_num, save_time):
+    file_header = ["Name", "Score"]
+    if normalise_score:
+        file_header.append('Normalised score by atom count')
+    if ligand_type != 'ligand':
+        file_header.append('Type')
+    if conf_num > 1:
+        file_header.append("Conformer number")
+    if save_time:
+        file_header.append("Time")
+    return file_header
+
+
+def format_result_lines(molecule_names, scores, normalised_scores, ligand_type, conformer_numbers, times,
+                        file_separator):
+    """ Formats a block of results column by column. Optional columns are skipped when they are None. Scores of shape
+    (molecules, targets) give one score column per target"""
+    columns = [[f'"{molecule_name}"' for molecule_name in molecule_names]]
+    columns.extend(np.atleast_2d(scores.T).astype(str).tolist())
+    if normalised_scores is not None:
+        columns.append(normalised_scores.astype(str).tolist())
+    if ligand_type != 'ligand':
+        columns.append([ligand_type] * len(scores))
+    if conformer_numbers is not None:
+        columns.append(conformer_numbers)
+    if times is not None:
+        columns.append([f"{time:.3f}" for time in times])
+    return "".join(file_separator.join(row) + "\n" for row in zip(*columns))
+
+
+def save_result_columns(output_file_path, molecule_names, columns):
+    """ Saves the result columns as .npy files next to the result file so they can be loaded without parsing it"""
+    column_folder_path = os.path.splitext(output_file_path)[0] + '_columns'
+    if not os.path.isdir(column_folder_path):
+        os.makedirs(column_folder_path)
+    save_string_table(column_folder_path, 'name', molecule_names)
+    for column_name, column in columns.items():
+        np.save(os.path.join(column_folder_path, column_name), column)
+    return column_folder_path
+
+
+def get_compile_time(compile_events):
+    """ Sums the time of the numba compilations recorded by a RecordingListener. Kernels called by a kernel are
+    compiled during the compilation of the caller and are not counted twice"""
+    compile_time = 0.0
+    depth = 0
+    compile_start = 0.0
+    for timestamp, compile_event in compile_events:
+        if compile_event.is_start:
+            if depth == 0:
+                compile_start = timestamp
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                compile_time += timestamp - compile_start
+    return compile_time
+
+
+def get_pose_count_lines(pose_counts, prefix=''):
+    evaluated = max(pose_counts['evaluated'], 1)
+    lines = [f"REMARK {prefix}poses evaluated: {pose_counts['evaluated']}"]
+    for name in pose_count_names[1:]:
+        lines.append(f"REMARK {prefix}poses rejected, {name}: {pose_counts[name]} "
+                     f"({100 * pose_counts[name] / evaluated:.1f}%)")
+    return lines
+
+
+def get_stats_lines(stats):
+    lines = get_pose_count_lines(stats['pose counts'])
+    for stage, stage_time in stats['stage times'].items():
+        lines.append(f"REMARK time {stage}: {stage_time:.3f} seconds")
+    lines.append(f"REMARK jit compile time: {stats['compile time']:.3f} seconds")
+    return lines
+
+
+def get_search_agreement_lines(search_cfs, exhaustive_cfs):
+    search_scores = np.rint(search_cfs)
+    exhaustive_scores = np.rint(exhaustive_cfs)
+    identical = np.count_nonzero(search_scores == exhaustive_scores)
+    if len(search_scores) > 1:
+        rank_correlation = spearmanr(search_scores, exhaustive_scores)[0]
+    else:
+        rank_correlation = np.nan
+    return [f"REMARK coarse to fine scores identical to exhaustive: {identical}/{len(search_scores)}",
+            f"REMARK coarse to fine mean score difference to exhaustive: "
+            f"{np.mean(search_scores - exhaustive_scores):.1f}",
+            f"REMARK coarse to fine spearman correlation to exhaustive: {rank_correlation:.4f}"]
 
 
 def main(target_name, preprocessed_target_path, preprocessed_ligand_path, result_folder_path,
          result_csv_and_pose_name=None, ligand_type='ligand', ligand_slice=None, write_info=True, write_file=True,
          file_separator=',', output_header=True, output_dictionary=True, save_time=False, normalise_score=False,
-         unique_run_id=None, **user_config):
+         unique_run_id=None, return_stats=False, **user_config):
     """
 
     Parameters:
@@ -196,6 +926,8 @@ def main(target_name, preprocessed_target_path, preprocessed_ligand_path, result
         save_time (bool, optional): Save time taken per molecule for docking. Default is False.
         normalise_score (bool, optional): Normalise the docking score by the number of atoms in the molecule. Default is False.
         unique_run_id (str, optional): Unique identifier for the run to avoid file name conflictsand also used to name ligand poses. Default is None.
+        return_stats (bool, optional): Also return a dictionary with the pose counts of the scoring kernels, the time
+            spent in every stage and the numba compilation time. Default is False.
         **user_config: Arbitrary keyword arguments for overriding default docking parameters.
 
     Raises:
@@ -204,7 +936,7 @@ def main(target_name, preprocessed_target_path, preprocessed_ligand_path, result
         TypeError: If input parameter types are incorrect.
 
     Returns:
-        None
+        The path to the result file, the result dictionary and, with return_stats, the run statistics
 
     """
     if not write_file and not output_dictionary:
@@ -214,21 +946,8 @@ def main(target_name, preprocessed_target_path, preprocessed_ligand_path, result
     time_start = timeit.default_timer()
     default_cf = 100000000
     info_lines = []
-    output_lines = []
 
-    params_dict_default = {
-        'USE_CLASH': True,
-        'LIGAND_ROTATIONS_PER_AXIS': 9,
-        'LIGAND_TEST_DOT_SEPARATION': 1.5,
-        'CLASH_DOT_DISTANCE': 0.25,
-        'CONFORMERS_PER_MOLECULE': 1,
-        'POSES_SAVED_PER_MOLECULE': 1,
-        'WRITE_LIGAND_TEST_DOTS': False,
-        'VERBOSE': False,
-        'SAVE_TOTAL_TIME': False
-    }
-    params_dict = params_dict_default.copy()
-    params_dict.update(user_config)
+    params_dict = get_params_dict(user_config)
 
     test_dot_separation = params_dict['LIGAND_TEST_DOT_SEPARATION']
     conf_num = params_dict['CONFORMERS_PER_MOLECULE']
@@ -239,15 +958,16 @@ def main(target_name, preprocessed_target_path, preprocessed_ligand_path, result
     ligand_rotations_per_axis = params_dict["LIGAND_ROTATIONS_PER_AXIS"]
     clash_dot_distance = params_dict["CLASH_DOT_DISTANCE"]
     write_ligand_test_dots = params_dict["WRITE_LIGAND_TEST_DOTS"]
+    batch_size = params_dict["BATCH_SIZE"]
+    use_bound_pruning = params_dict["USE_BOUND_PRUNING"]
+    search_mode = params_dict["SEARCH_MODE"]
+    coarse_test_dot_separation = params_dict["COARSE_TEST_DOT_SEPARATION"]
+    report_search_agreement = params_dict["REPORT_SEARCH_AGREEMENT"] and search_mode == 'coarse_to_fine'
     if not result_csv_and_pose_name:
         ligand_pose_save_path = os.path.join(result_folder_path, 'ligand_poses')
     else:
         ligand_pose_save_path = os.path.join(result_folder_path, result_csv_and_pose_name)
 
-    if not os.path.exists(preprocessed_target_path):
-        raise FileNotFoundError(f'{preprocessed_target_path} does not exist')
-    if not os.path.isdir(preprocessed_target_path):
-        raise IsADirectoryError(f'{preprocessed_target_path} is not directory, expected a directory')
     if not os.path.exists(preprocessed_ligand_path):
         raise FileNotFoundError(f'{preprocessed_ligand_path} does not exist')
     if not os.path.isdir(preprocessed_ligand_path):
@@ -259,181 +979,279 @@ def main(target_name, preprocessed_target_path, preprocessed_ligand_path, result
         ligand_slice = [0, None]
     start = ligand_slice[0]
     end = ligand_slice[1]
+    ligand_batches = get_ligand_batches(preprocessed_ligand_path, ligand_type, params_dict['LIGAND_BATCHES'])
     if result_csv_and_pose_name:
         output_file_basename = result_csv_and_pose_name
     else:
         output_file_basename = target_name
         if conf_num > 1:
             output_file_basename += f"_{conf_num}_conf"
+        if ligand_batches is not None:
+            output_file_basename += f"_batch_{'_'.join(str(batch) for batch in ligand_batches)}"
         if end:
             output_file_basename += f"_split_{start}_{end}"
         if unique_run_id:
             output_file_basename += f"_run_{unique_run_id}"
-    if file_separator == ',':
-        output_file_path = os.path.join(result_folder_path, f'{output_file_basename}.csv')
-    elif file_separator == '\t':
-        output_file_path = os.path.join(result_folder_path, f'{output_file_basename}.tsv')
-    else:
-        output_file_path = os.path.join(result_folder_path, f'{output_file_basename}.txt')
+    output_file_path = os.path.join(result_folder_path,
+                                    f'{output_file_basename}.{get_result_file_extension(file_separator)}')
+    checkpoint_interval = params_dict["CHECKPOINT_INTERVAL"]
+    best_conformer_only = params_dict["BEST_CONFORMER_ONLY"]
+    pose_output_format = params_dict["POSE_OUTPUT_FORMAT"]
+    resume = params_dict["RESUME"]
+    checkpoint_base_path = os.path.join(result_folder_path, output_file_basename)
     counter = 1
     duplicate_file = False
-    while os.path.isfile(output_file_path):
+    # A resumed run writes to the same files as the run it continues
+    while os.path.isfile(output_file_path) and not resume:
         counter += 1
-        output_file_path = os.path.join(result_folder_path, f'{output_file_basename}_({counter}).csv')
+        output_file_path = os.path.join(result_folder_path,
+                                        f'{output_file_basename}_({counter}).{get_result_file_extension(file_separator)}')
         duplicate_file = True
     if duplicate_file:
         ligand_pose_save_path += f"_({counter})"
 
-    binding_site_grid = np.load(os.path.join(preprocessed_target_path, f"ligand_test_dots_{test_dot_separation}.npy"))
-    precalculated_cf_list = np.load(os.path.join(preprocessed_target_path, f"cf_list.npy"))
-
-    if use_clash:
-        load_range_list = np.load(os.path.join(preprocessed_target_path, "bd_site_cuboid_coord_range_array.npy"))
-        clash_list = np.load(os.path.join(preprocessed_target_path, f"clash_list_{clash_dot_distance}.npy"))
-        clash_list_size = clash_list.shape
+    stage_times = {stage: 0.0 for stage in ('load target', 'load ligands', 'rotate', 'score', 'write poses',
+                                            'write results')}
+    stage_start = timeit.default_timer()
+    target = load_target_from_params(preprocessed_target_path, params_dict)
+    stage_times['load target'] = timeit.default_timer() - stage_start
+    binding_site_grid = target['binding_site_grid']
+    if search_mode == 'coarse_to_fine':
+        coarse_rotation_matrices = get_rotation_matrices(params_dict["COARSE_ROTATIONS_PER_AXIS"])
+        regions_kept = params_dict["COARSE_REGIONS_KEPT"]
     else:
-        load_range_list = None
-        clash_list = None
-        clash_list_size = None
+        coarse_rotation_matrices = np.zeros((0, 3, 3), dtype=np.float64)
+        regions_kept = 0
 
     if write_ligand_test_dots:
         write_pdb(binding_site_grid, "ligand_test_dots", ligand_pose_save_path, None, None)
-    n_cf_evals = len(binding_site_grid) * ligand_rotations_per_axis**3
-    atom_name_array, atom_type_array, atom_xyz_array, molecule_name_array, atoms_per_molecule_array, molecule_count_array \
-        = load_ligands(preprocessed_target_path, ligand_type, start, end, conf_num, path_to_ligands=preprocessed_ligand_path)
-    cfs_list_by_ligand = np.zeros(molecule_count_array, dtype=np.float32)
-    if save_time:
-        time_list = np.zeros(molecule_count_array, dtype=np.float32)
-
-    cell_width = np.load(os.path.join(preprocessed_target_path, 'index_cube_cell_width.npy'))
-    cf_size_list = np.array([np.size(precalculated_cf_list, axis=0), np.size(precalculated_cf_list, axis=1), np.size(precalculated_cf_list, axis=2)])
+    rotation_matrices = get_rotation_matrices(ligand_rotations_per_axis)
+    n_cf_evals = len(binding_site_grid) * len(rotation_matrices)
+    stage_start = timeit.default_timer()
+    atom_name_array, atom_type_array, atom_xyz_array, atom_offsets, molecule_name_array, atoms_per_molecule_array, \
+        molecule_count_array \
+        = load_ligands(preprocessed_target_path, ligand_type, start, end, conf_num, path_to_ligands=preprocessed_ligand_path,
+                       batches=ligand_batches)
+    stage_times['load ligands'] = timeit.default_timer() - stage_start
+    cell_width = target['cell_width']
 
     info_lines.append(f"REMARK target folder: {preprocessed_target_path}")
     info_lines.append(f"REMARK software: {os.path.basename(__file__)}")
     info_lines.append(f"REMARK ligand type: {ligand_type}")
+    if ligand_batches is not None:
+        info_lines.append(f"REMARK ligand batches: {ligand_batches}")
     info_lines.append(f"REMARK number of conformers: {conf_num}")
     info_lines.append(f"REMARK rotations per axis: {ligand_rotations_per_axis}")
+    info_lines.append(f"REMARK unique rotations: {len(rotation_matrices)}")
     info_lines.append(f"REMARK dot separation: {test_dot_separation} A")
     info_lines.append(f"REMARK preloaded grid distance: {clash_dot_distance} A")
     info_lines.append(f"REMARK Total binding site grid dots: {len(binding_site_grid)}")
     info_lines.append(f"REMARK Total CF evaluations per ligand: {n_cf_evals}")
     info_lines.append(f"REMARK use clash: {use_clash}")
-    info_lines.append(f"REMARK index cube width: {cell_width}")
+    if batch_size > 0:
+        info_lines.append(f"REMARK batch size: {batch_size}")
+    if use_bound_pruning:
+        info_lines.append(f"REMARK bound pruning: {use_bound_pruning}")
+    if best_conformer_only:
+        info_lines.append(f"REMARK best conformer only: {best_conformer_only}")
+    if pose_output_format != 'pdb':
+        info_lines.append(f"REMARK pose output format: {pose_output_format}")
+    if search_mode == 'coarse_to_fine':
+        info_lines.append(f"REMARK search mode: {search_mode}")
+        info_lines.append(f"REMARK coarse dot separation: {coarse_test_dot_separation} A")
+        info_lines.append(f"REMARK coarse unique rotations: {len(coarse_rotation_matrices)}")
+        info_lines.append(f"REMARK coarse regions kept: {regions_kept}")
+        info_lines.append(f"REMARK Total coarse binding site grid dots: {len(target['coarse_grid'])}")
+    if target['cf_grid_spacing'] is not None:
+        info_lines.append(f"REMARK CF grid spacing: {target['cf_grid_spacing']} A")
+    else:
+        info_lines.append(f"REMARK index cube width: {cell_width}")
+    if target['cf_interpolation']:
+        info_lines.append(f"REMARK CF interpolation: {target['cf_interpolation']}")
 
     if params_dict['VERBOSE']:
         print("\n".join(info_lines))
-    min_xyz = np.load(os.path.join(preprocessed_target_path, 'index_cube_min_xyz.npy'))
-
-    for i, molecule in enumerate(atoms_per_molecule_array):
-        time_molecule_start = timeit.default_timer()
-        molecule_atom_count = atoms_per_molecule_array[i]
-        molecule_atom_xyz = atom_xyz_array[i][0:molecule_atom_count]
-        molecule_atom_types = atom_type_array[i][0:molecule_atom_count]
-        molecule_rotations = rotate_ligand(molecule_atom_xyz, ligand_rotations_per_axis)
-        num_atoms = len(molecule_rotations[0])
-        if not use_clash:
-            cfs_list = get_cf_main(binding_site_grid, molecule_rotations, cf_size_list, n_cf_evals, precalculated_cf_list,
-                                   molecule_atom_types, default_cf, cell_width, min_xyz)
-        else:
-            cfs_list = get_cf_main_clash(binding_site_grid, molecule_rotations, cf_size_list, n_cf_evals,
-                                         precalculated_cf_list, molecule_atom_types, default_cf, cell_width, min_xyz,
-                                         load_range_list, clash_dot_distance, clash_list,
-                                         clash_list_size, num_atoms)
-        cfs_list_by_ligand[i] = np.min(cfs_list[:, 0])
-        if poses_saved_per_molecule > 0:
-            sorted_indices = np.argsort(cfs_list[:, 0])[:poses_saved_per_molecule]
-            molecule_atoms_names = atom_name_array[i][0:molecule_atom_count]
-            if poses_saved_per_molecule == 1:
-                molecule_save_folder = ligand_pose_save_path
+    cfs_list_by_ligand = np.zeros(molecule_count_array, dtype=np.float32)
+    refine_dot_counts = np.zeros(molecule_count_array, dtype=np.int64)
+    time_list = np.zeros(molecule_count_array, dtype=np.float32)
+    scored = np.zeros(molecule_count_array, dtype=np.bool_)
+    block_size = checkpoint_interval if checkpoint_interval > 0 else params_dict['WRITE_INTERVAL']
+    if resume:
+        records, checkpoint_block_size = load_checkpoint(checkpoint_base_path, ligand_slice, molecule_count_array,
+                                                         best_conformer_only)
+        if checkpoint_block_size is not None and checkpoint_block_size != block_size:
+            # Molecules are only skipped by whole blocks and poses are kept up to the first molecule not scored, so
+            # the run goes on with the blocks of the checkpoint
+            print(f"Resuming with the block size of the checkpoint, {checkpoint_block_size}, instead of {block_size}")
+            block_size = checkpoint_block_size
+        cfs_list_by_ligand[records['index']] = records['cf']
+        refine_dot_counts[records['index']] = records['refine_dots']
+        time_list[records['index']] = records['time']
+        scored[records['index']] = True
+        info_lines.append(f"REMARK molecules restored from checkpoint: {np.count_nonzero(scored)}")
+    elif checkpoint_interval > 0:
+        remove_checkpoint(checkpoint_base_path)
+    molecule_name_cleaned = [molecule_name.rsplit('_', 1)[0] for molecule_name in molecule_name_array]
+    molecule_conformer_number = [molecule_name.rsplit('_', 1)[1] for molecule_name in molecule_name_array]
+    scores = np.zeros(molecule_count_array, dtype=np.int64)
+    normalised_score = np.zeros(molecule_count_array, dtype=np.int64)
+    # Results are written block by block as the molecules are scored
+    result_file = open(output_file_path, "w") if write_file else None
+    if result_file and output_header:
+        result_file.write(file_separator.join(get_result_header(normalise_score, ligand_type, conf_num, save_time))
+                          + "\n")
+    if best_conformer_only:
+        group_offsets = get_conformer_group_offsets(molecule_name_cleaned)
+        # The best score of the molecule so far prunes the poses of its next conformers
+        score_params_dict = {**params_dict, 'USE_BOUND_PRUNING': True}
+    else:
+        group_offsets = np.arange(molecule_count_array + 1, dtype=np.int64)
+        score_params_dict = params_dict
+    use_group_threshold = best_conformer_only and poses_saved_per_molecule <= 1
+    block_bounds = [0]
+    while block_bounds[-1] < molecule_count_array:
+        # Blocks end on a group boundary so the conformers of a molecule are never split
+        block_bounds.append(int(group_offsets[min(np.searchsorted(group_offsets, block_bounds[-1] + block_size),
+                                                  len(group_offsets) - 1)]))
+    # Molecule reported on each result row: every molecule, or the best conformer of each molecule
+    row_indices = []
+    row_times = []
+    pose_counts = np.zeros(len(pose_count_names), dtype=np.int64)
+    compile_events = event.RecordingListener()
+    event.register('numba:compile', compile_events)
+    pose_writer = None
+    if poses_saved_per_molecule > 0 and pose_output_format != 'pdb':
+        # Molecules are checkpointed in order, so the poses written after the last checkpoint are dropped on resume
+        pose_writer = PoseWriter(get_pose_output_path(ligand_pose_save_path, pose_output_format), pose_output_format,
+                                 resume_from=int(np.count_nonzero(scored)) if resume else None)
+    try:
+        for block_start, block_end in zip(block_bounds[:-1], block_bounds[1:]):
+            block_group_offsets = group_offsets[(group_offsets >= block_start) & (group_offsets <= block_end)]
+            if not np.all(scored[block_start:block_end]):
+                top_poses_list, refine_dot_counts[block_start:block_end], time_list[block_start:block_end], \
+                    scoring_stats = score_ligands(target, atom_xyz_array, atom_type_array,
+                                                  atom_offsets[block_start:block_end+1], rotation_matrices,
+                                                  coarse_rotation_matrices, score_params_dict, default_cf, save_time,
+                                                  block_group_offsets - block_start, use_group_threshold)
+                cfs_list_by_ligand[block_start:block_end] = top_poses_list[:, 0, 0]
+                pose_counts += scoring_stats['pose counts'].sum(axis=0)
+                stage_times['rotate'] += scoring_stats['rotate time']
+                stage_times['score'] += scoring_stats['score time']
+            if best_conformer_only:
+                block_rows = np.array([group_start + np.argmin(cfs_list_by_ligand[group_start:group_end])
+                                       for group_start, group_end in zip(block_group_offsets[:-1],
+                                                                         block_group_offsets[1:])], dtype=np.int64)
+                block_times = np.add.reduceat(time_list[block_start:block_end], block_group_offsets[:-1] - block_start)
             else:
-                molecule_save_folder = os.path.join(ligand_pose_save_path, molecule_name_array[i])
-                if not os.path.isdir(molecule_save_folder):
-                    os.makedirs(molecule_save_folder)
-            for pose_number in range(0, poses_saved_per_molecule, 1):
-                pose_index = sorted_indices[pose_number]
-                pose_info = cfs_list[pose_index]
-                pose_rotation_number = int(pose_info[1])
-                translated_coords = np.zeros((len(molecule_rotations[pose_rotation_number]), 3), dtype=np.float32)
-                for atom in range(len(molecule_rotations[pose_rotation_number])):
-                    translated_coords[atom] = np.add(molecule_rotations[pose_rotation_number][atom],
-                                                     binding_site_grid[int(pose_info[2])])
-                pose_file_name = molecule_name_array[i]
-                if conf_num == 1:
-                    if pose_file_name.endswith('0'):
-                        pose_file_name = pose_file_name.rsplit('_', 1)[0]
-                pose_file_name += f'_{unique_run_id}'
-                if poses_saved_per_molecule != 1:
-                    pose_file_name += f'_pose_{pose_number+1}'
-                extra_info = [
-                              f"REMARK CF: {cfs_list[sorted_indices[pose_number]][0]:.2f}\n",
-                              f"REMARK atom types: "
-                              f"{np.array2string(molecule_atom_types, separator=' ',max_line_width=2000).strip('[]')}\n"
-                ]
-                if unique_run_id:
-                    extra_info.append(f"REMARK unique_run_ID: {unique_run_id}\n")
-                write_pdb(translated_coords, pose_file_name, molecule_save_folder, molecule_atoms_names, extra_info)
-        if save_time:
-            time_list[i] = timeit.default_timer() - time_molecule_start
+                block_rows = np.arange(block_start, block_end)
+                block_times = time_list[block_start:block_end]
+            if not np.all(scored[block_start:block_end]):
+                stage_start = timeit.default_timer()
+                if poses_saved_per_molecule > 0:
+                    for i in block_rows:
+                        write_molecule_poses(top_poses_list[i-block_start], rotation_matrices,
+                                             atom_xyz_array[atom_offsets[i]:atom_offsets[i+1]],
+                                             atom_type_array[atom_offsets[i]:atom_offsets[i+1]], atom_name_array[i],
+                                             molecule_name_array[i], binding_site_grid, ligand_pose_save_path,
+                                             conf_num, poses_saved_per_molecule, unique_run_id, pose_writer, i)
+                    if pose_writer:
+                        pose_writer.flush()
+                stage_times['write poses'] += timeit.default_timer() - stage_start
+                if checkpoint_interval > 0:
+                    records = np.zeros(block_end - block_start, dtype=checkpoint_dtype)
+                    records['index'] = np.arange(block_start, block_end)
+                    records['cf'] = cfs_list_by_ligand[block_start:block_end]
+                    records['refine_dots'] = refine_dot_counts[block_start:block_end]
+                    records['time'] = time_list[block_start:block_end]
+                    append_checkpoint(checkpoint_base_path, records, ligand_slice, molecule_count_array, block_size,
+                                      best_conformer_only)
+            scores[block_start:block_end] = np.rint(cfs_list_by_ligand[block_start:block_end])
+            normalised_score[block_start:block_end] = np.rint(
+                scores[block_start:block_end] / atoms_per_molecule_array[block_start:block_end])
+            row_indices.append(block_rows)
+            row_times.append(block_times)
+            stage_start = timeit.default_timer()
+            if result_file or params_dict['VERBOSE']:
+                result_lines = format_result_lines(
+                    [molecule_name_cleaned[i] for i in block_rows], scores[block_rows],
+                    normalised_score[block_rows] if normalise_score else None, ligand_type,
+                    [molecule_conformer_number[i] for i in block_rows] if conf_num > 1 else None,
+                    block_times if save_time else None, file_separator)
+                if result_file:
+                    result_file.write(result_lines)
+                    result_file.flush()
+                if params_dict['VERBOSE']:
+                    print(result_lines, end="")
+            stage_times['write results'] += timeit.default_timer() - stage_start
+    finally:
+        event.unregister('numba:compile', compile_events)
+        if result_file:
+            result_file.close()
+        if pose_writer:
+            pose_writer.close()
+    row_indices = np.concatenate(row_indices) if row_indices else np.zeros(0, dtype=np.int64)
+    row_times = np.concatenate(row_times) if row_times else np.zeros(0, dtype=np.float32)
 
+    if search_mode == 'coarse_to_fine':
+        info_lines.append(f"REMARK mean refined dots per ligand: {np.mean(refine_dot_counts):.1f}")
+    if report_search_agreement:
+        exhaustive_cfs_list_by_ligand = np.zeros(molecule_count_array, dtype=np.float32)
+        for i, molecule_atom_count in enumerate(atoms_per_molecule_array):
+            exhaustive_cfs_list_by_ligand[i] = score_ligand_orientations(
+                binding_site_grid, rotate_ligand(atom_xyz_array[atom_offsets[i]:atom_offsets[i+1]], rotation_matrices),
+                1, atom_type_array[atom_offsets[i]:atom_offsets[i+1]], molecule_atom_count, target['cf_size_list'],
+                target['cf_list'], default_cf, cell_width, target['min_xyz'], target['cf_interpolation'], use_clash,
+                target['load_range_list'], clash_dot_distance, target['clash_list'], target['clash_list_size'],
+                use_bound_pruning, target['cf_min_per_type'], np.inf,
+                np.zeros(len(pose_count_names), dtype=np.int64))[0][0]
+        if best_conformer_only:
+            exhaustive_cfs_list_by_ligand = np.minimum.reduceat(exhaustive_cfs_list_by_ligand, group_offsets[:-1])
+        info_lines.extend(get_search_agreement_lines(cfs_list_by_ligand[row_indices], exhaustive_cfs_list_by_ligand))
+        if params_dict['VERBOSE']:
+            print("\n".join(info_lines[-3:]))
+
+    stats = {'pose counts': dict(zip(pose_count_names, pose_counts.tolist())),
+             'stage times': stage_times,
+             'compile time': get_compile_time(compile_events.buffer)}
+    if params_dict['WRITE_STATS']:
+        info_lines.extend(get_stats_lines(stats))
+        if params_dict['VERBOSE']:
+            print("\n".join(get_stats_lines(stats)))
     if params_dict['SAVE_TOTAL_TIME']:
         info_lines.append(f"REMARK total screen time: {timeit.default_timer() - time_start:.3f} seconds")
         if params_dict['VERBOSE']:
-            print(output_lines[-1])
-    molecule_name_cleaned = [molecule_name.rsplit('_', 1)[0] for molecule_name in molecule_name_array]
-    molecule_conformer_number = [molecule_name.rsplit('_', 1)[1] for molecule_name in molecule_name_array]
-    cfs_list_by_ligand = np.rint(cfs_list_by_ligand).astype(np.int64)
-    if normalise_score:
-        normalised_score = np.rint(cfs_list_by_ligand/atoms_per_molecule_array).astype(np.int64)
+            print(info_lines[-1])
     if write_info:
         info_file_path = os.path.splitext(output_file_path)[0] + f'_info.txt'
         with open(info_file_path, "w") as f:
             f.writelines("\n".join(info_lines))
-    if write_file:
-        file_header = "Name,Score"
+    row_names = [molecule_name_cleaned[i] for i in row_indices]
+    row_conformer_numbers = [molecule_conformer_number[i] for i in row_indices]
+    if params_dict['COLUMNAR_OUTPUT']:
+        columns = {'score': scores[row_indices]}
         if normalise_score:
-            file_header += ',Normalised score by atom count'
-        if ligand_type != 'ligand':
-            file_header += ',Type'
+            columns['normalised_score'] = normalised_score[row_indices]
         if conf_num > 1:
-            file_header += ",Conformer number"
+            columns['conformer_number'] = np.array(row_conformer_numbers, dtype=np.int32)
         if save_time:
-            file_header += ",Time"
-        if not write_file:
-            file_header += ",Binding site"
-        if output_header:
-            output_lines.append(file_header)
-        for z, ligand in enumerate(atoms_per_molecule_array):
-            output = f'"{molecule_name_cleaned[z]}",{cfs_list_by_ligand[z]}'
-            if normalise_score:
-                output += f',{normalised_score[z]}'
-            if ligand_type != 'ligand':
-                output += f',{ligand_type}'
-            if conf_num > 1:
-                output += f",{molecule_conformer_number[z]}"
-            if save_time:
-                output += f",{time_list[z]:.3f}"
-            if not write_file:
-                output += f",{target_name}"
-            output_lines.append(output)
-        if file_separator != ',':
-            output_lines = [line.replace(',', file_separator) for line in output_lines]
-        if write_file:
-            with open(output_file_path, "w") as f:
-                f.writelines("\n".join(output_lines))
-                f.write("\n")
-    else:
+            columns['time'] = row_times
+        save_result_columns(output_file_path, row_names, columns)
+    if not write_file:
         output_file_path = None
-    if params_dict['VERBOSE']:
-        print("\n".join(output_lines))
     if output_dictionary:
-        output_dictionary = {'Names': molecule_name_cleaned, 'Score': cfs_list_by_ligand, 'Type': ligand_type,
+        output_dictionary = {'Names': row_names, 'Score': scores[row_indices], 'Type': ligand_type,
                              'Binding site': target_name}
         if normalise_score:
-            output_dictionary['Normalised score by atom count'] = normalised_score
+            output_dictionary['Normalised score by atom count'] = normalised_score[row_indices]
         if conf_num > 1:
-            output_dictionary['Conformer number'] = molecule_conformer_number
+            output_dictionary['Conformer number'] = row_conformer_numbers
         if save_time:
-            output_dictionary['Time'] = time_list
+            output_dictionary['Time'] = row_times
     else:
         output_dictionary = None
+    if checkpoint_interval > 0 or resume:
+        remove_checkpoint(checkpoint_base_path)
+    if return_stats:
+        stats['stage times']['total'] = timeit.default_timer() - time_start
+        return output_file_path, output_dictionary, stats
     return output_file_path, output_dictionary
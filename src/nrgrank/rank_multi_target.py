@@ -0,0 +1,255 @@
+import os
+import timeit
+import numpy as np
+from numba import njit, prange, set_num_threads
+from numba.typed import List
+from nrgrank.pose_writer import PoseWriter
+from nrgrank.rank_molecules import get_params_dict, load_target_from_params, load_ligands, get_ligand_batches, \
+    get_rotation_matrices, center_coords, apply_rotations, score_ligand_orientations, get_cf_main_coarse_to_fine, \
+    write_molecule_poses, get_pose_output_path, pose_count_names, get_pose_count_lines, get_result_file_extension, \
+    format_result_lines
+
+
+def pack_targets(targets):
+    """ Groups the arrays of several targets loaded with load_target so they can be passed to one kernel.
+    Arrays of different shapes go in typed lists, the others are stacked"""
+    # A typed list holds one dtype, targets preprocessed before the CF grid was stored as float32 are float64
+    cf_dtype = np.result_type(*[target['cf_list'] for target in targets])
+    packed = {'binding_site_grid': List([target['binding_site_grid'] for target in targets]),
+              'cf_list': List([target['cf_list'].astype(cf_dtype, copy=False) for target in targets]),
+              'clash_list': List([target['clash_list'] for target in targets]),
+              'coarse_grid': List([target['coarse_grid'] for target in targets]),
+              'cf_size_list': np.array([target['cf_size_list'] for target in targets], dtype=np.int64),
+              'clash_list_size': np.array([target['clash_list_size'] for target in targets], dtype=np.int64),
+              'cell_width': np.array([target['cell_width'] for target in targets], dtype=np.float64),
+              'min_xyz': np.array([target['min_xyz'] for target in targets], dtype=np.float64),
+              'load_range_list': np.array([target['load_range_list'] for target in targets], dtype=np.float64),
+              'cf_min_per_type': np.array([target['cf_min_per_type'] for target in targets], dtype=np.float64)}
+    return packed
+
+
+@njit(parallel=True, cache=True)
+def get_cf_main_multi_target(binding_site_grids, rotation_matrices, atom_xyz, atom_type, atom_offsets, poses_kept,
+                             cf_size_lists, cf_lists, default_cf, cell_widths, min_xyzs, cf_interpolation, use_clash,
+                             load_range_lists, preload_grid_distance, clash_lists, clash_list_sizes, use_bound_pruning,
+                             cf_min_per_types, coarse_grids, coarse_rotation_matrices, regions_kept, refine_distance):
+    n_ligands = len(atom_offsets) - 1
+    n_targets = len(cf_lists)
+    top_poses_list = np.zeros((n_ligands, n_targets, poses_kept, 3), dtype=np.float32)
+    pose_counts = np.zeros((n_ligands, n_targets, len(pose_count_names)), dtype=np.int64)
+    for ligand_index in prange(n_ligands):
+        atom_start = atom_offsets[ligand_index]
+        atom_end = atom_offsets[ligand_index+1]
+        num_atoms = atom_end - atom_start
+        ligand_atoms_types = atom_type[atom_start:atom_end]
+        centered_coords = center_coords(atom_xyz[atom_start:atom_end], num_atoms)
+        # The rotations are computed once and reused for every target
+        ligand_orientations = apply_rotations(centered_coords, rotation_matrices)
+        coarse_orientations = apply_rotations(centered_coords, coarse_rotation_matrices)
+        for target_index in range(n_targets):
+            if regions_kept > 0:
+                top_poses_list[ligand_index, target_index] = get_cf_main_coarse_to_fine(
+                    binding_site_grids[target_index], ligand_orientations, coarse_grids[target_index],
+                    coarse_orientations, regions_kept, refine_distance, poses_kept, ligand_atoms_types, num_atoms,
+                    cf_size_lists[target_index], cf_lists[target_index], default_cf, cell_widths[target_index],
+                    min_xyzs[target_index], cf_interpolation, use_clash, load_range_lists[target_index],
+                    preload_grid_distance, clash_lists[target_index], clash_list_sizes[target_index], use_bound_pruning,
+                    cf_min_per_types[target_index], np.inf, pose_counts[ligand_index, target_index])[0]
+            else:
+                top_poses_list[ligand_index, target_index] = score_ligand_orientations(
+                    binding_site_grids[target_index], ligand_orientations, poses_kept, ligand_atoms_types, num_atoms,
+                    cf_size_lists[target_index], cf_lists[target_index], default_cf, cell_widths[target_index],
+                    min_xyzs[target_index], cf_interpolation, use_clash, load_range_lists[target_index],
+                    preload_grid_distance, clash_lists[target_index], clash_list_sizes[target_index], use_bound_pruning,
+                    cf_min_per_types[target_index], np.inf, pose_counts[ligand_index, target_index])
+    return top_poses_list, pose_counts
+
+
+def main(target_names, preprocessed_target_paths, preprocessed_ligand_path, result_folder_path,
+         result_csv_and_pose_name=None, ligand_type='ligand', ligand_slice=None, write_info=True, write_file=True,
+         file_separator=',', output_header=True, output_dictionary=True, unique_run_id=None, **user_config):
+    """
+    Scores one ligand library against several targets. Every ligand is loaded and rotated once and then scored
+    against all the targets.
+
+    Parameters:
+        target_names (list[str]): Names of the targets. Used as score column names.
+        preprocessed_target_paths (list[str]): Paths to the preprocessed target folders from process_target().
+        preprocessed_ligand_path (str): Path to the preprocessed ligand folder from process_ligand().
+        result_folder_path (str): Directory path where the results will be stored.
+        result_csv_and_pose_name (str, optional): Custom name for CSV and pose files. Default is None.
+        ligand_type (str, optional): Type of ligand being processed (e.g., "ligand"). Default is 'ligand'.
+        ligand_slice (list[int] or None, optional): Slice range of ligands to process. Default is None.
+        write_info (bool, optional): Write informational remarks or not. Default is True.
+        write_file (bool, optional): Output a file or not. Default is True.
+        file_separator (str, optional): Separator character for file. Default is ','.
+        output_header (bool, optional): Flag to write header row in CSV file or not. Default is True.
+        output_dictionary (bool, optional): Output a dictionary or not. Default is True.
+        unique_run_id (str, optional): Unique identifier for the run to avoid file name conflicts. Default is None.
+        **user_config: Arbitrary keyword arguments for overriding default docking parameters.
+
+    Raises:
+        ValueError: If the number of target names and target paths differ.
+        TypeError: If neither write_file nor output_dictionary are set.
+
+    Returns:
+        The path to the result file and a dictionary with one score column per target
+    """
+    if not write_file and not output_dictionary:
+        raise TypeError("At least one of write_file or output_dictionary must be specified. "
+                        "Both can be True at the same time.")
+    if len(target_names) != len(preprocessed_target_paths):
+        raise ValueError(f"Got {len(target_names)} target names for {len(preprocessed_target_paths)} targets")
+
+    time_start = timeit.default_timer()
+    default_cf = 100000000
+    info_lines = []
+    params_dict = get_params_dict(user_config)
+    conf_num = params_dict['CONFORMERS_PER_MOLECULE']
+    if preprocessed_ligand_path.find('_conf') != -1:
+        conf_num = int(preprocessed_ligand_path.split('_conf')[0].split('_')[-1])
+    poses_saved_per_molecule = params_dict["POSES_SAVED_PER_MOLECULE"]
+    poses_kept = max(poses_saved_per_molecule, 1)
+    batch_size = params_dict["BATCH_SIZE"]
+    search_mode = params_dict["SEARCH_MODE"]
+    if params_dict["NUMBA_THREADS"]:
+        set_num_threads(params_dict["NUMBA_THREADS"])
+
+    if not os.path.isdir(preprocessed_ligand_path):
+        raise FileNotFoundError(f'{preprocessed_ligand_path} does not exist')
+    if not os.path.isdir(result_folder_path):
+        os.makedirs(result_folder_path)
+    if not ligand_slice:
+        ligand_slice = [0, None]
+    start, end = ligand_slice
+    ligand_batches = get_ligand_batches(preprocessed_ligand_path, ligand_type, params_dict['LIGAND_BATCHES'])
+    output_file_basename = result_csv_and_pose_name if result_csv_and_pose_name else 'multi_target'
+    if not result_csv_and_pose_name:
+        if conf_num > 1:
+            output_file_basename += f"_{conf_num}_conf"
+        if ligand_batches is not None:
+            output_file_basename += f"_batch_{'_'.join(str(batch) for batch in ligand_batches)}"
+        if end:
+            output_file_basename += f"_split_{start}_{end}"
+        if unique_run_id:
+            output_file_basename += f"_run_{unique_run_id}"
+    extension = get_result_file_extension(file_separator)
+    output_file_path = os.path.join(result_folder_path, f'{output_file_basename}.{extension}')
+    counter = 1
+    while os.path.isfile(output_file_path):
+        counter += 1
+        output_file_path = os.path.join(result_folder_path, f'{output_file_basename}_({counter}).{extension}')
+
+    targets = [load_target_from_params(preprocessed_target_path, params_dict)
+               for preprocessed_target_path in preprocessed_target_paths]
+    packed_targets = pack_targets(targets)
+    rotation_matrices = get_rotation_matrices(params_dict["LIGAND_ROTATIONS_PER_AXIS"])
+    if search_mode == 'coarse_to_fine':
+        coarse_rotation_matrices = get_rotation_matrices(params_dict["COARSE_ROTATIONS_PER_AXIS"])
+        regions_kept = params_dict["COARSE_REGIONS_KEPT"]
+    else:
+        coarse_rotation_matrices = np.zeros((0, 3, 3), dtype=np.float64)
+        regions_kept = 0
+    atom_name_array, atom_type_array, atom_xyz_array, atom_offsets, molecule_name_array, atoms_per_molecule_array, \
+        molecule_count = load_ligands(None, ligand_type, start, end, conf_num, path_to_ligands=preprocessed_ligand_path,
+                                      batches=ligand_batches)
+
+    info_lines.append(f"REMARK targets: {','.join(target_names)}")
+    info_lines.append(f"REMARK target folders: {','.join(preprocessed_target_paths)}")
+    info_lines.append(f"REMARK software: {os.path.basename(__file__)}")
+    info_lines.append(f"REMARK ligand type: {ligand_type}")
+    if ligand_batches is not None:
+        info_lines.append(f"REMARK ligand batches: {ligand_batches}")
+    info_lines.append(f"REMARK number of conformers: {conf_num}")
+    info_lines.append(f"REMARK unique rotations: {len(rotation_matrices)}")
+    info_lines.append(f"REMARK dot separation: {params_dict['LIGAND_TEST_DOT_SEPARATION']} A")
+    info_lines.append(f"REMARK use clash: {params_dict['USE_CLASH']}")
+    if search_mode == 'coarse_to_fine':
+        info_lines.append(f"REMARK search mode: {search_mode}")
+    if params_dict['VERBOSE']:
+        print("\n".join(info_lines))
+
+    molecule_name_cleaned = [molecule_name.rsplit('_', 1)[0] for molecule_name in molecule_name_array]
+    molecule_conformer_number = [molecule_name.rsplit('_', 1)[1] for molecule_name in molecule_name_array]
+    top_poses_list = np.zeros((molecule_count, len(targets), poses_kept, 3), dtype=np.float32)
+    scores = np.zeros((molecule_count, len(targets)), dtype=np.int64)
+    pose_counts = np.zeros((len(targets), len(pose_count_names)), dtype=np.int64)
+    if batch_size <= 0:
+        batch_size = max(molecule_count, 1)
+    # Results are written batch by batch as the molecules are scored
+    result_file = open(output_file_path, "w") if write_file else None
+    try:
+        if result_file and output_header:
+            file_header = ["Name"] + list(target_names)
+            if ligand_type != 'ligand':
+                file_header.append('Type')
+            if conf_num > 1:
+                file_header.append("Conformer number")
+            result_file.write(file_separator.join(file_header) + "\n")
+        for batch_start in range(0, molecule_count, batch_size):
+            batch_end = min(batch_start + batch_size, molecule_count)
+            top_poses_list[batch_start:batch_end], batch_pose_counts = get_cf_main_multi_target(
+                packed_targets['binding_site_grid'], rotation_matrices, atom_xyz_array, atom_type_array,
+                atom_offsets[batch_start:batch_end+1], poses_kept, packed_targets['cf_size_list'],
+                packed_targets['cf_list'], default_cf, packed_targets['cell_width'], packed_targets['min_xyz'],
+                params_dict['CF_INTERPOLATION'], params_dict['USE_CLASH'], packed_targets['load_range_list'],
+                params_dict['CLASH_DOT_DISTANCE'],
+                packed_targets['clash_list'], packed_targets['clash_list_size'], params_dict['USE_BOUND_PRUNING'],
+                packed_targets['cf_min_per_type'], packed_targets['coarse_grid'], coarse_rotation_matrices,
+                regions_kept, params_dict['COARSE_TEST_DOT_SEPARATION'])
+            pose_counts += batch_pose_counts.sum(axis=0)
+            scores[batch_start:batch_end] = np.rint(top_poses_list[batch_start:batch_end, :, 0, 0])
+            if result_file or params_dict['VERBOSE']:
+                result_lines = format_result_lines(
+                    molecule_name_cleaned[batch_start:batch_end], scores[batch_start:batch_end], None, ligand_type,
+                    molecule_conformer_number[batch_start:batch_end] if conf_num > 1 else None, None,
+                    file_separator)
+                if result_file:
+                    result_file.write(result_lines)
+                    result_file.flush()
+                if params_dict['VERBOSE']:
+                    print(result_lines, end="")
+    finally:
+        if result_file:
+            result_file.close()
+
+    if poses_saved_per_molecule > 0:
+        pose_output_format = params_dict["POSE_OUTPUT_FORMAT"]
+        for target_index, target_name in enumerate(target_names):
+            ligand_pose_save_path = os.path.join(result_folder_path, f"{output_file_basename}_{target_name}")
+            pose_writer = None
+            if pose_output_format != 'pdb':
+                pose_writer = PoseWriter(get_pose_output_path(ligand_pose_save_path, pose_output_format),
+                                         pose_output_format)
+            for i in range(molecule_count):
+                write_molecule_poses(top_poses_list[i, target_index], rotation_matrices,
+                                     atom_xyz_array[atom_offsets[i]:atom_offsets[i+1]],
+                                     atom_type_array[atom_offsets[i]:atom_offsets[i+1]], atom_name_array[i],
+                                     molecule_name_array[i], targets[target_index]['binding_site_grid'],
+                                     ligand_pose_save_path, conf_num, poses_saved_per_molecule, unique_run_id,
+                                     pose_writer, i)
+            if pose_writer:
+                pose_writer.close()
+
+    if params_dict['WRITE_STATS']:
+        # Rejection rates differ between targets, e.g. a tight binding site has more clashes
+        for target_name, target_pose_counts in zip(target_names, pose_counts):
+            info_lines.extend(get_pose_count_lines(dict(zip(pose_count_names, target_pose_counts.tolist())),
+                                                   f"{target_name} "))
+    if params_dict['SAVE_TOTAL_TIME']:
+        info_lines.append(f"REMARK total screen time: {timeit.default_timer() - time_start:.3f} seconds")
+    if write_info:
+        info_file_path = os.path.splitext(output_file_path)[0] + f'_info.txt'
+        with open(info_file_path, "w") as f:
+            f.writelines("\n".join(info_lines))
+    if not write_file:
+        output_file_path = None
+    if output_dictionary:
+        output_dictionary = {'Names': molecule_name_cleaned, 'Type': ligand_type}
+        for target_index, target_name in enumerate(target_names):
+            output_dictionary[target_name] = scores[:, target_index]
+        if conf_num > 1:
+            output_dictionary['Conformer number'] = molecule_conformer_number
+    else:
+        output_dictionary = None
+    return output_file_path, output_dictionary
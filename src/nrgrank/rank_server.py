@@ -0,0 +1,204 @@
+import os
+import json
+import argparse
+import threading
+import timeit
+import traceback
+import contextlib
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from nrgrank.rank_molecules import get_params_dict, load_target_from_params, load_ligands, score_ligands, \
+    get_rotation_matrices
+from nrgrank.process_ligands import read_mol2
+
+
+class ResidentTargets:
+    """ Keeps the most recently used preprocessed targets loaded in memory. The least recently used target is dropped
+    once more than max_targets are loaded"""
+    def __init__(self, max_targets=4):
+        self.max_targets = max_targets
+        self.targets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, preprocessed_target_path, params_dict):
+        key = (os.path.realpath(preprocessed_target_path), params_dict['LIGAND_TEST_DOT_SEPARATION'],
+               params_dict['USE_CLASH'], params_dict['CLASH_DOT_DISTANCE'], params_dict['SEARCH_MODE'],
+               params_dict['COARSE_TEST_DOT_SEPARATION'], params_dict['CF_GRID_SPACING'],
+               params_dict['CF_INTERPOLATION'])
+        with self.lock:
+            if key in self.targets:
+                self.targets.move_to_end(key)
+                return self.targets[key]
+        target = load_target_from_params(preprocessed_target_path, params_dict)
+        with self.lock:
+            self.targets[key] = target
+            self.targets.move_to_end(key)
+            while len(self.targets) > self.max_targets:
+                self.targets.popitem(last=False)
+        return target
+
+    def keys(self):
+        with self.lock:
+            return list(self.targets.keys())
+
+
+rotation_matrices_cache = {}
+# numba's default workqueue threading layer can not run parallel kernels from two threads at the same time
+parallel_scoring_lock = threading.Lock()
+
+
+def get_cached_rotation_matrices(n_rotations):
+    if n_rotations not in rotation_matrices_cache:
+        rotation_matrices_cache[n_rotations] = get_rotation_matrices(n_rotations)
+    return rotation_matrices_cache[n_rotations]
+
+
+def get_rotations_for_params(params_dict):
+    rotation_matrices = get_cached_rotation_matrices(params_dict['LIGAND_ROTATIONS_PER_AXIS'])
+    if params_dict['SEARCH_MODE'] == 'coarse_to_fine':
+        coarse_rotation_matrices = get_cached_rotation_matrices(params_dict['COARSE_ROTATIONS_PER_AXIS'])
+    else:
+        coarse_rotation_matrices = np.zeros((0, 3, 3), dtype=np.float64)
+    return rotation_matrices, coarse_rotation_matrices
+
+
+def warm_up(resident_targets, preprocessed_target_path, params_dict):
+    """ Loads a target and scores a small dummy ligand so the kernels are compiled before the first request"""
+    target = resident_targets.get(preprocessed_target_path, params_dict)
+    rotation_matrices, coarse_rotation_matrices = get_rotations_for_params(params_dict)
+    atom_xyz = np.array([[0, 0, 0], [1.5, 0, 0], [1.5, 1.5, 0]], dtype=np.float32)
+    atom_type = np.ones(3, dtype=np.int32)
+    atom_offsets = np.array([0, 3], dtype=np.int64)
+    score_ligands(target, atom_xyz, atom_type, atom_offsets, rotation_matrices, coarse_rotation_matrices,
+                  params_dict)
+    # Preprocessed ligands are memory mapped read only, which numba compiles separately
+    atom_xyz.flags.writeable = False
+    atom_type.flags.writeable = False
+    score_ligands(target, atom_xyz, atom_type, atom_offsets, rotation_matrices, coarse_rotation_matrices,
+                  params_dict)
+
+
+def score_request(resident_targets, request, server_config):
+    """ Scores one request. The request is a dictionary with the preprocessed target path in 'target' and either a
+    preprocessed ligand folder in 'ligands' (with optional 'ligand_type' and 'ligand_slice') or a mol2 file in 'mol2'.
+    'config' overrides the parameters the server was started with. With 'save_time', the answer has the time taken
+    per molecule, measured like in nrgrank_main"""
+    if 'target' not in request:
+        raise ValueError("The request must contain a 'target'")
+    params_dict = get_params_dict({**server_config, **request.get('config', {})})
+    target = resident_targets.get(request['target'], params_dict)
+    rotation_matrices, coarse_rotation_matrices = get_rotations_for_params(params_dict)
+
+    if 'mol2' in request:
+        if not os.path.isfile(request['mol2']):
+            raise FileNotFoundError(f"{request['mol2']} does not exist")
+        _, atom_type, atom_xyz, atom_offsets, molecule_names = read_mol2(request['mol2'])
+    elif 'ligands' in request:
+        if not os.path.isdir(request['ligands']):
+            raise FileNotFoundError(f"{request['ligands']} does not exist")
+        ligand_slice = request.get('ligand_slice') or [0, None]
+        _, atom_type, atom_xyz, atom_offsets, molecule_names, _, _ = \
+            load_ligands(None, request.get('ligand_type', 'ligand'), ligand_slice[0], ligand_slice[1],
+                         params_dict['CONFORMERS_PER_MOLECULE'], path_to_ligands=request['ligands'],
+                         batches=params_dict['LIGAND_BATCHES'])
+    else:
+        raise ValueError("The request must contain 'ligands' or 'mol2'")
+
+    save_time = bool(request.get('save_time', False))
+    # Batches are scored by parallel kernels, molecules one at a time by serial kernels that can run side by side
+    scoring_lock = parallel_scoring_lock if params_dict['BATCH_SIZE'] > 0 else contextlib.nullcontext()
+    with scoring_lock:
+        top_poses_list, _, time_list, _ = score_ligands(target, atom_xyz, atom_type, atom_offsets, rotation_matrices,
+                                                        coarse_rotation_matrices, params_dict, save_time=save_time)
+    answer = {'Names': [molecule_name.rsplit('_', 1)[0] for molecule_name in molecule_names],
+              'Conformer number': [molecule_name.rsplit('_', 1)[1] for molecule_name in molecule_names],
+              'Score': np.rint(top_poses_list[:, 0, 0]).astype(np.int64).tolist(),
+              'Binding site': request['target']}
+    if save_time:
+        answer['Time'] = time_list.tolist()
+    return answer
+
+
+def make_request_handler(resident_targets, server_config):
+    class RequestHandler(BaseHTTPRequestHandler):
+        def send_json(self, status, content):
+            body = json.dumps(content).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/targets':
+                self.send_json(200, {'targets': [key[0] for key in resident_targets.keys()]})
+            else:
+                self.send_json(404, {'error': f'Unknown path: {self.path}'})
+
+        def do_POST(self):
+            if self.path != '/score':
+                self.send_json(404, {'error': f'Unknown path: {self.path}'})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                self.send_json(200, score_request(resident_targets, request, server_config))
+            except (FileNotFoundError, IsADirectoryError, ValueError, TypeError, KeyError) as e:
+                self.send_json(400, {'error': f'{type(e).__name__}: {e}'})
+            except Exception as e:
+                # Errors while scoring must still get an answer, otherwise the client waits on a closed connection
+                traceback.print_exc()
+                self.send_json(500, {'error': f'{type(e).__name__}: {e}'})
+
+        def log_message(self, format, *args):
+            if server_config.get('VERBOSE'):
+                super().log_message(format, *args)
+
+    return RequestHandler
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Scoring server that keeps preprocessed targets in memory')
+    parser.add_argument('-t', '--targets', type=str, default='',
+                        help='Preprocessed target folders loaded at startup. If multiple: separate with comma no space')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address the server listens on')
+    parser.add_argument('-p', '--port', type=int, default=8765, help='Port the server listens on')
+    parser.add_argument('-m', '--max_targets', type=int, default=4, help='Number of targets kept in memory')
+    parser.add_argument('-c', '--config', type=str, default=None,
+                        help='JSON file with parameters overriding the default docking parameters')
+    args = parser.parse_args()
+    user_config = {}
+    if args.config:
+        with open(args.config) as f:
+            user_config = json.load(f)
+    preprocessed_target_paths = [target for target in args.targets.split(',') if target]
+    main(preprocessed_target_paths, host=args.host, port=args.port, max_targets=args.max_targets, **user_config)
+
+
+def main(preprocessed_target_paths=(), host='127.0.0.1', port=8765, max_targets=4, **user_config):
+    """
+    Starts a local HTTP server answering score requests.
+
+    POST /score with a JSON body {"target": path, "ligands": path} or {"target": path, "mol2": path}. Optional keys are
+    "ligand_type", "ligand_slice", "save_time" and "config". The answer has the same keys as the dictionary returned by
+    nrgrank_main. GET /targets lists the targets held in memory.
+    """
+    server_config = dict(user_config)
+    params_dict = get_params_dict(server_config)
+    resident_targets = ResidentTargets(max(max_targets, len(preprocessed_target_paths), 1))
+    for preprocessed_target_path in preprocessed_target_paths:
+        time_start = timeit.default_timer()
+        warm_up(resident_targets, preprocessed_target_path, params_dict)
+        print(f'Loaded {preprocessed_target_path} in {timeit.default_timer() - time_start:.3f} seconds')
+    server = ThreadingHTTPServer((host, port), make_request_handler(resident_targets, server_config))
+    print(f'Listening on http://{host}:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    get_args()
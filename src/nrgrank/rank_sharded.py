@@ -0,0 +1,218 @@
+import os
+import csv
+import json
+import pickle
+import shutil
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from nrgrank.general_functions import load_string_table
+from nrgrank.rank_molecules import (main as rank_molecules_main, get_params_dict, get_result_file_extension,
+                                    get_ligand_batches, get_conformer_group_offsets)
+
+
+def get_ligand_prefixes(preprocessed_ligand_path, ligand_type='ligand', batches=None):
+    """ File prefixes of the ligand shards in library order. With batches, only the shards of these batches, in the
+    order the loader reads them"""
+    manifest_path = os.path.join(preprocessed_ligand_path, f"{ligand_type}_manifest.json")
+    if not os.path.isfile(manifest_path):
+        return [ligand_type]
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    shards = manifest["shards"]
+    if batches is not None:
+        shards = [shard for shard in shards if shard.get("batch", 0) in batches]
+    return [shard["prefix"] for shard in shards]
+
+
+def get_atoms_per_molecule(preprocessed_ligand_path, ligand_type='ligand', batches=None):
+    prefixes = get_ligand_prefixes(preprocessed_ligand_path, ligand_type, batches)
+    atoms_per_molecule = [np.load(os.path.join(preprocessed_ligand_path, f"{prefix}_atoms_num_per_ligand.npy"))
+                          for prefix in prefixes]
+    if not atoms_per_molecule:
+        return np.zeros(0, dtype=np.int32)
+    return np.concatenate(atoms_per_molecule)
+
+
+def get_molecule_names(preprocessed_ligand_path, ligand_type='ligand', batches=None):
+    molecule_names = []
+    for prefix in get_ligand_prefixes(preprocessed_ligand_path, ligand_type, batches):
+        if os.path.isfile(os.path.join(preprocessed_ligand_path, f"{prefix}_molecule_name_offsets.npy")):
+            molecule_names.extend(load_string_table(preprocessed_ligand_path, f"{prefix}_molecule_name"))
+        else:
+            # Ligands preprocessed before the ragged layout
+            with open(os.path.join(preprocessed_ligand_path, f"{prefix}_molecule_name.pkl"), 'rb') as f:
+                molecule_names.extend(pickle.load(f))
+    return molecule_names
+
+
+def get_balanced_slices(atoms_per_molecule, n_shards, group_offsets=None):
+    """ Splits the molecules in n_shards contiguous slices holding about the same number of atoms, since the scoring
+    time of a molecule grows with its number of atoms. With group_offsets, every slice boundary is moved to the
+    nearest group start so the conformers of a molecule are scored in the same shard"""
+    cumulative_atoms = np.cumsum(atoms_per_molecule, dtype=np.int64)
+    total_atoms = cumulative_atoms[-1] if len(cumulative_atoms) else 0
+    targets = total_atoms * np.arange(1, n_shards) / n_shards
+    boundaries = np.searchsorted(cumulative_atoms, targets, side='right')
+    if group_offsets is not None:
+        atoms_before = np.concatenate(([0], cumulative_atoms))
+        group_atoms_before = atoms_before[group_offsets]
+        next_group = np.clip(np.searchsorted(group_offsets, boundaries), 1, len(group_offsets) - 1)
+        closer_to_previous = (atoms_before[boundaries] - group_atoms_before[next_group - 1] <=
+                              group_atoms_before[next_group] - atoms_before[boundaries])
+        boundaries = group_offsets[np.where(closer_to_previous, next_group - 1, next_group)]
+    boundaries = np.concatenate(([0], boundaries, [len(atoms_per_molecule)]))
+    return [[int(boundaries[i]), int(boundaries[i+1])] for i in range(n_shards)]
+
+
+def get_shard_name(shard_index, n_shards):
+    return f"shard_{shard_index:04d}_of_{n_shards:04d}"
+
+
+def remove_shard_outputs(shard_folder_path, shard_name):
+    """ Removes everything a previous run of the shard wrote: result table, info file, columns, poses and checkpoint"""
+    for file_name in os.listdir(shard_folder_path):
+        if file_name == shard_name or file_name.startswith((f"{shard_name}_", f"{shard_name}.")):
+            file_path = os.path.join(shard_folder_path, file_name)
+            if os.path.isdir(file_path):
+                shutil.rmtree(file_path)
+            else:
+                os.remove(file_path)
+
+
+def run_shard(shard_index, n_shards, target_name, preprocessed_target_path, preprocessed_ligand_path, shard_folder_path,
+              ligand_type='ligand', file_separator=',', **user_config):
+    """ Scores one shard. The output name only depends on the shard so a shard that is run again replaces its
+    previous output, unless RESUME is set to continue it from its checkpoint. The shard table always has a header
+    so it can be merged. LIGAND_BATCHES is resolved here when the shard is run on its own, so the slices and the
+    loader always count the molecules of the same batches"""
+    batches = get_ligand_batches(preprocessed_ligand_path, ligand_type, get_params_dict(user_config)['LIGAND_BATCHES'])
+    user_config = dict(user_config, LIGAND_BATCHES=batches)
+    atoms_per_molecule = get_atoms_per_molecule(preprocessed_ligand_path, ligand_type, batches)
+    group_offsets = None
+    if get_params_dict(user_config)['BEST_CONFORMER_ONLY']:
+        # One row per molecule is only kept if all its conformers are in the same shard
+        group_offsets = get_conformer_group_offsets(
+            [molecule_name.rsplit('_', 1)[0]
+             for molecule_name in get_molecule_names(preprocessed_ligand_path, ligand_type, batches)])
+    ligand_slice = get_balanced_slices(atoms_per_molecule, n_shards, group_offsets)[shard_index]
+    shard_name = get_shard_name(shard_index, n_shards)
+    if not get_params_dict(user_config)['RESUME']:
+        remove_shard_outputs(shard_folder_path, shard_name)
+    output_file_path, _ = rank_molecules_main(target_name, preprocessed_target_path, preprocessed_ligand_path,
+                                              shard_folder_path, result_csv_and_pose_name=shard_name,
+                                              ligand_type=ligand_type, ligand_slice=ligand_slice,
+                                              file_separator=file_separator, output_header=True,
+                                              output_dictionary=False, **user_config)
+    return output_file_path
+
+
+def merge_shards(shard_folder_path, n_shards, output_file_path, file_separator=',', output_header=True):
+    """ Merges the shard tables into one table ranked by score. Molecules with the same score keep the library order"""
+    extension = get_result_file_extension(file_separator)
+    shard_file_paths = [os.path.join(shard_folder_path, f"{get_shard_name(i, n_shards)}.{extension}")
+                        for i in range(n_shards)]
+    missing_shards = [os.path.basename(path) for path in shard_file_paths if not os.path.isfile(path)]
+    if missing_shards:
+        raise FileNotFoundError(f"Missing shard results in {shard_folder_path}: {', '.join(missing_shards)}")
+    header = None
+    rows = []
+    for shard_file_path in shard_file_paths:
+        with open(shard_file_path) as f:
+            reader = csv.reader(f, delimiter=file_separator)
+            header = next(reader, header)
+            rows.extend(row for row in reader if row)
+    score_column = header.index('Score')
+    rows.sort(key=lambda row: int(row[score_column]))
+    with open(output_file_path, 'w') as f:
+        if output_header:
+            f.write(file_separator.join(header) + "\n")
+        for row in rows:
+            f.write(f'"{row[0]}"{file_separator}' + file_separator.join(row[1:]) + "\n")
+    return output_file_path
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Screen a ligand library in shards and merge the results')
+    parser.add_argument('-n', '--target_name', type=str, required=True, help='Name of the target')
+    parser.add_argument('-t', '--preprocessed_target_path', type=str, required=True,
+                        help='Path to the preprocessed target folder')
+    parser.add_argument('-l', '--preprocessed_ligand_path', type=str, required=True,
+                        help='Path to the preprocessed ligand folder')
+    parser.add_argument('-o', '--result_folder_path', type=str, required=True, help='Folder for the results')
+    parser.add_argument('-s', '--n_shards', type=int, required=True, help='Number of shards')
+    parser.add_argument('-p', '--processes', type=int, default=None,
+                        help='Number of processes used to score the shards locally')
+    parser.add_argument('-i', '--shard_index', type=int, default=None,
+                        help='Only score this shard, e.g. the task id of an array job')
+    parser.add_argument('-m', '--merge_only', action='store_true', help='Only merge the shard results')
+    parser.add_argument('-c', '--config', type=str, default=None,
+                        help='JSON file with parameters overriding the default docking parameters')
+    args = parser.parse_args()
+    user_config = {}
+    if args.config:
+        with open(args.config) as f:
+            user_config = json.load(f)
+    main(args.target_name, args.preprocessed_target_path, args.preprocessed_ligand_path, args.result_folder_path,
+         args.n_shards, processes=args.processes, shard_index=args.shard_index, merge_only=args.merge_only,
+         **user_config)
+
+
+def main(target_name, preprocessed_target_path, preprocessed_ligand_path, result_folder_path, n_shards,
+         processes=None, shard_index=None, merge_only=False, ligand_type='ligand', file_separator=',',
+         output_header=True, **user_config):
+    """
+    Screens a preprocessed ligand library in n_shards shards balanced by atom count and merges the shard results in
+    one table ranked by score.
+
+    Parameters:
+        target_name (str): The name of the target. Used to name the merged table.
+        preprocessed_target_path (str): Path to the preprocessed target folder from process_target().
+        preprocessed_ligand_path (str): Path to the preprocessed ligand folder from process_ligand().
+        result_folder_path (str): Directory path where the results will be stored. Shard results go in a 'shards'
+            sub folder.
+        n_shards (int): Number of shards the library is split in.
+        processes (int, optional): Number of shards scored at the same time on this machine. Default is None, which
+            uses one process per CPU.
+        shard_index (int, optional): Only score this shard and do not merge. Used when each shard runs as an
+            independent task, e.g. in an array job. Default is None.
+        merge_only (bool, optional): Only merge the results of shards that were scored before. Default is False.
+        ligand_type (str, optional): Type of ligand being processed (e.g., "ligand"). Default is 'ligand'.
+        file_separator (str, optional): Separator of the shard and merged tables, which also sets their extension.
+            Default is ','.
+        output_header (bool, optional): Write a header row in the merged table. Shard tables always have one.
+            Default is True.
+        **user_config: Arbitrary keyword arguments for overriding default docking parameters.
+
+    Returns:
+        The path to the merged table, or to the shard table when shard_index is given
+    """
+    if n_shards < 1:
+        raise ValueError(f"n_shards must be at least 1, got {n_shards}")
+    if shard_index is not None and not 0 <= shard_index < n_shards:
+        raise ValueError(f"shard_index must be between 0 and {n_shards - 1}, got {shard_index}")
+    shard_folder_path = os.path.join(result_folder_path, 'shards')
+    if not os.path.isdir(shard_folder_path):
+        os.makedirs(shard_folder_path, exist_ok=True)
+
+    if shard_index is not None:
+        return run_shard(shard_index, n_shards, target_name, preprocessed_target_path, preprocessed_ligand_path,
+                         shard_folder_path, ligand_type=ligand_type, file_separator=file_separator, **user_config)
+    if not merge_only:
+        # 'latest' is resolved once so every shard splits the same batches, even if one is appended during the run
+        user_config['LIGAND_BATCHES'] = get_ligand_batches(preprocessed_ligand_path, ligand_type,
+                                                           get_params_dict(user_config)['LIGAND_BATCHES'])
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(run_shard, i, n_shards, target_name, preprocessed_target_path,
+                                       preprocessed_ligand_path, shard_folder_path, ligand_type, file_separator,
+                                       **user_config)
+                       for i in range(n_shards)]
+            for future in futures:
+                future.result()
+    output_file_path = os.path.join(result_folder_path,
+                                    f"{target_name}_ranked.{get_result_file_extension(file_separator)}")
+    return merge_shards(shard_folder_path, n_shards, output_file_path, file_separator, output_header)
+
+
+if __name__ == '__main__':
+    get_args()
@@ -0,0 +1,36 @@
+import numpy as np
+from nrgrank.rank_molecules import get_cf_with_clash, pose_count_names
+
+default_cf = 100000000
+
+
+def score_one_atom_pose(x, clash_list, cf_list):
+    """ Scores a pose of one atom at (x, 0, 0) on a clash grid of 1 A cells and a CF grid of 10 A cells, both from the
+    origin"""
+    lig_pose = np.array([[x, 0.0, 0.0]])
+    return get_cf_with_clash(lig_pose, np.zeros(3), np.zeros((3, 2)), 1.0, np.array(cf_list.shape[:3]), cf_list,
+                             np.ones(1, dtype=np.int32), default_cf, 10.0, np.zeros(3), False, clash_list,
+                             np.array(clash_list.shape), 1, np.inf, np.zeros(1),
+                             np.zeros(len(pose_count_names), dtype=np.int64))
+
+
+def test_clash_index_is_clamped_to_the_clash_grid():
+    # The clash grid is larger than the CF grid, its cell 1 clashes
+    clash_list = np.zeros((4, 4, 4), dtype=np.bool_)
+    clash_list[1] = True
+    cf_list = np.full((2, 2, 2, 1), -5.0, dtype=np.float32)
+    # Index 2 equals the CF grid size but is inside the clash grid, it must not be moved to the clashing cell 1.
+    # Scores were default_cf for such poses before the clamp used the clash grid size
+    assert score_one_atom_pose(2.0, clash_list, cf_list) == -5.0
+    assert score_one_atom_pose(1.0, clash_list, cf_list) == default_cf
+
+
+def test_pose_past_the_clash_grid():
+    clash_list = np.zeros((4, 4, 4), dtype=np.bool_)
+    cf_list = np.full((2, 2, 2, 1), -5.0, dtype=np.float32)
+    # Index 4 is one past the last cell and is moved back to it, further out the pose is out of bounds
+    assert score_one_atom_pose(4.0, clash_list, cf_list) == -5.0
+    clash_list[3] = True
+    assert score_one_atom_pose(4.0, clash_list, cf_list) == default_cf
+    clash_list[3] = False
+    assert score_one_atom_pose(5.0, clash_list, cf_list) == default_cf
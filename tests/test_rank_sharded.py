@@ -0,0 +1,26 @@
+import numpy as np
+from nrgrank.rank_molecules import get_conformer_group_offsets
+from nrgrank.rank_sharded import get_balanced_slices
+
+
+def test_slices_split_molecules_by_atom_count():
+    atoms_per_molecule = np.full(6, 10)
+    assert get_balanced_slices(atoms_per_molecule, 2) == [[0, 3], [3, 6]]
+
+
+def test_slices_keep_conformer_groups_together():
+    # The atom midpoint falls between the second and third conformers of mol_b
+    molecule_names = ['mol_a_1', 'mol_a_2', 'mol_b_1', 'mol_b_2', 'mol_b_3', 'mol_b_4']
+    group_offsets = get_conformer_group_offsets([name.rsplit('_', 1)[0] for name in molecule_names])
+    assert group_offsets.tolist() == [0, 2, 6]
+    atoms_per_molecule = np.full(6, 10)
+    assert get_balanced_slices(atoms_per_molecule, 2, group_offsets) == [[0, 2], [2, 6]]
+
+
+def test_slices_move_to_nearest_group_start():
+    atoms_per_molecule = np.full(6, 10)
+    # The atom midpoint is at the fourth molecule, 10 atoms after the start of the second group here
+    assert get_balanced_slices(atoms_per_molecule, 2, np.array([0, 2, 5, 6])) == [[0, 2], [2, 6]]
+    # and 10 atoms before the start of the third group there
+    assert get_balanced_slices(atoms_per_molecule, 2, np.array([0, 1, 4, 6])) == [[0, 4], [4, 6]]
+    assert get_balanced_slices(atoms_per_molecule, 3, np.array([0, 1, 4, 6])) == [[0, 1], [1, 4], [4, 6]]